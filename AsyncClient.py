@@ -0,0 +1,236 @@
+"""
+asyncio front-end for the EClient/EWrapper pair.
+
+The socket is read with asyncio streams and every message is decoded and
+dispatched on the event loop, so there is no reader thread and no callback
+ever crosses a thread. The request encoding is the stock EClient one, only
+sendMsg() is redirected to the stream writer.
+
+    client = AsyncClient()
+    await client.connectAsync("127.0.0.1", 7497, 0)
+    bars = await client.historical_bars(contract, durationStr="1 D")
+    async for tick in client.ticks(contract, "BidAsk"):
+        ...
+"""
+
+import asyncio
+import logging
+import struct
+
+from ibapi import comm
+from ibapi import decoder
+from ibapi import wrapper
+from ibapi.client import EClient
+from ibapi.common import (BarData, HistoricalTick, HistoricalTickBidAsk,
+                          HistoricalTickLast, TickAttribBidAsk, TickAttribLast,
+                          TickerId)
+from ibapi.contract import Contract, ContractDetails
+from ibapi.server_versions import MIN_CLIENT_VER, MAX_CLIENT_VER
+
+from ErrorCodes import isWarning
+from RequestMgr import RequestError, RequestMgr
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncClient(wrapper.EWrapper, EClient):
+    def __init__(self):
+        wrapper.EWrapper.__init__(self)
+        EClient.__init__(self, wrapper=self)
+        self.reqMgr = RequestMgr()
+        self.tickQueues = {}
+        self.streamReader = None
+        self.streamWriter = None
+        self.readTask = None
+        self.nextValidOrderId = None
+        self.nextReqId = 1
+        self.ready = None
+
+    def getReqId(self) -> int:
+        reqId = self.nextReqId
+        self.nextReqId += 1
+        return reqId
+
+    async def _readMsg(self) -> tuple:
+        header = await self.streamReader.readexactly(4)
+        size = struct.unpack("!I", header)[0]
+        return comm.read_fields(await self.streamReader.readexactly(size))
+
+    async def connectAsync(self, host: str, port: int, clientId: int,
+                           timeout: float = 10.):
+        self.host = host
+        self.port = port
+        self.clientId = clientId
+        self.ready = asyncio.Event()
+        self.streamReader, self.streamWriter = await asyncio.open_connection(host, port)
+        self.setConnState(EClient.CONNECTING)
+
+        v100version = "v%d..%d" % (MIN_CLIENT_VER, MAX_CLIENT_VER)
+        if self.connectionOptions:
+            v100version = v100version + " " + self.connectionOptions
+        self.streamWriter.write(b"API\0" + comm.make_msg(v100version))
+
+        self.decoder = decoder.Decoder(self, 0)
+        fields = await asyncio.wait_for(self._readMsg(), timeout)
+        # sometimes news come before the server version
+        while len(fields) != 2:
+            self.decoder.interpret(fields)
+            fields = await asyncio.wait_for(self._readMsg(), timeout)
+
+        (serverVersion, connTime) = fields
+        self.serverVersion_ = int(serverVersion)
+        self.connTime = connTime
+        self.decoder.serverVersion = self.serverVersion_
+        self.setConnState(EClient.CONNECTED)
+        logger.debug("connected, server version %d", self.serverVersion_)
+
+        self.readTask = asyncio.ensure_future(self._readLoop())
+        self.startApi()
+        await asyncio.wait_for(self.ready.wait(), timeout)
+
+    async def _readLoop(self):
+        try:
+            while True:
+                self.decoder.interpret(await self._readMsg())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info("connection closed by peer")
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._closed()
+
+    def _closed(self):
+        if self.connState == EClient.DISCONNECTED:
+            return
+        self.setConnState(EClient.DISCONNECTED)
+        if self.streamWriter is not None:
+            self.streamWriter.close()
+        for reqId in list(self.reqMgr.requests):
+            self.reqMgr.receivedError(reqId, -1, "connection closed")
+        for q in self.tickQueues.values():
+            q.put_nowait(ConnectionError("connection closed"))
+        self.connectionClosed()
+
+    def isConnected(self):
+        return EClient.CONNECTED == self.connState and self.streamWriter is not None \
+               and not self.streamWriter.is_closing()
+
+    def sendMsg(self, msg):
+        self.streamWriter.write(comm.make_msg(msg))
+
+    def disconnect(self):
+        if self.readTask is not None:
+            self.readTask.cancel()
+        self._closed()
+
+    def run(self):
+        """ there is no reader thread loop, messages are read by connectAsync() """
+        raise RuntimeError("AsyncClient has no run() loop: await connectAsync() on an "
+                           "asyncio event loop, it reads and dispatches the messages")
+
+    # high level API
+
+    async def historical_bars(self, contract: Contract, endDateTime: str = "",
+                              durationStr: str = "1 D", barSizeSetting: str = "5 mins",
+                              whatToShow: str = "TRADES", useRTH: int = 1,
+                              formatDate: int = 2) -> list:
+        reqId = self.getReqId()
+        act = self.reqMgr.expect(reqId, "reqHistoricalData")
+        self.reqHistoricalData(reqId, contract, endDateTime, durationStr,
+                               barSizeSetting, whatToShow, useRTH, formatDate,
+                               False, [])
+        return await act
+
+    async def contract_details(self, contract: Contract) -> list:
+        reqId = self.getReqId()
+        act = self.reqMgr.expect(reqId, "reqContractDetails")
+        self.reqContractDetails(reqId, contract)
+        return await act
+
+    async def ticks(self, contract: Contract, tickType: str = "Last",
+                    numberOfTicks: int = 0, ignoreSize: bool = False):
+        """ async iterator over tick-by-tick data, tickType is one of "Last",
+        "AllLast", "BidAsk" or "MidPoint". Leaving the loop cancels the
+        subscription. """
+        reqId = self.getReqId()
+        q = asyncio.Queue()
+        self.tickQueues[reqId] = q
+        self.reqTickByTickData(reqId, contract, tickType, numberOfTicks, ignoreSize)
+        try:
+            while True:
+                tick = await q.get()
+                if isinstance(tick, Exception):
+                    raise tick
+                yield tick
+        finally:
+            del self.tickQueues[reqId]
+            if self.isConnected():
+                self.cancelTickByTickData(reqId)
+
+    # wrapper callbacks
+
+    def nextValidId(self, orderId: int):
+        self.nextValidOrderId = orderId
+        self.ready.set()
+
+    def error(self, reqId: TickerId, errorCode: int, errorString: str):
+        logger.info("error %d %d %s", reqId, errorCode, errorString)
+        if isWarning(errorCode):
+            return
+        self.reqMgr.receivedError(reqId, errorCode, errorString)
+        q = self.tickQueues.get(reqId)
+        if q is not None:
+            q.put_nowait(RequestError(reqId, errorCode, errorString))
+
+    def historicalData(self, reqId: int, bar: BarData):
+        self.reqMgr.receivedMsg(reqId, bar)
+
+    def historicalDataEnd(self, reqId: int, start: str, end: str):
+        self.reqMgr.receivedEnd(reqId)
+
+    def contractDetails(self, reqId: int, contractDetails: ContractDetails):
+        self.reqMgr.receivedMsg(reqId, contractDetails)
+
+    def bondContractDetails(self, reqId: int, contractDetails: ContractDetails):
+        self.reqMgr.receivedMsg(reqId, contractDetails)
+
+    def contractDetailsEnd(self, reqId: int):
+        self.reqMgr.receivedEnd(reqId)
+
+    def tickByTickAllLast(self, reqId: int, tickType: int, time: int, price: float,
+                          size: int, tickAttribLast: TickAttribLast, exchange: str,
+                          specialConditions: str):
+        q = self.tickQueues.get(reqId)
+        if q is None:
+            return
+        tick = HistoricalTickLast()
+        tick.time = time
+        tick.tickAttribLast = tickAttribLast
+        tick.price = price
+        tick.size = size
+        tick.exchange = exchange
+        tick.specialConditions = specialConditions
+        q.put_nowait(tick)
+
+    def tickByTickBidAsk(self, reqId: int, time: int, bidPrice: float, askPrice: float,
+                         bidSize: int, askSize: int, tickAttribBidAsk: TickAttribBidAsk):
+        q = self.tickQueues.get(reqId)
+        if q is None:
+            return
+        tick = HistoricalTickBidAsk()
+        tick.time = time
+        tick.tickAttribBidAsk = tickAttribBidAsk
+        tick.priceBid = bidPrice
+        tick.priceAsk = askPrice
+        tick.sizeBid = bidSize
+        tick.sizeAsk = askSize
+        q.put_nowait(tick)
+
+    def tickByTickMidPoint(self, reqId: int, time: int, midPoint: float):
+        q = self.tickQueues.get(reqId)
+        if q is None:
+            return
+        tick = HistoricalTick()
+        tick.time = time
+        tick.price = midPoint
+        q.put_nowait(tick)
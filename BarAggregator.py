@@ -0,0 +1,232 @@
+"""
+Streaming OHLCV + VWAP candles from trades and 5 seconds real time bars.
+
+A BarAggregator rolls tickByTickAllLast trades and realtimeBar bars up into
+candles of barSeconds (60, 300, 900 or any custom length), aligned on epoch
+multiples of barSeconds and labelled with their start time like the bars of
+reqHistoricalData. Each update touches a handful of scalars of the candle in
+progress, O(1). A candle is closed, written to the BarStore and reported to
+onClose(row, start) when:
+ - an update of a later candle arrives,
+ - a real time bar reaches the end of the candle,
+ - or flush(now) finds it over (symbols without updates).
+Data older than the last closed candle of a symbol is dropped and counted in
+nLate, a published candle is never rewritten.
+
+    aggregator = BarAggregator(300, store)
+    aggregator.addSymbol("MSFT", reqId)
+    aggregator.addBar(reqId, time, open_, high, low, close, volume, wap, count)
+"""
+
+import functools
+import threading
+import time
+
+from ibapi.object_implem import Object
+
+from BarStore import BarStore
+
+NO_CANDLE = -1
+
+
+class BarAggregator(Object):
+    def __init__(self, barSeconds: int, store: BarStore = None, onClose=None):
+        self.barSeconds = barSeconds
+        self.store = store if store is not None else BarStore()
+        self.onClose = onClose
+        # candle in progress per store row, as plain lists: scalar access to
+        # a list is much cheaper than to a NumPy array
+        self.start = []
+        self.open = []
+        self.high = []
+        self.low = []
+        self.close = []
+        self.volume = []
+        self.notional = []
+        self.count = []
+        self.lastClosed = []
+        self.reqId2row = {}
+        self.nLate = 0
+        # updates come from the reader thread, flush() from any other
+        self.lock = threading.Lock()
+
+    def addSymbol(self, symbol: str, reqId: int = None) -> int:
+        row = self.store.addSymbol(symbol, reqId)
+        with self.lock:
+            while len(self.start) <= row:
+                for state in (self.open, self.high, self.low, self.close,
+                              self.volume, self.notional):
+                    state.append(0.)
+                self.count.append(0)
+                self.start.append(NO_CANDLE)
+                self.lastClosed.append(NO_CANDLE)
+            if reqId is not None:
+                self.reqId2row[reqId] = row
+        return row
+
+    def resume(self, symbol: str, now: float = None):
+        """ continue the series already in the store (e.g. backfilled with
+        reqHistoricalData): a last bar still in progress becomes the candle
+        in progress, the ones before it are never touched """
+        if now is None:
+            now = time.time()
+        store = self.store
+        row = store.symbol2row[symbol]
+        n = int(store.counts[row])
+        if n == 0:
+            return
+        with self.lock:
+            last = int(store.time[row, n - 1])
+            if last + self.barSeconds <= now:
+                self.lastClosed[row] = last
+                return
+            # the store overwrites a bar appended again with the same time
+            self.lastClosed[row] = int(store.time[row, n - 2]) if n > 1 else NO_CANDLE
+            self.start[row] = last
+            self.open[row] = float(store.open[row, n - 1])
+            self.high[row] = float(store.high[row, n - 1])
+            self.low[row] = float(store.low[row, n - 1])
+            self.close[row] = float(store.close[row, n - 1])
+            volume = max(float(store.volume[row, n - 1]), 0.)
+            self.volume[row] = volume
+            self.notional[row] = float(store.average[row, n - 1]) * volume
+            self.count[row] = int(store.barCount[row, n - 1])
+
+    def _closeCandle(self, row: int) -> int:
+        start = self.start[row]
+        volume = self.volume[row]
+        vwap = self.notional[row] / volume if volume > 0 else self.close[row]
+        self.store.append(row, start, self.open[row], self.high[row], self.low[row],
+                          self.close[row], volume, self.count[row], vwap)
+        self.start[row] = NO_CANDLE
+        self.lastClosed[row] = start
+        return start
+
+    def _update(self, row: int, time_: int, open_: float, high: float, low: float,
+                close: float, volume: float, notional: float, count: int,
+                endTime: int) -> tuple:
+        """ returns the starts of the candles closed by this update """
+        barSeconds = self.barSeconds
+        start = time_ - time_ % barSeconds
+        if start <= self.lastClosed[row]:
+            self.nLate += 1
+            return ()
+        closed = ()
+        current = self.start[row]
+        if current != start:
+            if current != NO_CANDLE:
+                closed = (self._closeCandle(row),)
+            self.start[row] = start
+            self.open[row] = open_
+            self.high[row] = high
+            self.low[row] = low
+            self.close[row] = close
+            self.volume[row] = volume
+            self.notional[row] = notional
+            self.count[row] = count
+        else:
+            if high > self.high[row]:
+                self.high[row] = high
+            if low < self.low[row]:
+                self.low[row] = low
+            self.close[row] = close
+            self.volume[row] += volume
+            self.notional[row] += notional
+            self.count[row] += count
+        if endTime >= start + barSeconds:
+            # the update covers the end of the candle, no need to wait
+            closed += (self._closeCandle(row),)
+        return closed
+
+    def _notify(self, row: int, closed: tuple):
+        if self.onClose is not None:
+            for start in closed:
+                self.onClose(row, start)
+
+    def addTrade(self, reqId: int, time_: int, price: float, size: float):
+        """ from tickByTickAllLast (or Last) """
+        row = self.reqId2row.get(reqId)
+        if row is None:
+            return
+        with self.lock:
+            closed = self._update(row, time_, price, price, price, price, size,
+                                  price * size, 1, time_)
+        if closed:
+            self._notify(row, closed)
+
+    def addBar(self, reqId: int, time_: int, open_: float, high: float, low: float,
+               close: float, volume: float, wap: float, count: int,
+               barSeconds: int = 5):
+        """ from realtimeBar, time_ is the start of the barSeconds long bar """
+        row = self.reqId2row.get(reqId)
+        if row is None:
+            return
+        # bid/ask/midpoint bars have no volume (-1)
+        volume = max(volume, 0)
+        with self.lock:
+            closed = self._update(row, time_, open_, high, low, close, volume,
+                                  wap * volume, count, time_ + barSeconds)
+        if closed:
+            self._notify(row, closed)
+
+    def flush(self, now: float = None, grace: float = 0.) -> list:
+        """ close the candles ended before now - grace; returns their rows """
+        if now is None:
+            now = time.time()
+        closed = []
+        with self.lock:
+            for (row, start) in enumerate(self.start):
+                if start != NO_CANDLE and start + self.barSeconds <= now - grace:
+                    closed.append((row, self._closeCandle(row)))
+        if self.onClose is not None:
+            for (row, start) in closed:
+                self.onClose(row, start)
+        return [row for (row, _) in closed]
+
+    def current(self, symbol: str) -> dict:
+        """ the candle in progress of a symbol, None if there is none """
+        row = self.store.symbol2row[symbol]
+        with self.lock:
+            if self.start[row] == NO_CANDLE:
+                return None
+            volume = self.volume[row]
+            return {"time": self.start[row], "open": self.open[row],
+                    "high": self.high[row], "low": self.low[row],
+                    "close": self.close[row], "volume": volume,
+                    "average": self.notional[row] / volume if volume > 0
+                    else self.close[row],
+                    "barCount": self.count[row]}
+
+
+class BarAggregators(Object):
+    """ several candle lengths over the same streams, one BarStore each """
+
+    def __init__(self, barSecondsList=(60, 300, 900), onClose=None):
+        self.aggregators = {}
+        for barSeconds in barSecondsList:
+            callback = None
+            if onClose is not None:
+                callback = functools.partial(onClose, barSeconds)
+            self.aggregators[barSeconds] = BarAggregator(barSeconds, onClose=callback)
+
+    def store(self, barSeconds: int) -> BarStore:
+        return self.aggregators[barSeconds].store
+
+    def addSymbol(self, symbol: str, reqId: int = None):
+        for aggregator in self.aggregators.values():
+            aggregator.addSymbol(symbol, reqId)
+
+    def addTrade(self, reqId: int, time_: int, price: float, size: float):
+        for aggregator in self.aggregators.values():
+            aggregator.addTrade(reqId, time_, price, size)
+
+    def addBar(self, reqId: int, time_: int, open_: float, high: float, low: float,
+               close: float, volume: float, wap: float, count: int,
+               barSeconds: int = 5):
+        for aggregator in self.aggregators.values():
+            aggregator.addBar(reqId, time_, open_, high, low, close, volume, wap,
+                              count, barSeconds)
+
+    def flush(self, now: float = None, grace: float = 0.):
+        for aggregator in self.aggregators.values():
+            aggregator.flush(now, grace)
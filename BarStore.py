@@ -0,0 +1,140 @@
+"""
+Columnar in-memory store for historical bars.
+
+Every field lives in its own 2-D NumPy array (symbol row x bar column), bar
+times are kept as epoch seconds and each symbol owns one row, so the last N
+candles of a symbol are a plain view and the last N candles of the whole
+universe are one gather.
+"""
+
+import time
+
+import numpy as np
+
+from ibapi.common import BarData
+from ibapi.object_implem import Object
+
+
+def barDateToEpoch(date: str) -> int:
+    """ BarData.date is either epoch seconds (formatDate=2), "yyyymmdd" for
+    daily bars or "yyyymmdd  hh:mm:ss" (formatDate=1, local time). """
+    date = date.strip()
+    if date.isdigit() and len(date) != 8:
+        return int(date)
+    if len(date) == 8:
+        return int(time.mktime(time.strptime(date, "%Y%m%d")))
+    # intraday bars may carry a trailing time zone name, drop it
+    parts = date.split()
+    return int(time.mktime(time.strptime(" ".join(parts[:2]), "%Y%m%d %H:%M:%S")))
+
+
+class BarStore(Object):
+    FLOAT_FIELDS = ("open", "high", "low", "close", "volume", "average")
+
+    def __init__(self, capacity: int = 64, nSymbols: int = 8):
+        self.symbol2row = {}
+        self.reqId2row = {}
+        self.symbols = []
+        self.counts = np.zeros(nSymbols, dtype=np.int64)
+        self.time = np.zeros((nSymbols, capacity), dtype=np.int64)
+        self.barCount = np.zeros((nSymbols, capacity), dtype=np.int32)
+        for field in self.FLOAT_FIELDS:
+            setattr(self, field, np.zeros((nSymbols, capacity), dtype=np.float64))
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def _columns(self):
+        return ["time", "barCount"] + list(self.FLOAT_FIELDS)
+
+    def _grow(self, nRows: int, nCols: int):
+        oldRows, oldCols = self.time.shape
+        for name in self._columns():
+            old = getattr(self, name)
+            new = np.zeros((nRows, nCols), dtype=old.dtype)
+            new[:oldRows, :oldCols] = old
+            setattr(self, name, new)
+        counts = np.zeros(nRows, dtype=np.int64)
+        counts[:oldRows] = self.counts
+        self.counts = counts
+
+    def addSymbol(self, symbol: str, reqId: int = None) -> int:
+        row = self.symbol2row.get(symbol)
+        if row is None:
+            row = len(self.symbols)
+            if row == self.time.shape[0]:
+                self._grow(2 * row, self.time.shape[1])
+            self.symbol2row[symbol] = row
+            self.symbols.append(symbol)
+        if reqId is not None:
+            self.reqId2row[reqId] = row
+        return row
+
+    def append(self, row: int, time_: int, open_: float, high: float,
+               low: float, close: float, volume: float = 0.,
+               barCount: int = 0, average: float = 0.):
+        n = self.counts[row]
+        # keepUpToDate requests resend the bar in progress: overwrite it
+        if n > 0 and self.time[row, n - 1] == time_:
+            n -= 1
+        elif n == self.time.shape[1]:
+            self._grow(self.time.shape[0], 2 * n)
+        self.time[row, n] = time_
+        self.open[row, n] = open_
+        self.high[row, n] = high
+        self.low[row, n] = low
+        self.close[row, n] = close
+        self.volume[row, n] = volume
+        self.barCount[row, n] = barCount
+        self.average[row, n] = average
+        self.counts[row] = n + 1
+
+    def appendBar(self, reqId: int, bar: BarData):
+        row = self.reqId2row.get(reqId)
+        if row is None:
+            row = self.addSymbol(str(reqId), reqId)
+        self.append(row, barDateToEpoch(bar.date), bar.open, bar.high,
+                    bar.low, bar.close, bar.volume, bar.barCount, bar.average)
+
+    def appendRecords(self, records: np.ndarray):
+        """ a batch of RingBuffer.BAR_RECORD, oldest first """
+        for (reqId, time_, open_, high, low, close, volume, average,
+             barCount) in records.tolist():
+            row = self.reqId2row.get(reqId)
+            if row is None:
+                row = self.addSymbol(str(reqId), reqId)
+            self.append(row, time_, open_, high, low, close, volume, barCount,
+                        average)
+
+    def count(self, symbol: str) -> int:
+        return int(self.counts[self.symbol2row[symbol]])
+
+    def lastN(self, symbol: str, n: int) -> dict:
+        """ views (no copy) on the last n bars of one symbol, field -> 1-D """
+        row = self.symbol2row[symbol]
+        end = int(self.counts[row])
+        start = max(0, end - n)
+        return {name: getattr(self, name)[row, start:end]
+                for name in self._columns()}
+
+    def lastNMatrix(self, n: int, symbols: list = None) -> tuple:
+        """ last n bars of many symbols as (symbol x n) matrices, oldest bar
+        first. Rows with less than n bars are left padded and flagged False in
+        the returned mask. """
+        if symbols is None:
+            rows = np.arange(len(self.symbols))
+        else:
+            rows = np.fromiter((self.symbol2row[s] for s in symbols),
+                               dtype=np.int64, count=len(symbols))
+        counts = self.counts[rows]
+        cols = counts[:, None] - n + np.arange(n)
+        valid = cols >= 0
+        cols = np.maximum(cols, 0)
+        rowIdx = rows[:, None]
+        matrices = {name: getattr(self, name)[rowIdx, cols]
+                    for name in self._columns()}
+        return matrices, valid
+
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in self._columns()) \
+               + self.counts.nbytes
@@ -0,0 +1,312 @@
+"""
+Callback throughput benchmark for the TestApp handlers.
+
+Streams of wire messages, synthetic or replayed from a capture, are decoded
+with the stock Decoder and dispatched to a fresh TestApp, exactly as the
+reader loop would do it, under every combination of
+ - the coverage counting wrappers installed or not (TestApp(instrument=...))
+ - the event sink of the handlers writing or a NullSink
+Each combination is run twice: once untimed for messages/sec and once with a
+timer around the benchmarked callbacks for the p50/p99 per-callback latency
+(the timer wraps the counting wrapper, so its cost is part of the figure).
+
+The console sink writes to os.devnull unless --stdout is given, so the
+numbers do not depend on the terminal.
+
+    python Benchmark.py                            # every stream, every mode
+    python Benchmark.py -c tickPrice orderStatus -n 200000
+    python Benchmark.py --save streams.bin         # write the synthetic streams
+    python Benchmark.py --replay capture.bin       # length prefixed frames
+"""
+
+import argparse
+import array
+import gc
+import os
+import random
+import struct
+import sys
+import time
+
+import numpy as np
+
+from ibapi import comm
+from ibapi import decoder
+from ibapi.message import IN
+from ibapi.object_implem import Object
+from ibapi.server_versions import MAX_CLIENT_VER
+
+from EventSink import ConsoleWriter, EventSink, NullSink
+from MockGateway import makeMsg
+from Program import TestApp
+
+BENCH_CALLBACKS = ("tickPrice", "tickByTickBidAsk", "updateMktDepthL2",
+                   "historicalData", "orderStatus")
+
+# (instrument, sink)
+MODES = {
+    "counted+sink": (True, True),
+    "counted": (True, False),
+    "sink": (False, True),
+    "raw": (False, False),
+}
+
+
+def _walk(rng: random.Random, price: float) -> float:
+    return round(max(0.01, price + rng.choice((-0.01, 0., 0.01))), 2)
+
+
+def tickPriceStream(n: int, rng: random.Random, reqId: int = 1) -> list:
+    frames = []
+    price = 100.
+    for i in range(n):
+        price = _walk(rng, price)
+        tickType = 1 if i % 2 == 0 else 2  # BID / ASK
+        frames.append(makeMsg(IN.TICK_PRICE, 6, reqId, tickType,
+                              price if tickType == 1 else price + 0.01,
+                              rng.randint(1, 50) * 100, 0))
+    return frames
+
+
+def tickByTickBidAskStream(n: int, rng: random.Random, reqId: int = 2) -> list:
+    frames = []
+    price = 100.
+    now = int(time.time())
+    for i in range(n):
+        price = _walk(rng, price)
+        frames.append(makeMsg(IN.TICK_BY_TICK, reqId, 3, now + i, price,
+                              price + 0.01, rng.randint(1, 50) * 100,
+                              rng.randint(1, 50) * 100, 0))
+    return frames
+
+
+def updateMktDepthL2Stream(n: int, rng: random.Random, reqId: int = 3,
+                           rows: int = 10) -> list:
+    frames = []
+    mid = 100.
+    for i in range(n):
+        side = i % 2
+        position = (i // 2) % rows
+        operation = 0 if i < 2 * rows else 1
+        offset = 0.01 * (position + 1)
+        price = round(mid - offset if side == 1 else mid + offset, 2)
+        frames.append(makeMsg(IN.MARKET_DEPTH_L2, 1, reqId, position,
+                              "MM%d" % (position % 4), operation, side, price,
+                              rng.randint(1, 50) * 100, True))
+    return frames
+
+
+def historicalDataStream(n: int, rng: random.Random, reqId: int = 4,
+                         barsPerMsg: int = 100) -> list:
+    """ n bars, barsPerMsg per HISTORICAL_DATA message """
+    frames = []
+    price = 100.
+    step = 300
+    start = int(time.time()) // step * step - n * step
+    for first in range(0, n, barsPerMsg):
+        nBars = min(barsPerMsg, n - first)
+        msg = [IN.HISTORICAL_DATA, reqId, str(start + first * step),
+               str(start + (first + nBars) * step), nBars]
+        for i in range(first, first + nBars):
+            open_ = price
+            close = _walk(rng, _walk(rng, open_))
+            msg += [str(start + i * step), open_, max(open_, close) + 0.01,
+                    min(open_, close) - 0.01, close, rng.randint(1, 100) * 100,
+                    round((open_ + close) / 2, 3), rng.randint(1, 50)]
+            price = close
+        frames.append(makeMsg(*msg))
+    return frames
+
+
+def orderStatusStream(n: int, rng: random.Random) -> list:
+    frames = []
+    quantity = 100.
+    for i in range(n):
+        orderId = 1 + i // 4
+        step = i % 4
+        status = ("PreSubmitted", "Submitted", "Submitted", "Filled")[step]
+        filled = quantity / 2 * max(0, step - 1)
+        price = round(100. + rng.random(), 2)
+        frames.append(makeMsg(IN.ORDER_STATUS, orderId, status, filled,
+                              quantity - filled, price if filled else 0.,
+                              1000000 + orderId, 0, price if filled else 0.,
+                              0, "", 0.))
+    return frames
+
+
+STREAMS = {
+    "tickPrice": tickPriceStream,
+    "tickByTickBidAsk": tickByTickBidAskStream,
+    "updateMktDepthL2": updateMktDepthL2Stream,
+    "historicalData": historicalDataStream,
+    "orderStatus": orderStatusStream,
+}
+
+
+def splitFrames(buf: bytes) -> list:
+    """ length prefixed frames as found on the wire after the handshake """
+    frames = []
+    pos = 0
+    while pos + 4 <= len(buf):
+        size = struct.unpack_from("!I", buf, pos)[0]
+        frames.append(buf[pos:pos + 4 + size])
+        pos += 4 + size
+    return frames
+
+
+def readFrames(path: str) -> list:
+    with open(path, "rb") as f:
+        return splitFrames(f.read())
+
+
+def writeFrames(path: str, frames: list):
+    with open(path, "wb") as f:
+        for frame in frames:
+            f.write(frame)
+
+
+def timeCalls(fn, samples):
+    perfCounter = time.perf_counter_ns
+
+    def timeCalls_(*args, **kwargs):
+        t0 = perfCounter()
+        ret = fn(*args, **kwargs)
+        samples.append(perfCounter() - t0)
+        return ret
+
+    return timeCalls_
+
+
+class BenchResult(Object):
+    def __init__(self, stream: str, mode: str, nMsgs: int, elapsed: float,
+                 latencies: dict):
+        self.stream = stream
+        self.mode = mode
+        self.nMsgs = nMsgs
+        self.elapsed = elapsed
+        # callback name -> array of ns
+        self.latencies = latencies
+
+    def msgsPerSec(self) -> float:
+        return self.nMsgs / self.elapsed if self.elapsed > 0 else float("inf")
+
+    def nCallbacks(self) -> int:
+        return sum(len(samples) for samples in self.latencies.values())
+
+    def percentiles(self, callback: str) -> tuple:
+        """ (p50, p99) in microseconds """
+        samples = np.frombuffer(self.latencies[callback], dtype=np.int64)
+        (p50, p99) = np.percentile(samples, (50, 99))
+        return (p50 / 1e3, p99 / 1e3)
+
+    def rows(self) -> list:
+        rows = []
+        for (callback, samples) in sorted(self.latencies.items()):
+            if not samples:
+                continue
+            (p50, p99) = self.percentiles(callback)
+            callsPerSec = len(samples) / self.elapsed if self.elapsed > 0 else float("inf")
+            rows.append((self.stream, self.mode, callback, len(samples),
+                         self.msgsPerSec(), callsPerSec, p50, p99))
+        return rows
+
+
+def makeApp(instrument: bool, sinkEnabled: bool, toStdout: bool = False):
+    if not sinkEnabled:
+        sink = NullSink()
+    elif toStdout:
+        sink = EventSink(ConsoleWriter())
+    else:
+        sink = EventSink(ConsoleWriter(open(os.devnull, "w")))
+    app = TestApp(instrument=instrument, sink=sink)
+    dec = decoder.Decoder(app, MAX_CLIENT_VER)
+    return (app, dec)
+
+
+def dispatch(dec, payloads: list):
+    interpret = dec.interpret
+    readFields = comm.read_fields
+    for payload in payloads:
+        interpret(readFields(payload))
+
+
+def runBenchmark(stream: str, frames: list, mode: str, warmup: int = 1000,
+                 toStdout: bool = False) -> BenchResult:
+    (instrument, sinkEnabled) = MODES[mode]
+    payloads = [frame[4:] for frame in frames]
+    warmup = min(warmup, len(payloads) // 10)
+
+    # throughput, nothing but the handlers in the way; the sink writer keeps
+    # running concurrently, as it would in a live session
+    (app, dec) = makeApp(instrument, sinkEnabled, toStdout)
+    dispatch(dec, payloads[:warmup])
+    gc.collect()
+    t0 = time.perf_counter()
+    dispatch(dec, payloads)
+    elapsed = time.perf_counter() - t0
+    app.sink.close()
+
+    # latency, a timer outside of everything the app installed
+    (app, dec) = makeApp(instrument, sinkEnabled, toStdout)
+    latencies = {callback: array.array("q") for callback in BENCH_CALLBACKS}
+    for (callback, samples) in latencies.items():
+        setattr(app, callback, timeCalls(getattr(app, callback), samples))
+    dispatch(dec, payloads[:warmup])
+    for samples in latencies.values():
+        del samples[:]
+    gc.collect()
+    dispatch(dec, payloads)
+    app.sink.close()
+
+    return BenchResult(stream, mode, len(payloads), elapsed, latencies)
+
+
+def printResults(results: list):
+    header = "%-18s %-14s %-18s %9s %11s %11s %9s %9s" % (
+        "stream", "mode", "callback", "calls", "msgs/s", "calls/s", "p50 us", "p99 us")
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        for row in result.rows():
+            print("%-18s %-14s %-18s %9d %11.0f %11.0f %9.2f %9.2f" % row)
+
+
+def main():
+    cmdLineParser = argparse.ArgumentParser("TestApp callback benchmark")
+    cmdLineParser.add_argument("-c", "--callbacks", nargs="+", choices=list(STREAMS),
+                               default=list(STREAMS),
+                               help="synthetic streams to run")
+    cmdLineParser.add_argument("-n", "--count", type=int, default=50000,
+                               help="messages per synthetic stream (bars for historicalData)")
+    cmdLineParser.add_argument("-m", "--modes", nargs="+", choices=list(MODES),
+                               default=list(MODES), help="modes to run")
+    cmdLineParser.add_argument("--seed", type=int, default=0)
+    cmdLineParser.add_argument("--replay", help="capture file of length prefixed "
+                                                "frames to run instead of the synthetic streams")
+    cmdLineParser.add_argument("--save", help="write the synthetic streams to this "
+                                              "file and exit")
+    cmdLineParser.add_argument("--stdout", action="store_true", default=False,
+                               help="let the console sink write to the real stdout")
+    args = cmdLineParser.parse_args()
+
+    if args.replay:
+        streams = {os.path.basename(args.replay): readFrames(args.replay)}
+    else:
+        rng = random.Random(args.seed)
+        streams = {name: STREAMS[name](args.count, rng) for name in args.callbacks}
+
+    if args.save:
+        writeFrames(args.save, [frame for frames in streams.values() for frame in frames])
+        print("saved", sum(map(len, streams.values())), "frames to", args.save)
+        return
+
+    results = []
+    for (stream, frames) in streams.items():
+        for mode in args.modes:
+            results.append(runBenchmark(stream, frames, mode, toStdout=args.stdout))
+            print("done", stream, mode, file=sys.stderr)
+    printResults(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Batched candle pattern analysis over a (symbol x candle) matrix.
+
+All conditions are evaluated for every symbol at once with NumPy, so a rescan
+costs a handful of array operations whatever the size of the universe.
+"""
+
+import numpy as np
+
+from ibapi.object_implem import Object
+
+from BarStore import BarStore
+
+
+class CandleAnalysis(Object):
+    def __init__(self, symbols: list, valid, higherCloses, rangeExpansion,
+                 strongBody, smallUpperWick):
+        self.symbols = symbols
+        self.valid = valid
+        self.higherCloses = higherCloses
+        self.rangeExpansion = rangeExpansion
+        self.strongBody = strongBody
+        self.smallUpperWick = smallUpperWick
+        self.matches = valid & higherCloses & rangeExpansion & strongBody \
+                       & smallUpperWick
+
+    def matchingSymbols(self) -> list:
+        return [self.symbols[i] for i in np.flatnonzero(self.matches)]
+
+    def __str__(self):
+        return "CandleAnalysis. Symbols: %d, Valid: %d, Matches: %s" % (
+            len(self.symbols), int(self.valid.sum()), self.matchingSymbols())
+
+
+class CandleAnalyzer(Object):
+    def __init__(self, nCandles: int, rangeExpansionFactor: float = 1.2,
+                 minBodyRatio: float = 0.6, maxUpperWickRatio: float = 0.25):
+        self.nCandles = nCandles
+        self.rangeExpansionFactor = rangeExpansionFactor
+        self.minBodyRatio = minBodyRatio
+        self.maxUpperWickRatio = maxUpperWickRatio
+
+    def analyze(self, open_, high, low, close, valid=None,
+                symbols: list = None) -> CandleAnalysis:
+        """ every argument is a (symbol x candle) matrix, oldest candle first;
+        valid flags the cells actually holding a bar """
+        nSymbols = close.shape[0]
+        if valid is None:
+            rowValid = np.ones(nSymbols, dtype=bool)
+        else:
+            rowValid = valid.all(axis=1)
+        if symbols is None:
+            symbols = list(range(nSymbols))
+
+        # consecutive higher closes across the whole window
+        higherCloses = (np.diff(close, axis=1) > 0).all(axis=1)
+
+        # last candle range against the mean range of the candles before it
+        ranges = high - low
+        priorMean = ranges[:, :-1].mean(axis=1) if ranges.shape[1] > 1 \
+            else ranges[:, 0]
+        rangeExpansion = ranges[:, -1] >= self.rangeExpansionFactor * priorMean
+
+        # body and upper wick of the last candle relative to its range
+        lastRange = ranges[:, -1]
+        safeRange = np.where(lastRange > 0, lastRange, 1.)
+        body = np.abs(close[:, -1] - open_[:, -1])
+        upperWick = high[:, -1] - np.maximum(open_[:, -1], close[:, -1])
+        strongBody = (lastRange > 0) & (body / safeRange >= self.minBodyRatio)
+        smallUpperWick = upperWick / safeRange <= self.maxUpperWickRatio
+
+        return CandleAnalysis(symbols, rowValid, higherCloses, rangeExpansion,
+                              strongBody, smallUpperWick)
+
+    def analyzeStore(self, store: BarStore, symbols: list = None) -> CandleAnalysis:
+        if symbols is None:
+            symbols = list(store.symbols)
+        matrices, valid = store.lastNMatrix(self.nCandles, symbols)
+        return self.analyze(matrices["open"], matrices["high"], matrices["low"],
+                            matrices["close"], valid, symbols)
@@ -0,0 +1,258 @@
+"""
+Pool of API connections with distinct clientIds behind one EClient-like
+object, all the callbacks merged into one wrapper.
+
+Every connection has its own socket, reader thread and message rate budget.
+Requests about a contract (market data, tick-by-tick, depth, bars, history,
+contract details, ...) go to the connection picked by a consistent hash of
+the contract (conId, or symbol/secType/currency), so an instrument always
+lives on the same connection and adding a connection moves only ~1/N of the
+instruments. The reqId is remembered, its cancel goes where the request
+went. Orders, account and everything else go to the primary connection (the
+first clientId), whose order ids are the ones handed out by nextValidId.
+Settings like reqMarketDataType are sent on every connection.
+
+Each connection reports through a ForwardingWrapper which calls the shared
+wrapper under one lock, so the wrapper sees one serialized stream exactly as
+with a single connection; nextValidId, managedAccounts and connectAck are
+only forwarded from the primary connection. The lock is reentrant: a
+callback may send requests, and a request to a connection that is down
+reports its error from within, on the same thread. The reqId of a request
+is forgotten once its last answer (or its error) went through.
+
+    pool = ConnectionPool(app, nConnections=4, firstClientId=10)
+    pool.connect("127.0.0.1", 7497)
+    pool.reqMktData(1001, contract, "", False, False, [])
+"""
+
+import bisect
+import inspect
+import logging
+import threading
+import zlib
+
+from ibapi.client import EClient
+from ibapi.contract import Contract
+from ibapi.object_implem import Object
+from ibapi.wrapper import EWrapper
+
+from ErrorCodes import isWarning
+
+logger = logging.getLogger(__name__)
+
+# request -> position of the contract argument, the reqId being the first one
+ROUTED_REQUESTS = {
+    "reqMktData": 1,
+    "reqTickByTickData": 1,
+    "reqMktDepth": 1,
+    "reqRealTimeBars": 1,
+    "reqHistoricalData": 1,
+    "reqHeadTimeStamp": 1,
+    "reqHistogramData": 1,
+    "reqHistoricalTicks": 1,
+    "reqContractDetails": 1,
+    "reqFundamentalData": 1,
+    "calculateImpliedVolatility": 1,
+    "calculateOptionPrice": 1,
+    # the underlying symbol
+    "reqSecDefOptParams": 1,
+    # no contract, spread by reqId
+    "reqScannerSubscription": None,
+}
+
+CANCELS = ("cancelMktData", "cancelTickByTickData", "cancelMktDepth",
+           "cancelRealTimeBars", "cancelHistoricalData", "cancelHeadTimeStamp",
+           "cancelHistogramData", "cancelFundamentalData",
+           "cancelCalculateImpliedVolatility", "cancelCalculateOptionPrice",
+           "cancelScannerSubscription")
+
+# per connection settings
+BROADCASTS = ("reqMarketDataType", "setServerLogLevel")
+
+PRIMARY_ONLY_CALLBACKS = ("nextValidId", "managedAccounts", "connectAck")
+
+# last answer of a request -> position of its "done" flag, None if it has none
+END_CALLBACKS = {
+    "historicalDataEnd": None,
+    "contractDetailsEnd": None,
+    "securityDefinitionOptionParameterEnd": None,
+    "tickSnapshotEnd": None,
+    "headTimestamp": None,
+    "histogramData": None,
+    "fundamentalData": None,
+    "historicalTicks": 2,
+    "historicalTicksBidAsk": 2,
+    "historicalTicksLast": 2,
+}
+
+def routingKey(contract) -> bytes:
+    if isinstance(contract, Contract):
+        if contract.conId:
+            return b"%d" % contract.conId
+        return ("%s|%s|%s" % (contract.symbol, contract.secType,
+                              contract.currency)).encode()
+    return str(contract).encode()
+
+
+def _forwarder(name: str):
+    def forward(self, *args):
+        with self.lock:
+            return getattr(self.target, name)(*args)
+    forward.__name__ = name
+    return forward
+
+
+def _endingForwarder(name: str, doneArg: int):
+    def forward(self, reqId, *args):
+        with self.lock:
+            try:
+                return getattr(self.target, name)(reqId, *args)
+            finally:
+                if doneArg is None or args[doneArg - 1]:
+                    self.ended(reqId)
+    forward.__name__ = name
+    return forward
+
+
+def _forwardError(self, reqId, errorCode, errorString):
+    with self.lock:
+        try:
+            return self.target.error(reqId, errorCode, errorString)
+        finally:
+            if reqId > 0 and not isWarning(errorCode):
+                self.ended(reqId, True)
+
+
+def _dropped(*args):
+    pass
+
+
+class ForwardingWrapper(EWrapper):
+    """ wrapper of one pool connection, hands every callback over to the
+    shared wrapper, one at a time """
+
+    def __init__(self, target: EWrapper, lock: threading.RLock, primary: bool,
+                 ended=_dropped):
+        EWrapper.__init__(self)
+        self.target = target
+        self.lock = lock
+        # ended(reqId, failed) once a request got its last answer
+        self.ended = ended
+        if not primary:
+            for name in PRIMARY_ONLY_CALLBACKS:
+                setattr(self, name, _dropped)
+
+
+for _name, _ in inspect.getmembers(EWrapper, inspect.isfunction):
+    if not _name.startswith("_") and _name != "logAnswer":
+        setattr(ForwardingWrapper, _name, _forwarder(_name))
+for (_name, _doneArg) in END_CALLBACKS.items():
+    setattr(ForwardingWrapper, _name, _endingForwarder(_name, _doneArg))
+ForwardingWrapper.error = _forwardError
+
+
+class HashRing(Object):
+    """ consistent hash of routing keys onto nodes, vnodes points per node """
+
+    def __init__(self, nodes: list, vnodes: int = 64):
+        points = sorted((zlib.crc32(b"%d#%d" % (node, i)), node)
+                        for node in nodes for i in range(vnodes))
+        self.hashes = [h for (h, _) in points]
+        self.nodes = [node for (_, node) in points]
+
+    def node(self, key: bytes) -> int:
+        i = bisect.bisect(self.hashes, zlib.crc32(key))
+        return self.nodes[i % len(self.nodes)]
+
+
+class ConnectionPool(Object):
+    def __init__(self, wrapper: EWrapper, nConnections: int = 4,
+                 firstClientId: int = 0, vnodes: int = 64):
+        self.wrapper = wrapper
+        # serializes the callbacks of all the connections; reentrant, the
+        # callbacks send requests which may report errors right away
+        self.lock = threading.RLock()
+        self.clientIds = list(range(firstClientId, firstClientId + nConnections))
+        self.clients = {}
+        for clientId in self.clientIds:
+            forwarding = ForwardingWrapper(wrapper, self.lock,
+                                           clientId == firstClientId, self._ended)
+            self.clients[clientId] = EClient(forwarding)
+        self.primary = self.clients[firstClientId]
+        self.ring = HashRing(self.clientIds, vnodes)
+        self.reqId2client = {}
+        # keepUpToDate history: historicalDataEnd is not its last answer
+        self.streamingReqIds = set()
+        self.threads = []
+
+    def connect(self, host: str, port: int):
+        for (clientId, client) in self.clients.items():
+            client.connect(host, port, clientId)
+            thread = threading.Thread(target=client.run, name="Reader-%d" % clientId,
+                                      daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def isConnected(self) -> bool:
+        return all(client.isConnected() for client in self.clients.values())
+
+    def disconnect(self):
+        for client in self.clients.values():
+            client.disconnect()
+
+    def client(self, key: bytes) -> EClient:
+        return self.clients[self.ring.node(key)]
+
+    def shardOf(self, reqId: int) -> int:
+        """ clientId a reqId was sent on, None if unknown """
+        client = self.reqId2client.get(reqId)
+        return None if client is None else client.clientId
+
+    def _routed(self, name: str, contractArg: int):
+        def routed(reqId, *args):
+            key = routingKey(args[contractArg - 1]) if contractArg is not None \
+                else b"%d" % reqId
+            client = self.client(key)
+            self.reqId2client[reqId] = client
+            if name == "reqHistoricalData" and args[7]:
+                self.streamingReqIds.add(reqId)
+            return getattr(client, name)(reqId, *args)
+        return routed
+
+    def _cancel(self, name: str):
+        def cancel(reqId, *args):
+            client = self.reqId2client.pop(reqId, self.primary)
+            self.streamingReqIds.discard(reqId)
+            return getattr(client, name)(reqId, *args)
+        return cancel
+
+    def _ended(self, reqId: int, failed: bool = False):
+        if failed:
+            self.streamingReqIds.discard(reqId)
+        elif reqId in self.streamingReqIds:
+            return
+        self.reqId2client.pop(reqId, None)
+
+    def _broadcast(self, name: str):
+        def broadcast(*args):
+            for client in self.clients.values():
+                getattr(client, name)(*args)
+        return broadcast
+
+    def __getattr__(self, name: str):
+        # only called for what the pool does not define: build the routing
+        # method once and keep it on the instance
+        if name.startswith("_") or "clients" not in self.__dict__:
+            raise AttributeError(name)
+        if name in ROUTED_REQUESTS:
+            method = self._routed(name, ROUTED_REQUESTS[name])
+        elif name in CANCELS:
+            method = self._cancel(name)
+        elif name in BROADCASTS:
+            method = self._broadcast(name)
+        else:
+            method = getattr(self.primary, name)
+            if not callable(method):
+                return method
+        setattr(self, name, method)
+        return method
@@ -0,0 +1,264 @@
+"""
+Contract details cache: an LRU in memory in front of a persistent store.
+
+Contracts are resolved with reqContractDetails through the RequestMgr, all
+the misses of a batch are sent before waiting on any of them, so resolving a
+symbol list costs one round trip, not one per symbol. Requests for the same
+contract already in flight share their answer. The answers are kept as they
+come (every candidate), the choice among several is made on each lookup:
+    no candidate         UnknownContractError
+    several candidates   narrowed down by primaryExchange when the query has
+                         one, AmbiguousContractError if still more than one
+Downstream requests then use conIdContract(details), keyed by conId.
+
+    cache = ContractCache(app, app.reqMgr, "cache/contracts.pickle")
+    details = cache.resolve([ContractSamples.USStockAtSmart()], timeout=10)
+    contract = conIdContract(details[0], "SMART")
+"""
+
+import collections
+import concurrent.futures
+import itertools
+import logging
+import os
+import pickle
+import threading
+import time
+
+from ibapi.client import EClient
+from ibapi.contract import Contract, ContractDetails
+from ibapi.object_implem import Object
+
+from RequestMgr import RequestError, RequestMgr
+
+logger = logging.getLogger(__name__)
+
+# "No security definition has been found for the request"
+NO_SECURITY_DEFINITION = 200
+
+
+class ContractResolutionError(Exception):
+    def __init__(self, message: str, failures: dict = None):
+        Exception.__init__(self, message)
+        # contract description -> exception, for a batch
+        self.failures = failures or {}
+
+
+class UnknownContractError(ContractResolutionError):
+    def __init__(self, contract: Contract):
+        ContractResolutionError.__init__(
+            self, "no security definition for %s" % describe(contract))
+        self.contract = contract
+
+
+class AmbiguousContractError(ContractResolutionError):
+    def __init__(self, contract: Contract, candidates: list):
+        ContractResolutionError.__init__(
+            self, "%s is ambiguous: %s" % (describe(contract), ", ".join(
+                "%s@%s conId %d" % (d.contract.localSymbol, d.contract.primaryExchange,
+                                    d.contract.conId) for d in candidates)))
+        self.contract = contract
+        self.candidates = candidates
+
+
+def describe(contract: Contract) -> str:
+    c = contract
+    if c.conId:
+        return "conId %d" % c.conId
+    return " ".join(str(part) for part in (c.symbol, c.secType, c.exchange, c.currency,
+                                            c.lastTradeDateOrContractMonth, c.strike
+                                            if c.strike else "", c.right) if part)
+
+
+def conIdContract(details: ContractDetails, exchange: str = None) -> Contract:
+    """ the contract to use downstream: conId plus the routing exchange, the
+    other fields only for readability """
+    resolved = details.contract
+    contract = Contract()
+    contract.conId = resolved.conId
+    contract.symbol = resolved.symbol
+    contract.secType = resolved.secType
+    contract.currency = resolved.currency
+    contract.exchange = exchange or resolved.exchange
+    contract.primaryExchange = resolved.primaryExchange
+    contract.localSymbol = resolved.localSymbol
+    return contract
+
+
+class ContractCache(Object):
+    def __init__(self, client: EClient, reqMgr: RequestMgr, path: str = None,
+                 capacity: int = 1024, maxAge: float = 7 * 86400,
+                 firstReqId: int = 20000000):
+        self.client = client
+        self.reqMgr = reqMgr
+        self.path = path
+        self.capacity = capacity
+        # older stored answers are asked again
+        self.maxAge = maxAge
+        self.nextReqId = itertools.count(firstReqId)
+        self.lru = collections.OrderedDict()
+        # key -> (time saved, [ContractDetails]), loaded on first use
+        self.store = None
+        self.storeDirty = False
+        self.inFlight = {}
+        self.nHits = 0
+        self.nMisses = 0
+        # lookups come from the caller's thread, answers from the reader thread
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def key(contract: Contract) -> tuple:
+        c = contract
+        if c.conId:
+            return (c.conId, c.exchange)
+        return (c.symbol, c.secType, c.exchange, c.primaryExchange, c.currency,
+                c.lastTradeDateOrContractMonth, c.strike, c.right, c.multiplier,
+                c.localSymbol, c.tradingClass)
+
+    def _loadStore(self):
+        self.store = {}
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                self.store = pickle.load(f)
+        except Exception:
+            logger.exception("unreadable contract cache %s, starting empty", self.path)
+
+    def save(self):
+        """ write the persistent store if anything changed, atomically """
+        with self.lock:
+            if self.path is None or not self.storeDirty:
+                return
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmpPath = self.path + ".tmp"
+            with open(tmpPath, "wb") as f:
+                pickle.dump(self.store, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpPath, self.path)
+            self.storeDirty = False
+
+    def _cached(self, key: tuple) -> list:
+        """ candidates from the LRU, then from the store; None on a miss """
+        candidates = self.lru.get(key)
+        if candidates is not None:
+            self.lru.move_to_end(key)
+            return candidates
+        if self.store is None:
+            self._loadStore()
+        stored = self.store.get(key)
+        if stored is None or stored[0] + self.maxAge < time.time():
+            return None
+        self._remember(key, stored[1])
+        return stored[1]
+
+    def _remember(self, key: tuple, candidates: list):
+        self.lru[key] = candidates
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
+
+    @staticmethod
+    def pick(contract: Contract, candidates: list) -> ContractDetails:
+        if not candidates:
+            raise UnknownContractError(contract)
+        if len(candidates) > 1 and contract.primaryExchange:
+            candidates = [d for d in candidates
+                          if d.contract.primaryExchange == contract.primaryExchange] \
+                         or candidates
+        if len(candidates) > 1:
+            raise AmbiguousContractError(contract, candidates)
+        return candidates[0]
+
+    def lookup(self, contract: Contract) -> ContractDetails:
+        """ from the cache only, None on a miss """
+        with self.lock:
+            candidates = self._cached(self.key(contract))
+        return None if candidates is None else self.pick(contract, candidates)
+
+    def submit(self, contract: Contract) -> concurrent.futures.Future:
+        """ future of the ContractDetails of contract, resolved right away on
+        a hit; never blocks, may be called from the reader thread """
+        key = self.key(contract)
+        with self.lock:
+            candidates = self._cached(key)
+            if candidates is None:
+                self.nMisses += 1
+                answer = self.inFlight.get(key)
+                if answer is None:
+                    answer = self._request(key, contract)
+            else:
+                self.nHits += 1
+        if candidates is not None:
+            answer = concurrent.futures.Future()
+            answer.set_result(candidates)
+        return self._picked(contract, answer)
+
+    def _request(self, key: tuple, contract: Contract) -> concurrent.futures.Future:
+        reqId = next(self.nextReqId)
+        answer = concurrent.futures.Future()
+        self.inFlight[key] = answer
+        act = self.reqMgr.expect(reqId, "reqContractDetails")
+
+        def received(future):
+            with self.lock:
+                self.inFlight.pop(key, None)
+                if future.cancelled():
+                    answer.cancel()
+                    return
+                error = future.exception()
+                if isinstance(error, RequestError) \
+                        and error.errorCode == NO_SECURITY_DEFINITION:
+                    # a definite answer, cached like any other
+                    candidates = []
+                elif error is not None:
+                    answer.set_exception(error)
+                    return
+                else:
+                    candidates = future.result()
+                self._remember(key, candidates)
+                self.store[key] = (time.time(), candidates)
+                self.storeDirty = True
+                if not self.inFlight:
+                    self.save()
+            answer.set_result(candidates)
+
+        act.future.add_done_callback(received)
+        self.client.reqContractDetails(reqId, contract)
+        return answer
+
+    def _picked(self, contract: Contract, answer: concurrent.futures.Future) \
+            -> concurrent.futures.Future:
+        picked = concurrent.futures.Future()
+
+        def pick(future):
+            try:
+                picked.set_result(self.pick(contract, future.result()))
+            except Exception as e:
+                picked.set_exception(e)
+
+        answer.add_done_callback(pick)
+        return picked
+
+    def resolve(self, contracts: list, timeout: float = None) -> list:
+        """ ContractDetails of every contract, in order; every request goes
+        out before waiting. Raises a ContractResolutionError naming all the
+        contracts that failed. Not to be called from the reader thread. """
+        futures = [self.submit(contract) for contract in contracts]
+        concurrent.futures.wait(futures, timeout)
+        results = []
+        failures = {}
+        for (contract, future) in zip(contracts, futures):
+            if not future.done():
+                failures[describe(contract)] = concurrent.futures.TimeoutError()
+                continue
+            error = future.exception()
+            if error is not None:
+                failures[describe(contract)] = error
+            else:
+                results.append(future.result())
+        if failures:
+            raise ContractResolutionError(
+                "unresolved contracts: " + "; ".join(
+                    "%s (%s)" % (name, str(error) or "timed out")
+                    for (name, error) in failures.items()), failures)
+        return results
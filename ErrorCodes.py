@@ -0,0 +1,40 @@
+"""
+Codes of error() after which the request they are about is still alive:
+notifications, warnings, market data partly or only delayed available. Any
+other code on a reqId ends that request. The connection errors, on
+NO_VALID_ID, end every request out.
+
+    def error(self, reqId, errorCode, errorString):
+        if isWarning(errorCode):
+            return
+        if reqId == NO_VALID_ID and isConnectionError(errorCode):
+            failAll(errorCode, errorString)
+        else:
+            fail(reqId, errorCode, errorString)
+"""
+
+from ibapi.errors import BAD_LENGTH, CONNECT_FAIL, NOT_CONNECTED, SOCKET_EXCEPTION
+
+# "Order Message: Warning", the order is still working
+ORDER_WARNING = 399
+
+# part of the requested market data is not subscribed (10090), delayed data
+# is displayed instead (10167), no data during a competing live session
+# (10197): the other ticks keep coming
+MARKET_DATA_WARNINGS = frozenset((10090, 10167, 10197))
+
+
+def isWarning(errorCode: int) -> bool:
+    # 21xx codes are notifications (farm status, deprecated fields, ...)
+    return 2100 <= errorCode < 2200 or errorCode == ORDER_WARNING \
+        or errorCode in MARKET_DATA_WARNINGS
+
+
+# the socket is gone or unusable, or TWS lost its connection to IB (1100):
+# reported on NO_VALID_ID, no answer comes for the requests out
+CONNECTION_ERRORS = frozenset((CONNECT_FAIL.code(), NOT_CONNECTED.code(),
+                               BAD_LENGTH.code(), SOCKET_EXCEPTION.code(), 1100))
+
+
+def isConnectionError(errorCode: int) -> bool:
+    return errorCode in CONNECTION_ERRORS
@@ -0,0 +1,298 @@
+"""
+Structured event sink for the wrapper callbacks.
+
+A callback only appends a fixed schema record (time in ns, event name, field
+names, values) to a queue. The field names are a constant tuple per call
+site, so emitting costs a tuple and a deque append. A background thread
+drains the queue every flushInterval (or as soon as batchSize records are
+waiting), formats the whole batch and hands it to the output in one write,
+so neither formatting nor terminal speed is paid on the reader thread.
+Values are formatted later on, objects handed over must not be mutated
+after emit() (the decoder builds new ones for every message).
+
+Outputs:
+    ConsoleWriter    "Event. Field: value ..." lines, like the old print()s
+    JsonLinesWriter  one JSON object per record
+    BinaryWriter     tagged binary records, read back with readBinary()
+
+    sink = EventSink(JsonLinesWriter(open("events.jsonl", "wb")))
+    sink.emit("TickSize", ("TickerId", "TickType", "Size"), reqId, tickType, size)
+    sink.close()
+"""
+
+import atexit
+import collections
+import datetime
+import json
+import logging
+import struct
+import sys
+import threading
+import time
+
+from ibapi.object_implem import Object
+
+logger = logging.getLogger(__name__)
+
+
+class ConsoleWriter(Object):
+    def __init__(self, stream=None, timeFields=("Time",)):
+        # None means whatever sys.stdout is at write time
+        self.stream = stream
+        # epoch seconds in these fields are shown as local date/time
+        self.timeFields = frozenset(timeFields)
+        self.lastSecond = None
+        self.lastSecondStr = None
+
+    def formatTime(self, epoch: int) -> str:
+        # ticks come many per second, format each second only once
+        if epoch != self.lastSecond:
+            self.lastSecond = epoch
+            self.lastSecondStr = datetime.datetime.fromtimestamp(epoch).strftime(
+                "%Y%m%d %H:%M:%S")
+        return self.lastSecondStr
+
+    def formatRecord(self, record) -> str:
+        (_, event, names, values) = record
+        parts = [event + "."]
+        for (name, value) in zip(names, values):
+            if name in self.timeFields and type(value) is int:
+                value = self.formatTime(value)
+            parts.append("%s: %s" % (name, value))
+        return " ".join(parts)
+
+    def write(self, records: list):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write("\n".join(map(self.formatRecord, records)) + "\n")
+        stream.flush()
+
+    def close(self):
+        if self.stream is not None and self.stream not in (sys.stdout, sys.stderr):
+            self.stream.close()
+
+
+class JsonLinesWriter(Object):
+    """ {"ts": ns, "event": name, field: value, ...} per line; values JSON
+    does not know (contracts, bars, ...) are written as their str() """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.encoder = json.JSONEncoder(default=str)
+
+    def formatRecord(self, record) -> str:
+        (ts, event, names, values) = record
+        obj = {"ts": ts, "event": event}
+        obj.update(zip(names, values))
+        return self.encoder.encode(obj)
+
+    def write(self, records: list):
+        self.stream.write(("\n".join(map(self.formatRecord, records)) + "\n").encode())
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+
+# binary layout, little endian:
+#   schema: b"S" u16 schemaId u16 len event u8 nFields (u16 len name)*
+#   event:  b"E" i64 ts u16 schemaId then per value a tag and its payload:
+#           b"q" i64 | b"d" f64 | b"?" u8 | b"n" | b"s" u32 len utf8
+# a schema record always comes before the first event using it
+_SCHEMA_HEAD = struct.Struct("<cHH")
+_EVENT_HEAD = struct.Struct("<cqH")
+_INT = struct.Struct("<cq")
+_FLOAT = struct.Struct("<cd")
+_BOOL = struct.Struct("<c?")
+_STR = struct.Struct("<cI")
+_U16 = struct.Struct("<H")
+
+
+def _packStr(s: str) -> bytes:
+    b = s.encode()
+    return _U16.pack(len(b)) + b
+
+
+class BinaryWriter(Object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.schemas = {}
+
+    def schemaId(self, event: str, names: tuple, out: list) -> int:
+        key = (event, names)
+        schemaId = self.schemas.get(key)
+        if schemaId is None:
+            schemaId = len(self.schemas)
+            self.schemas[key] = schemaId
+            b = event.encode()
+            out.append(_SCHEMA_HEAD.pack(b"S", schemaId, len(b)) + b
+                       + bytes((len(names),)) + b"".join(map(_packStr, names)))
+        return schemaId
+
+    def write(self, records: list):
+        out = []
+        for (ts, event, names, values) in records:
+            out.append(_EVENT_HEAD.pack(b"E", ts, self.schemaId(event, names, out)))
+            for value in values:
+                t = type(value)
+                if t is bool:
+                    out.append(_BOOL.pack(b"?", value))
+                elif t is int and -(1 << 63) <= value < (1 << 63):
+                    out.append(_INT.pack(b"q", value))
+                elif t is float:
+                    out.append(_FLOAT.pack(b"d", value))
+                elif value is None:
+                    out.append(b"n")
+                else:
+                    b = str(value).encode()
+                    out.append(_STR.pack(b"s", len(b)) + b)
+        self.stream.write(b"".join(out))
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+
+def readBinary(path: str):
+    """ yields (ts, event, {field: value}) from a BinaryWriter file """
+    with open(path, "rb") as f:
+        buf = f.read()
+    schemas = {}
+    pos = 0
+    while pos < len(buf):
+        kind = buf[pos:pos + 1]
+        if kind == b"S":
+            (_, schemaId, n) = _SCHEMA_HEAD.unpack_from(buf, pos)
+            pos += _SCHEMA_HEAD.size
+            event = buf[pos:pos + n].decode()
+            pos += n
+            nFields = buf[pos]
+            pos += 1
+            names = []
+            for _ in range(nFields):
+                n = _U16.unpack_from(buf, pos)[0]
+                names.append(buf[pos + 2:pos + 2 + n].decode())
+                pos += 2 + n
+            schemas[schemaId] = (event, names)
+        elif kind == b"E":
+            (_, ts, schemaId) = _EVENT_HEAD.unpack_from(buf, pos)
+            pos += _EVENT_HEAD.size
+            (event, names) = schemas[schemaId]
+            fields = {}
+            for name in names:
+                tag = buf[pos:pos + 1]
+                if tag == b"q":
+                    value = _INT.unpack_from(buf, pos)[1]
+                    pos += _INT.size
+                elif tag == b"d":
+                    value = _FLOAT.unpack_from(buf, pos)[1]
+                    pos += _FLOAT.size
+                elif tag == b"?":
+                    value = _BOOL.unpack_from(buf, pos)[1]
+                    pos += _BOOL.size
+                elif tag == b"n":
+                    value = None
+                    pos += 1
+                else:
+                    n = _STR.unpack_from(buf, pos)[1]
+                    pos += _STR.size
+                    value = buf[pos:pos + n].decode()
+                    pos += n
+                fields[name] = value
+            yield (ts, event, fields)
+        else:
+            raise ValueError("corrupted event file at offset %d" % pos)
+
+
+class EventSink(Object):
+    def __init__(self, writer=None, flushInterval: float = 0.1,
+                 batchSize: int = 4096, maxPending: int = 1 << 20):
+        self.writer = writer if writer is not None else ConsoleWriter()
+        self.flushInterval = flushInterval
+        self.batchSize = batchSize
+        # beyond this the records are dropped and counted, not queued
+        self.maxPending = maxPending
+        self.records = collections.deque()
+        self.dropped = 0
+        self.wakeup = threading.Event()
+        # flush() may run on another thread than the writer
+        self.writeLock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="EventSink",
+                                       daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def emit(self, event: str, names: tuple, *values):
+        records = self.records
+        if len(records) >= self.maxPending:
+            self.dropped += 1
+            return
+        records.append((time.time_ns(), event, names, values))
+        if len(records) == self.batchSize:
+            self.wakeup.set()
+
+    def _drain(self):
+        with self.writeLock:
+            self._drainLocked()
+
+    def _drainLocked(self):
+        records = self.records
+        while records:
+            batch = [records.popleft() for _ in range(min(len(records), self.batchSize))]
+            if self.dropped:
+                (dropped, self.dropped) = (self.dropped, 0)
+                batch.append((time.time_ns(), "EventSinkOverflow", ("Dropped",),
+                              (dropped,)))
+            try:
+                self.writer.write(batch)
+            except Exception:
+                logger.exception("event sink write failed, %d records lost", len(batch))
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flushInterval)
+            self.wakeup.clear()
+            self._drain()
+
+    def flush(self):
+        """ write what is queued now, from the calling thread """
+        self._drain()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self.wakeup.set()
+        self.thread.join()
+        self._drain()
+        self.writer.close()
+
+
+class NullSink(Object):
+    """ drops everything, for benchmarks and silent runs """
+
+    def emit(self, event: str, names: tuple, *values):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def makeSink(kind: str = "console", path: str = None) -> EventSink:
+    """ kind is "console", "jsonl", "binary" or "none" """
+    if kind == "none":
+        return NullSink()
+    if kind == "console":
+        stream = open(path, "w") if path else None
+        return EventSink(ConsoleWriter(stream))
+    if path is None:
+        raise ValueError("the %s sink needs an output file" % kind)
+    if kind == "jsonl":
+        return EventSink(JsonLinesWriter(open(path, "wb")))
+    if kind == "binary":
+        return EventSink(BinaryWriter(open(path, "wb")))
+    raise ValueError("unknown sink %s" % kind)
@@ -0,0 +1,307 @@
+"""
+Local Black-Scholes / Black-76 pricing, greeks and implied volatility for
+whole option chains, one NumPy batch per refresh.
+
+The options of a chain are rows of preallocated columns (strike, expiry,
+call/put, underlying, quotes, results). Quotes come from tickPrice (bid,
+ask, last) and tickOptionComputation (the model price and underlying price
+TWS computes), each tick only marks its row dirty, a price change of an
+underlying marks its underlying dirty. refresh() then solves the implied
+volatility and the greeks of the dirty rows only, all of them at once:
+    price    generalized Black-Scholes with cost of carry b: b = r - q for
+             stocks and indexes, b = 0 for futures (Black-76)
+    iv       safeguarded Newton on the out of the money side (bisection
+             whenever a step leaves the bracket), from the Corrado-Miller
+             guess, all the rows of the batch together
+    greeks   delta, gamma, vega (per vol point), theta (per calendar day)
+There is no scipy here: N(x) uses the Abramowitz-Stegun 7.1.26 erf, good to
+1.5e-7, so N(x) = (1 + erf(x / sqrt(2))) / 2 is good to 7.5e-8.
+
+    engine = GreeksEngine(rate=0.05)
+    und = engine.addUnderlying(1000)                    # reqId of its quotes
+    for (reqId, strike) in enumerate(strikes, 1001):
+        engine.addOption(reqId, und, strike, "20240621", "C")
+    # tickPrice / tickOptionComputation: hand them over to the engine
+    rows = engine.refresh()
+    engine.iv[rows], engine.delta[rows]
+"""
+
+import calendar
+import math
+import time
+
+import numpy as np
+
+from ibapi.object_implem import Object
+from ibapi.ticktype import TickTypeEnum
+
+YEAR_SECONDS = 365. * 86400.
+# options expire at the close, 16:00 New York, ~20:00 UTC
+EXPIRY_SECONDS_OF_DAY = 20 * 3600
+
+BID_TICKS = frozenset((TickTypeEnum.BID, TickTypeEnum.DELAYED_BID))
+ASK_TICKS = frozenset((TickTypeEnum.ASK, TickTypeEnum.DELAYED_ASK))
+LAST_TICKS = frozenset((TickTypeEnum.LAST, TickTypeEnum.DELAYED_LAST))
+
+MIN_VOL = 1e-4
+MAX_VOL = 5.
+
+_SQRT2 = math.sqrt(2.)
+_INV_SQRT_2PI = 1. / math.sqrt(2. * math.pi)
+
+
+def normCdf(x: np.ndarray) -> np.ndarray:
+    z = np.abs(x) / _SQRT2
+    t = 1. / (1. + 0.3275911 * z)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741
+                + t * (-1.453152027 + t * 1.061405429))))
+    erf = 1. - poly * np.exp(-z * z)
+    return 0.5 * (1. + np.copysign(erf, x))
+
+
+def normPdf(x: np.ndarray) -> np.ndarray:
+    return _INV_SQRT_2PI * np.exp(-0.5 * x * x)
+
+
+def blackScholes(S, K, T, r, b, sigma, omega, greeks: bool = True) -> tuple:
+    """ price (and delta, gamma, vega, theta) of calls (omega 1) and puts
+    (omega -1), every argument an array or a scalar """
+    sqrtT = np.sqrt(T)
+    volT = sigma * sqrtT
+    d1 = (np.log(S / K) + (b + 0.5 * sigma * sigma) * T) / volT
+    d2 = d1 - volT
+    carry = np.exp((b - r) * T)
+    discount = np.exp(-r * T)
+    nd1 = normCdf(omega * d1)
+    nd2 = normCdf(omega * d2)
+    price = omega * (S * carry * nd1 - K * discount * nd2)
+    if not greeks:
+        return (price,)
+    pdf = normPdf(d1)
+    delta = omega * carry * nd1
+    gamma = carry * pdf / (S * volT)
+    vega = S * carry * pdf * sqrtT
+    theta = (-S * carry * pdf * sigma / (2. * sqrtT)
+             - omega * (b - r) * S * carry * nd1
+             - omega * r * K * discount * nd2)
+    return (price, delta, gamma, vega / 100., theta / 365.)
+
+
+def _priceVega(S, K, T, r, b, sigma, omega) -> tuple:
+    """ price and vega (per unit of vol), all the Newton step needs """
+    sqrtT = np.sqrt(T)
+    volT = sigma * sqrtT
+    d1 = (np.log(S / K) + (b + 0.5 * sigma * sigma) * T) / volT
+    sCarry = S * np.exp((b - r) * T)
+    price = omega * (sCarry * normCdf(omega * d1)
+                     - K * np.exp(-r * T) * normCdf(omega * (d1 - volT)))
+    return (price, sCarry * normPdf(d1) * sqrtT)
+
+
+def impliedVol(price, S, K, T, r, b, omega, tol: float = 1e-7,
+               volTol: float = 1e-6, maxIter: int = 50) -> np.ndarray:
+    """ volatility repricing each option at price, NaN when the price is
+    outside the no-arbitrage bounds or has no time value to speak of (deep in
+    the money, no quote pins the volatility down). Every row is solved on its
+    out of the money side (put-call parity), with Newton steps on the log of
+    the price: far from the money the price is tiny and about exponential in
+    the volatility. A row stops once its price is within tol, or its step or
+    its bracket is below volTol. """
+    (price, S, K, T, b, omega) = np.broadcast_arrays(
+        *(np.asarray(a, dtype=float) for a in (price, S, K, T, b, omega)))
+    sc = S * np.exp((b - r) * T)
+    kd = K * np.exp(-r * T)
+    intrinsic = np.maximum(omega * (sc - kd), 0.)
+    upper = np.where(omega > 0, sc, kd)
+    valid = (price > intrinsic + 10. * tol) & (price < upper) & (T > 0)
+    vol = np.full(price.shape, np.nan)
+    if not valid.any():
+        return vol
+    (p, s, k, t, c, w, sc, kd) = (a[valid] for a in (price, S, K, T, b, omega, sc, kd))
+    otm = np.where(kd >= sc, 1., -1.)
+    p = np.where(otm == w, p, p - w * (sc - kd))
+    lo = np.full(p.shape, MIN_VOL)
+    hi = np.full(p.shape, MAX_VOL)
+    # Corrado-Miller guess, on the call price
+    call = np.where(otm > 0, p, p + sc - kd)
+    half = call - 0.5 * (sc - kd)
+    root = np.sqrt(np.maximum(half * half - (sc - kd) ** 2 / np.pi, 0.))
+    sigma = np.clip(np.sqrt(2. * np.pi / t) / (sc + kd) * (half + root), 0.05, 2.)
+    logP = np.log(p)
+    done = np.zeros(p.shape, dtype=bool)
+    # the whole batch every iteration: masks are cheaper than shrinking it
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        for _ in range(maxIter):
+            (model, vega) = _priceVega(s, k, t, r, c, sigma, otm)
+            diff = model - p
+            above = diff > 0
+            lo = np.where(above, lo, sigma)
+            hi = np.where(above, sigma, hi)
+            step = sigma - (np.log(model) - logP) * model / vega
+            step = np.where((step > lo) & (step < hi), step, 0.5 * (lo + hi))
+            converged = np.abs(diff) < tol
+            stalled = (np.abs(step - sigma) < volTol) | (hi - lo < volTol)
+            sigma = np.where(done | converged, sigma, step)
+            done |= converged | stalled
+            if done.all():
+                break
+    vol[valid] = sigma
+    return vol
+
+
+def expiryEpoch(expiry: str) -> float:
+    """ "YYYYMMDD" (lastTradeDateOrContractMonth) -> epoch seconds of the
+    close """
+    day = time.strptime(expiry[:8], "%Y%m%d")
+    return calendar.timegm(day) + EXPIRY_SECONDS_OF_DAY
+
+
+class GreeksEngine(Object):
+    def __init__(self, rate: float = 0.0, capacity: int = 1024):
+        self.rate = rate
+        self.reqId2row = {}
+        self.reqId2underlying = {}
+        self.nOptions = 0
+        self.nUnderlyings = 0
+        self._allocOptions(capacity)
+        self._allocUnderlyings(16)
+
+    def _allocOptions(self, n: int):
+        def grown(name, dtype, fill):
+            column = np.full(n, fill, dtype=dtype)
+            old = getattr(self, name, None)
+            if old is not None:
+                column[:len(old)] = old
+            setattr(self, name, column)
+
+        for name in ("strike", "expiry", "omega", "bid", "ask", "last", "modelPrice"):
+            grown(name, float, 0.)
+        for name in ("iv", "price", "delta", "gamma", "vega", "theta", "undPrice"):
+            grown(name, float, np.nan)
+        grown("underlying", np.int32, 0)
+        grown("dirty", bool, False)
+
+    def _allocUnderlyings(self, n: int):
+        for (name, dtype, fill) in (("undBid", float, 0.), ("undAsk", float, 0.),
+                                    ("undLast", float, 0.), ("undModel", float, 0.),
+                                    ("carry", float, 0.), ("undDirty", bool, False)):
+            column = np.full(n, fill, dtype=dtype)
+            old = getattr(self, name, None)
+            if old is not None:
+                column[:len(old)] = old
+            setattr(self, name, column)
+
+    def addUnderlying(self, reqId: int = None, isFuture: bool = False,
+                      dividendYield: float = 0.) -> int:
+        und = self.nUnderlyings
+        if und == len(self.carry):
+            self._allocUnderlyings(2 * und)
+        self.nUnderlyings += 1
+        self.carry[und] = 0. if isFuture else self.rate - dividendYield
+        if reqId is not None:
+            self.reqId2underlying[reqId] = und
+        return und
+
+    def addOption(self, reqId: int, underlying: int, strike: float, expiry: str,
+                  right: str) -> int:
+        row = self.nOptions
+        if row == len(self.strike):
+            self._allocOptions(2 * row)
+        self.nOptions += 1
+        self.strike[row] = strike
+        self.expiry[row] = expiryEpoch(expiry)
+        self.omega[row] = 1. if right[:1].upper() == "C" else -1.
+        self.underlying[row] = underlying
+        self.dirty[row] = True
+        if reqId is not None:
+            self.reqId2row[reqId] = row
+        return row
+
+    def tickPrice(self, reqId: int, tickType: int, price: float) -> bool:
+        """ True if reqId is an option or an underlying of the engine """
+        row = self.reqId2row.get(reqId)
+        if row is not None:
+            (bid, ask, last, dirty) = (self.bid, self.ask, self.last, self.dirty)
+        else:
+            row = self.reqId2underlying.get(reqId)
+            if row is None:
+                return False
+            (bid, ask, last, dirty) = (self.undBid, self.undAsk, self.undLast,
+                                       self.undDirty)
+        if tickType in BID_TICKS:
+            column = bid
+        elif tickType in ASK_TICKS:
+            column = ask
+        elif tickType in LAST_TICKS:
+            column = last
+        else:
+            return True
+        if column[row] != price:
+            column[row] = price
+            dirty[row] = True
+        return True
+
+    def tickOptionComputation(self, reqId: int, tickType: int, impliedVol: float,
+                              delta: float, optPrice: float, pvDividend: float,
+                              gamma: float, vega: float, theta: float,
+                              undPrice: float) -> bool:
+        """ keeps the model price and the underlying price TWS used, both as
+        fallbacks for missing quotes """
+        row = self.reqId2row.get(reqId)
+        if row is None:
+            return False
+        if optPrice is not None and optPrice > 0 and optPrice != self.modelPrice[row]:
+            self.modelPrice[row] = optPrice
+            self.dirty[row] = True
+        und = self.underlying[row]
+        if undPrice is not None and undPrice > 0 and undPrice != self.undModel[und]:
+            self.undModel[und] = undPrice
+            self.undDirty[und] = True
+        return True
+
+    @staticmethod
+    def _quote(bid: np.ndarray, ask: np.ndarray, last: np.ndarray,
+               model: np.ndarray) -> np.ndarray:
+        """ mid, else last, else the model price """
+        return np.where((bid > 0) & (ask > 0), 0.5 * (bid + ask),
+                        np.where(last > 0, last, model))
+
+    def refresh(self, now: float = None) -> np.ndarray:
+        """ implied vols and greeks of the dirty rows; returns those rows """
+        n = self.nOptions
+        m = self.nUnderlyings
+        underlying = self.underlying[:n]
+        rows = np.flatnonzero(self.dirty[:n] | self.undDirty[:m][underlying])
+        self.dirty[rows] = False
+        self.undDirty[:m] = False
+        if not rows.size:
+            return rows
+        if now is None:
+            now = time.time()
+        und = underlying[rows]
+        S = self._quote(self.undBid[und], self.undAsk[und], self.undLast[und],
+                        self.undModel[und])
+        quote = self._quote(self.bid[rows], self.ask[rows], self.last[rows],
+                            self.modelPrice[rows])
+        T = (self.expiry[rows] - now) / YEAR_SECONDS
+        K = self.strike[rows]
+        omega = self.omega[rows]
+        b = self.carry[und]
+        ok = (S > 0) & (quote > 0) & (T > 0)
+        iv = np.full(rows.size, np.nan)
+        if ok.any():
+            iv[ok] = impliedVol(quote[ok], S[ok], K[ok], T[ok], self.rate, b[ok], omega[ok])
+        solved = ~np.isnan(iv)
+        results = (self.price, self.delta, self.gamma, self.vega, self.theta)
+        for column in results:
+            column[rows] = np.nan
+        self.iv[rows] = iv
+        # the underlying price the row was solved with
+        self.undPrice[rows] = S
+        if solved.any():
+            r = rows[solved]
+            values = blackScholes(S[solved], K[solved], T[solved], self.rate, b[solved],
+                                  iv[solved], omega[solved])
+            for (column, value) in zip(results, values):
+                column[r] = value
+        return rows
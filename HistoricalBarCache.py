@@ -0,0 +1,359 @@
+"""
+Persistent on-disk cache of historical bars with gap filling fetches.
+
+Bars are cached per (contract, barSizeSetting, whatToShow, useRTH), the
+contract being its conId when known. Each series is one file:
+    header   magic version coveredStart coveredEnd count          32 bytes
+    columns  time[count] open[count] high ... average[count] barCount[count]
+so loading is one read and a few np.frombuffer(). The header keeps the time
+range already fetched, bars missing inside it are gaps of the market (no
+trading), not of the cache.
+
+A request for a window [start, end) is answered from the cache; only the
+missing head [start, coveredStart) and tail [coveredEnd, end) go out as
+reqHistoricalData, through the pacing aware HistoricalDataScheduler. The bar
+in progress of a fetch up to now is handed out but never written, the next
+request fetches it again.
+
+    cache = HistoricalBarCache("cache/bars", app.histScheduler)
+    req = cache.request(contract, "5 mins", "TRADES", 1, time.time() - 86400)
+    bars = req.get(timeout=60)           # field -> array, oldest bar first
+    # historicalData/historicalDataEnd/error are fed with
+    # cache.historicalData(reqId, bar), cache.historicalDataEnd(reqId), ...
+"""
+
+import concurrent.futures
+import itertools
+import math
+import os
+import re
+import struct
+import threading
+import time
+
+import numpy as np
+
+from ibapi.common import BarData
+from ibapi.contract import Contract
+from ibapi.object_implem import Object
+
+from BarStore import BarStore, barDateToEpoch
+from ErrorCodes import isWarning
+from HistoricalDataScheduler import HISTORICAL_DATA_ERROR, HistoricalDataScheduler
+
+MAGIC = b"IBHC"
+VERSION = 1
+# magic version reserved coveredStart coveredEnd count
+_HEADER = struct.Struct("<4sHHqqQ")
+
+COLUMNS = (("time", np.int64), ("open", np.float64), ("high", np.float64),
+           ("low", np.float64), ("close", np.float64), ("volume", np.float64),
+           ("average", np.float64), ("barCount", np.int32))
+
+NO_COVERAGE = -1
+
+BAR_SIZE_UNITS = {"sec": 1, "secs": 1, "min": 60, "mins": 60, "hour": 3600,
+                  "hours": 3600, "day": 86400, "days": 86400, "week": 7 * 86400,
+                  "month": 30 * 86400}
+
+
+def barSeconds(barSizeSetting: str) -> int:
+    """ "5 mins" -> 300 """
+    (n, unit) = barSizeSetting.split()
+    return int(n) * BAR_SIZE_UNITS[unit.lower()]
+
+
+def durationStr(seconds: float) -> str:
+    """ the smallest reqHistoricalData duration covering seconds """
+    if seconds <= 86400:
+        return "%d S" % max(math.ceil(seconds), 60)
+    if seconds <= 365 * 86400:
+        return "%d D" % math.ceil(seconds / 86400)
+    return "%d Y" % math.ceil(seconds / (365 * 86400))
+
+
+def endDateTimeStr(epoch: float) -> str:
+    return time.strftime("%Y%m%d %H:%M:%S GMT", time.gmtime(epoch))
+
+
+def isNoData(errorCode: int, errorString: str) -> bool:
+    # "HMDS query returned no data": nothing traded in the window
+    return errorCode == HISTORICAL_DATA_ERROR and "no data" in errorString.lower()
+
+
+def emptyColumns() -> dict:
+    return {name: np.empty(0, dtype=dtype) for (name, dtype) in COLUMNS}
+
+
+class BarSeries(Object):
+    """ the bars of one cache key, sorted by time, with the fetched range """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.columns = emptyColumns()
+        self.coveredStart = NO_COVERAGE
+        self.coveredEnd = NO_COVERAGE
+        # bars up to here (excluded) are complete and may be written
+        self.completeEnd = NO_COVERAGE
+
+    def __len__(self):
+        return len(self.columns["time"])
+
+    def load(self) -> bool:
+        try:
+            with open(self.path, "rb") as f:
+                buf = f.read()
+        except FileNotFoundError:
+            return False
+        (magic, version, _, coveredStart, coveredEnd, count) = \
+            _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a bar cache file" % self.path)
+        offset = _HEADER.size
+        columns = {}
+        for (name, dtype) in COLUMNS:
+            columns[name] = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+            offset += count * np.dtype(dtype).itemsize
+        self.columns = columns
+        self.coveredStart = coveredStart
+        self.coveredEnd = coveredEnd
+        self.completeEnd = coveredEnd
+        return True
+
+    def save(self):
+        """ write the complete bars, atomically """
+        n = int(np.searchsorted(self.columns["time"], self.completeEnd))
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmpPath = self.path + ".tmp"
+        with open(tmpPath, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, 0, self.coveredStart,
+                                 min(self.coveredEnd, self.completeEnd), n))
+            for (name, dtype) in COLUMNS:
+                f.write(self.columns[name][:n].astype(dtype, copy=False).tobytes())
+        os.replace(tmpPath, self.path)
+
+    def merge(self, columns: dict):
+        """ add bars, a fetched bar replaces a cached one with the same time """
+        if len(columns["time"]) == 0:
+            return
+        times = np.concatenate((columns["time"], self.columns["time"]))
+        # np.unique keeps the first occurrence, the fetched one
+        (_, index) = np.unique(times, return_index=True)
+        self.columns = {name: np.concatenate((columns[name], self.columns[name]))[index]
+                        for (name, _) in COLUMNS}
+
+    def cover(self, start: int, end: int, completeEnd: int):
+        if self.coveredStart == NO_COVERAGE:
+            (self.coveredStart, self.coveredEnd) = (start, end)
+        else:
+            self.coveredStart = min(self.coveredStart, start)
+            self.coveredEnd = max(self.coveredEnd, end)
+        self.completeEnd = max(self.completeEnd, completeEnd)
+
+    def window(self, start: int, end: int = None) -> dict:
+        """ copies of the bars with start <= time < end """
+        times = self.columns["time"]
+        first = int(np.searchsorted(times, start))
+        last = len(times) if end is None else int(np.searchsorted(times, end))
+        return {name: column[first:last].copy()
+                for (name, column) in self.columns.items()}
+
+
+class Fetch(Object):
+    def __init__(self, reqId: int, request, start: int, end: int, completeEnd: int):
+        self.reqId = reqId
+        self.request = request
+        self.start = start
+        self.end = end
+        self.completeEnd = completeEnd
+        self.bars = []
+
+
+class CacheRequest(Object):
+    def __init__(self, key: tuple, series: BarSeries, start: int, end: int,
+                 onDone=None):
+        self.key = key
+        self.series = series
+        self.start = start
+        self.end = end
+        self.onDone = onDone
+        self.nPending = 0
+        self.nFetched = 0
+        self.errors = []
+        self.future = concurrent.futures.Future()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def get(self, timeout: float = None) -> dict:
+        """ blocks until the missing bars are fetched; field -> array of the
+        window, oldest bar first (a failed fetch leaves its range out, see
+        errors) """
+        return self.future.result(timeout)
+
+
+class HistoricalBarCache(Object):
+    def __init__(self, directory: str, scheduler: HistoricalDataScheduler,
+                 firstReqId: int = 10000000):
+        self.directory = directory
+        self.scheduler = scheduler
+        self.series = {}
+        self.fetches = {}
+        self.nextReqId = itertools.count(firstReqId)
+        # requests come from the caller's thread, bars from the reader thread
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def key(contract: Contract, barSizeSetting: str, whatToShow: str,
+            useRTH: int) -> tuple:
+        c = contract
+        contractKey = (c.conId,) if c.conId else (c.symbol, c.secType, c.exchange,
+                                                    c.currency)
+        return contractKey + (barSizeSetting, whatToShow, int(useRTH))
+
+    def path(self, key: tuple) -> str:
+        name = "_".join(re.sub(r"[^A-Za-z0-9.]", "", str(part)) for part in key)
+        return os.path.join(self.directory, name + ".ibc")
+
+    def _series(self, key: tuple) -> BarSeries:
+        series = self.series.get(key)
+        if series is None:
+            series = BarSeries(self.path(key))
+            series.load()
+            self.series[key] = series
+        return series
+
+    def request(self, contract: Contract, barSizeSetting: str, whatToShow: str,
+                useRTH: int, start: float, end: float = None,
+                onDone=None) -> CacheRequest:
+        """ bars of [start, end), end None meaning up to now (bar in progress
+        included); onDone(request) is called once everything is there """
+        step = barSeconds(barSizeSetting)
+        now = time.time()
+        start = int(start) - int(start) % step
+        upToNow = end is None or end >= now
+        end = int(now) if upToNow else int(end)
+        # the bar in progress at now is not complete yet
+        completeEnd = int(now) - int(now) % step if upToNow else end
+
+        key = self.key(contract, barSizeSetting, whatToShow, useRTH)
+        with self.lock:
+            series = self._series(key)
+            req = CacheRequest(key, series, start, None if upToNow else end, onDone)
+            if series.coveredStart == NO_COVERAGE:
+                gaps = [(start, end)]
+            else:
+                gaps = []
+                if start < series.coveredStart:
+                    gaps.append((start, series.coveredStart))
+                # a fetch up to now always refreshes the bar in progress
+                if end > series.coveredEnd or (upToNow and end > series.completeEnd):
+                    gaps.append((min(series.coveredEnd, series.completeEnd), end))
+            fetches = []
+            for (gapStart, gapEnd) in gaps:
+                fetch = Fetch(next(self.nextReqId), req, gapStart, gapEnd,
+                              completeEnd if gapEnd == end else gapEnd)
+                self.fetches[fetch.reqId] = fetch
+                fetches.append(fetch)
+            req.nPending = len(fetches)
+
+        if not fetches:
+            self._complete(req)
+        for fetch in fetches:
+            endDateTime = "" if upToNow and fetch.end == end else endDateTimeStr(fetch.end)
+            self.scheduler.submit(fetch.reqId, contract, endDateTime,
+                                  durationStr(fetch.end - fetch.start), barSizeSetting,
+                                  whatToShow, useRTH, 2)
+        return req
+
+    def owns(self, reqId: int) -> bool:
+        return reqId in self.fetches
+
+    def historicalData(self, reqId: int, bar: BarData) -> bool:
+        """ to be called from historicalData; returns False for the bars of
+        requests that are not the cache's """
+        fetch = self.fetches.get(reqId)
+        if fetch is None:
+            return False
+        fetch.bars.append((barDateToEpoch(bar.date), bar.open, bar.high, bar.low,
+                           bar.close, bar.volume, bar.average, bar.barCount))
+        return True
+
+    def historicalDataEnd(self, reqId: int) -> bool:
+        """ to be called from historicalDataEnd """
+        with self.lock:
+            fetch = self.fetches.pop(reqId, None)
+            if fetch is None:
+                return False
+            series = fetch.request.series
+            if fetch.bars:
+                rows = list(zip(*fetch.bars))
+                series.merge({name: np.array(rows[i], dtype=dtype)
+                              for (i, (name, dtype)) in enumerate(COLUMNS)})
+            series.cover(fetch.start, fetch.end, fetch.completeEnd)
+            series.save()
+            fetch.request.nFetched += len(fetch.bars)
+        self._fetchDone(fetch)
+        return True
+
+    def error(self, reqId: int, errorCode: int, errorString: str) -> bool:
+        """ to be called from error() once the scheduler gave up on reqId """
+        if isWarning(errorCode) or reqId not in self.fetches:
+            return False
+        if isNoData(errorCode, errorString):
+            # an empty window is a valid answer, remember it
+            return self.historicalDataEnd(reqId)
+        with self.lock:
+            fetch = self.fetches.pop(reqId, None)
+            if fetch is None:
+                return False
+            fetch.request.errors.append((reqId, errorCode, errorString))
+        self._fetchDone(fetch)
+        return True
+
+    def cancel(self, req: CacheRequest) -> bool:
+        """ give up on the fetches of req still out, its onDone is not called;
+        returns False if there were none (req is done or completing) """
+        with self.lock:
+            reqIds = [reqId for (reqId, fetch) in self.fetches.items()
+                      if fetch.request is req]
+            for reqId in reqIds:
+                del self.fetches[reqId]
+        if not reqIds:
+            return False
+        for reqId in reqIds:
+            if self.scheduler.cancel(reqId):
+                self.scheduler.client.cancelHistoricalData(reqId)
+        req.future.cancel()
+        return True
+
+    def _fetchDone(self, fetch: Fetch):
+        req = fetch.request
+        with self.lock:
+            req.nPending -= 1
+            if req.nPending > 0:
+                return
+        self._complete(req)
+
+    def _complete(self, req: CacheRequest):
+        with self.lock:
+            bars = req.series.window(req.start, req.end)
+        if not req.future.done():
+            req.future.set_result(bars)
+        if req.onDone is not None:
+            req.onDone(req)
+
+    def cached(self, contract: Contract, barSizeSetting: str, whatToShow: str,
+               useRTH: int, start: float = 0, end: float = None) -> dict:
+        """ what the cache holds right now, no fetch """
+        with self.lock:
+            series = self._series(self.key(contract, barSizeSetting, whatToShow, useRTH))
+            return series.window(int(start), None if end is None else int(end))
+
+
+def fillStore(store: BarStore, row: int, bars: dict):
+    """ append the bars of a cache request to a BarStore row """
+    for i in range(len(bars["time"])):
+        store.append(row, int(bars["time"][i]), bars["open"][i], bars["high"][i],
+                     bars["low"][i], bars["close"][i], bars["volume"][i],
+                     int(bars["barCount"][i]), bars["average"][i])
@@ -0,0 +1,272 @@
+"""
+Pacing aware scheduler for reqHistoricalData.
+
+Requests are queued and sent as soon as the TWS historical data pacing rules
+allow it:
+ - no identical request within 15 seconds
+ - no more than 5 requests for the same contract/exchange/tick type within
+   2 seconds (six or more is a violation)
+ - no more than 60 requests within any 10 minute period
+and never more than maxInFlight requests waiting for their historicalDataEnd.
+Pacing violations reported through error() are retried with a back off.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+from ibapi.client import EClient
+from ibapi.contract import Contract
+from ibapi.object_implem import Object
+
+from ErrorCodes import isWarning
+
+logger = logging.getLogger(__name__)
+
+HISTORICAL_DATA_ERROR = 162
+
+
+def isPacingViolation(errorCode: int, errorString: str) -> bool:
+    return errorCode == HISTORICAL_DATA_ERROR and "pacing violation" in errorString.lower()
+
+
+class HistoricalRequest(Object):
+    def __init__(self, reqId: int, contract: Contract, endDateTime: str,
+                 durationStr: str, barSizeSetting: str, whatToShow: str,
+                 useRTH: int, formatDate: int, keepUpToDate: bool,
+                 chartOptions: list):
+        self.reqId = reqId
+        self.contract = contract
+        self.endDateTime = endDateTime
+        self.durationStr = durationStr
+        self.barSizeSetting = barSizeSetting
+        self.whatToShow = whatToShow
+        self.useRTH = useRTH
+        self.formatDate = formatDate
+        self.keepUpToDate = keepUpToDate
+        self.chartOptions = chartOptions
+        self.attempts = 0
+        self.notBefore = 0.
+        self.sentTime = None
+
+    def contractKey(self) -> tuple:
+        c = self.contract
+        return (c.conId or c.symbol, c.secType, c.exchange, c.currency,
+                self.whatToShow)
+
+    def identicalKey(self) -> tuple:
+        return self.contractKey() + (self.endDateTime, self.durationStr,
+                                     self.barSizeSetting, self.useRTH)
+
+
+class HistoricalDataScheduler(Object):
+    def __init__(self, client: EClient, maxInFlight: int = 50,
+                 maxPerWindow: int = 60, window: float = 600.,
+                 identicalInterval: float = 15., maxPerContract: int = 5,
+                 contractInterval: float = 2., retryDelay: float = 10.,
+                 maxRetries: int = 3):
+        self.client = client
+        self.maxInFlight = maxInFlight
+        self.maxPerWindow = maxPerWindow
+        self.window = window
+        self.identicalInterval = identicalInterval
+        self.maxPerContract = maxPerContract
+        self.contractInterval = contractInterval
+        self.retryDelay = retryDelay
+        self.maxRetries = maxRetries
+
+        self.pending = collections.deque()
+        self.inFlight = {}
+        self.sentTimes = collections.deque()
+        self.identicalSentTime = {}
+        self.contractSentTimes = collections.defaultdict(collections.deque)
+        self.done = set()
+        self.failed = {}
+
+        # reentrant: reqHistoricalData may call error() straight back
+        self.lock = threading.RLock()
+        self.cond = threading.Condition(self.lock)
+        self.timer = None
+        self.pumping = False
+
+    def submit(self, reqId: int, contract: Contract, endDateTime: str,
+               durationStr: str, barSizeSetting: str, whatToShow: str,
+               useRTH: int, formatDate: int = 1, keepUpToDate: bool = False,
+               chartOptions: list = None):
+        req = HistoricalRequest(reqId, contract, endDateTime, durationStr,
+                                barSizeSetting, whatToShow, useRTH, formatDate,
+                                keepUpToDate, chartOptions or [])
+        with self.lock:
+            self.pending.append(req)
+        self.pump()
+
+    def _delay(self, req: HistoricalRequest, now: float) -> float:
+        """ seconds to wait before req can be sent, 0 if it can go now """
+        delay = req.notBefore - now
+        last = self.identicalSentTime.get(req.identicalKey())
+        if last is not None:
+            delay = max(delay, last + self.identicalInterval - now)
+        times = self.contractSentTimes.get(req.contractKey())
+        if times and len(times) >= self.maxPerContract:
+            delay = max(delay, times[0] + self.contractInterval - now)
+        return max(delay, 0.)
+
+    def _expire(self, now: float):
+        while self.sentTimes and self.sentTimes[0] <= now - self.window:
+            self.sentTimes.popleft()
+        for key in list(self.contractSentTimes):
+            times = self.contractSentTimes[key]
+            while times and times[0] <= now - self.contractInterval:
+                times.popleft()
+            if not times:
+                del self.contractSentTimes[key]
+        for key in [k for (k, t) in self.identicalSentTime.items()
+                    if t <= now - self.identicalInterval]:
+            del self.identicalSentTime[key]
+
+    def _send(self, req: HistoricalRequest, now: float):
+        req.attempts += 1
+        req.sentTime = now
+        self.inFlight[req.reqId] = req
+        self.sentTimes.append(now)
+        self.identicalSentTime[req.identicalKey()] = now
+        self.contractSentTimes[req.contractKey()].append(now)
+        logger.debug("sending historical request %d (attempt %d)", req.reqId,
+                     req.attempts)
+        self.client.reqHistoricalData(req.reqId, req.contract, req.endDateTime,
+                                      req.durationStr, req.barSizeSetting,
+                                      req.whatToShow, req.useRTH, req.formatDate,
+                                      req.keepUpToDate, req.chartOptions)
+
+    def pump(self):
+        """ send everything the pacing rules allow right now and arm a timer
+        for the next request that has to wait """
+        with self.lock:
+            if self.pumping:
+                # error() called back from inside _send, the outer loop goes on
+                return
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            self.pumping = True
+            try:
+                self._pump()
+            finally:
+                self.pumping = False
+            self.cond.notify_all()
+
+    def _pump(self):
+        now = time.monotonic()
+        self._expire(now)
+        nextDelay = None
+        skipped = collections.deque()
+        while self.pending and len(self.inFlight) < self.maxInFlight:
+            if len(self.sentTimes) >= self.maxPerWindow:
+                windowDelay = self.sentTimes[0] + self.window - now
+                nextDelay = windowDelay if nextDelay is None \
+                    else min(nextDelay, windowDelay)
+                break
+            req = self.pending.popleft()
+            delay = self._delay(req, now)
+            if delay > 0:
+                skipped.append(req)
+                nextDelay = delay if nextDelay is None else min(nextDelay, delay)
+                continue
+            self._send(req, now)
+        # keep the submission order for the requests that had to wait
+        skipped.extend(self.pending)
+        self.pending = skipped
+
+        if self.pending and nextDelay is not None:
+            self.timer = threading.Timer(nextDelay, self.pump)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _finish(self, reqId: int):
+        self.inFlight.pop(reqId, None)
+        self.done.add(reqId)
+
+    def onEnd(self, reqId: int):
+        """ to be called from historicalDataEnd """
+        with self.lock:
+            if reqId not in self.inFlight:
+                return
+            self._finish(reqId)
+        self.pump()
+
+    def onError(self, reqId: int, errorCode: int, errorString: str) -> bool:
+        """ to be called from error(); returns True if the error is a pacing
+        violation the scheduler will retry, the caller can then ignore it """
+        retrying = False
+        with self.lock:
+            req = self.inFlight.get(reqId)
+            if req is None or isWarning(errorCode):
+                return False
+            if isPacingViolation(errorCode, errorString) \
+                    and req.attempts <= self.maxRetries:
+                del self.inFlight[reqId]
+                req.notBefore = time.monotonic() \
+                                + self.retryDelay * 2 ** (req.attempts - 1)
+                logger.info("pacing violation on %d, retrying in %.1fs", reqId,
+                            req.notBefore - time.monotonic())
+                self.pending.appendleft(req)
+                retrying = True
+            else:
+                self.failed[reqId] = (errorCode, errorString)
+                self._finish(reqId)
+        self.pump()
+        return retrying
+
+    def connectionLost(self, errorCode: int, errorString: str) -> list:
+        """ to be called on a connection error (reqId NO_VALID_ID): the
+        requests in flight failed and free their slots, the queued ones go
+        out again (and fail at once while disconnected); returns the failed
+        reqIds """
+        with self.lock:
+            reqIds = list(self.inFlight)
+            for reqId in reqIds:
+                self.failed[reqId] = (errorCode, errorString)
+                self._finish(reqId)
+        if reqIds:
+            logger.warning("connection lost (%d), %d historical requests failed",
+                           errorCode, len(reqIds))
+        self.pump()
+        return reqIds
+
+    def cancel(self, reqId: int) -> bool:
+        """ drop reqId if still queued; returns True if it was in flight, the
+        caller should then cancelHistoricalData() it """
+        with self.lock:
+            self.pending = collections.deque(
+                req for req in self.pending if req.reqId != reqId)
+            inFlight = self.inFlight.pop(reqId, None) is not None
+            self.cond.notify_all()
+        if inFlight:
+            self.pump()
+        return inFlight
+
+    def cancelAll(self) -> list:
+        """ drop the queued requests; returns the in flight reqIds which the
+        caller should cancelHistoricalData() """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending.clear()
+            reqIds = list(self.inFlight)
+            self.inFlight.clear()
+            self.cond.notify_all()
+            return reqIds
+
+    def isDone(self) -> bool:
+        with self.lock:
+            return not self.pending and not self.inFlight
+
+    def wait(self, timeout: float = None) -> bool:
+        """ block until every submitted request got its historicalDataEnd or
+        failed; returns False on timeout """
+        with self.lock:
+            return self.cond.wait_for(
+                lambda: not self.pending and not self.inFlight, timeout)
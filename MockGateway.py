@@ -0,0 +1,353 @@
+"""
+Local stand-in for TWS / IB Gateway speaking the API wire protocol.
+
+It performs the handshake, answers startApi with nextValidId and
+managedAccounts, and streams scripted volumes of data back to the requests
+it understands:
+    reqMktData            -> tickPrice/tickSize
+    reqTickByTickData     -> tickByTickAllLast/BidAsk/MidPoint
+    reqMktDepth           -> updateMktDepth or updateMktDepthL2
+    reqHistoricalData     -> historicalData + historicalDataEnd
+    reqRealTimeBars       -> realtimeBar
+    placeOrder            -> orderStatus (PreSubmitted, Submitted, fills)
+    reqIds, reqCurrentTime
+Bar dates are always sent as epoch seconds, whatever formatDate was asked.
+
+    gateway = MockGateway(script=MockScript(ticksPerRequest=100000))
+    port = gateway.start()
+    app.connect("127.0.0.1", port, 0)
+
+or from the command line: python MockGateway.py -p 7497 --ticks 100000
+"""
+
+import argparse
+import logging
+import random
+import socketserver
+import struct
+import threading
+import time
+
+from ibapi.message import IN, OUT
+from ibapi.object_implem import Object
+from ibapi.server_versions import (MAX_CLIENT_VER, MIN_SERVER_VER_MARKET_CAP_PRICE,
+                                   MIN_SERVER_VER_SMART_DEPTH,
+                                   MIN_SERVER_VER_SYNT_REALTIME_BARS,
+                                   MIN_SERVER_VER_ORDER_CONTAINER)
+
+logger = logging.getLogger(__name__)
+
+
+def makeMsg(*fields) -> bytes:
+    text = "".join([str(int(f) if type(f) is bool else f) + "\0" for f in fields]).encode()
+    return struct.pack("!I", len(text)) + text
+
+
+class MockScript(Object):
+    def __init__(self, ticksPerRequest: int = 100, tickByTickPerRequest: int = 100,
+                 depthUpdatesPerRequest: int = 100, depthRows: int = 10,
+                 depthL2: bool = False, barsPerRequest: int = 100,
+                 barSeconds: int = 300, realTimeBarsPerRequest: int = 10,
+                 fillsPerOrder: int = 1, nextValidId: int = 1,
+                 accounts: str = "DU123456", startPrice: float = 100.,
+                 seed: int = 0, chunkSize: int = 1 << 16):
+        self.ticksPerRequest = ticksPerRequest
+        self.tickByTickPerRequest = tickByTickPerRequest
+        self.depthUpdatesPerRequest = depthUpdatesPerRequest
+        self.depthRows = depthRows
+        self.depthL2 = depthL2
+        self.barsPerRequest = barsPerRequest
+        self.barSeconds = barSeconds
+        self.realTimeBarsPerRequest = realTimeBarsPerRequest
+        self.fillsPerOrder = fillsPerOrder
+        self.nextValidId = nextValidId
+        self.accounts = accounts
+        self.startPrice = startPrice
+        self.seed = seed
+        # bytes buffered before each socket write
+        self.chunkSize = chunkSize
+
+
+class MockSession(socketserver.BaseRequestHandler):
+    """ one client connection; the handleXxx methods can be overridden to
+    script other answers """
+
+    def setup(self):
+        self.script = self.server.gateway.script
+        self.serverVersion = self.server.gateway.serverVersion
+        self.rng = random.Random(self.script.seed)
+        self.out = bytearray()
+        self.nextOrderId = self.script.nextValidId
+        self.permId = 1000000
+        self.handlers = {
+            OUT.START_API: self.handleStartApi,
+            OUT.REQ_IDS: self.handleReqIds,
+            OUT.REQ_CURRENT_TIME: self.handleReqCurrentTime,
+            OUT.REQ_MKT_DATA: self.handleReqMktData,
+            OUT.REQ_TICK_BY_TICK_DATA: self.handleReqTickByTickData,
+            OUT.REQ_MKT_DEPTH: self.handleReqMktDepth,
+            OUT.REQ_HISTORICAL_DATA: self.handleReqHistoricalData,
+            OUT.REQ_REAL_TIME_BARS: self.handleReqRealTimeBars,
+            OUT.PLACE_ORDER: self.handlePlaceOrder,
+        }
+
+    def recvExactly(self, n: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.request.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError("client went away")
+            buf += chunk
+        return bytes(buf)
+
+    def recvPayload(self) -> bytes:
+        size = struct.unpack("!I", self.recvExactly(4))[0]
+        return self.recvExactly(size)
+
+    def recvMsg(self) -> list:
+        return self.recvPayload().split(b"\0")[:-1]
+
+    def send(self, msg: bytes):
+        self.out += msg
+        if len(self.out) >= self.script.chunkSize:
+            self.flush()
+
+    def flush(self):
+        if self.out:
+            self.request.sendall(self.out)
+            self.out = bytearray()
+
+    def handle(self):
+        try:
+            prefix = self.recvExactly(4)
+            if prefix != b"API\0":
+                logger.error("bad handshake prefix %s", prefix)
+                return
+            # "v<min>..<max>[ connectOptions]", not NULL terminated
+            versions = self.recvPayload().decode().split()[0]
+            (minVer, maxVer) = versions.lstrip("v").split("..")
+            self.serverVersion = min(int(maxVer), self.serverVersion)
+            self.send(makeMsg(self.serverVersion,
+                              time.strftime("%Y%m%d %H:%M:%S") + " EST"))
+            self.flush()
+            while True:
+                fields = self.recvMsg()
+                handler = self.handlers.get(int(fields[0]))
+                if handler is not None:
+                    handler(fields)
+                self.flush()
+        except (ConnectionError, OSError):
+            logger.debug("session closed")
+
+    def walk(self, price: float) -> float:
+        return round(max(0.01, price + self.rng.choice((-0.01, 0., 0.01))), 2)
+
+    def handleStartApi(self, fields):
+        self.send(makeMsg(IN.NEXT_VALID_ID, 1, self.nextOrderId))
+        self.send(makeMsg(IN.MANAGED_ACCTS, 1, self.script.accounts))
+
+    def handleReqIds(self, fields):
+        self.send(makeMsg(IN.NEXT_VALID_ID, 1, self.nextOrderId))
+
+    def handleReqCurrentTime(self, fields):
+        self.send(makeMsg(IN.CURRENT_TIME, 1, int(time.time())))
+
+    def handleReqMktData(self, fields):
+        reqId = int(fields[2])
+        price = self.script.startPrice
+        for i in range(self.script.ticksPerRequest):
+            price = self.walk(price)
+            tickType = 1 if i % 2 == 0 else 2  # BID / ASK
+            self.send(makeMsg(IN.TICK_PRICE, 6, reqId, tickType,
+                              price if tickType == 1 else price + 0.01,
+                              self.rng.randint(1, 50) * 100, 0))
+
+    def handleReqTickByTickData(self, fields):
+        reqId = int(fields[1])
+        tickType = fields[14].decode()
+        price = self.script.startPrice
+        now = int(time.time())
+        for i in range(self.script.tickByTickPerRequest):
+            price = self.walk(price)
+            if tickType in ("Last", "AllLast"):
+                self.send(makeMsg(IN.TICK_BY_TICK, reqId, 1 if tickType == "Last" else 2,
+                                  now + i, price, self.rng.randint(1, 10) * 100, 0,
+                                  "ISLAND", ""))
+            elif tickType == "BidAsk":
+                self.send(makeMsg(IN.TICK_BY_TICK, reqId, 3, now + i, price,
+                                  price + 0.01, self.rng.randint(1, 50) * 100,
+                                  self.rng.randint(1, 50) * 100, 0))
+            else:
+                self.send(makeMsg(IN.TICK_BY_TICK, reqId, 4, now + i, price + 0.005))
+
+    def handleReqMktDepth(self, fields):
+        reqId = int(fields[2])
+        rows = self.script.depthRows
+        mid = self.script.startPrice
+        for i in range(self.script.depthUpdatesPerRequest):
+            side = i % 2
+            position = (i // 2) % rows
+            # first pass over the rows inserts, then updates
+            operation = 0 if i < 2 * rows else 1
+            if i >= 2 * rows and self.rng.random() < 0.05:
+                # delete + reinsert keeps the book at the same depth
+                self.sendDepth(reqId, position, 2, side, 0., 0)
+                operation = 0
+            offset = 0.01 * (position + 1)
+            price = round(mid - offset if side == 1 else mid + offset, 2)
+            self.sendDepth(reqId, position, operation, side, price,
+                           self.rng.randint(1, 50) * 100)
+
+    def sendDepth(self, reqId, position, operation, side, price, size):
+        if self.script.depthL2:
+            msg = [IN.MARKET_DEPTH_L2, 1, reqId, position, "MM%d" % (position % 4),
+                   operation, side, price, size]
+            if self.serverVersion >= MIN_SERVER_VER_SMART_DEPTH:
+                msg.append(True)
+            self.send(makeMsg(*msg))
+        else:
+            self.send(makeMsg(IN.MARKET_DEPTH, 1, reqId, position, operation,
+                              side, price, size))
+
+    def handleReqHistoricalData(self, fields):
+        idx = 1 if self.serverVersion >= MIN_SERVER_VER_SYNT_REALTIME_BARS else 2
+        reqId = int(fields[idx])
+        n = self.script.barsPerRequest
+        step = self.script.barSeconds
+        end = int(time.time()) // step * step
+        start = end - n * step
+        msg = [IN.HISTORICAL_DATA]
+        if self.serverVersion < MIN_SERVER_VER_SYNT_REALTIME_BARS:
+            msg.append(3)
+        msg += [reqId, str(start), str(end), n]
+        price = self.script.startPrice
+        for i in range(n):
+            open_ = price
+            close = self.walk(self.walk(open_))
+            high = max(open_, close) + 0.01
+            low = min(open_, close) - 0.01
+            msg += [str(start + i * step), open_, high, low, close,
+                    self.rng.randint(1, 100) * 100, round((open_ + close) / 2, 3)]
+            if self.serverVersion < MIN_SERVER_VER_SYNT_REALTIME_BARS:
+                msg.append("false")
+            msg.append(self.rng.randint(1, 50))
+            price = close
+        self.send(makeMsg(*msg))
+
+    def handleReqRealTimeBars(self, fields):
+        reqId = int(fields[2])
+        now = int(time.time()) // 5 * 5
+        price = self.script.startPrice
+        for i in range(self.script.realTimeBarsPerRequest):
+            open_ = price
+            close = self.walk(open_)
+            self.send(makeMsg(IN.REAL_TIME_BARS, 3, reqId, now + 5 * i, open_,
+                              max(open_, close), min(open_, close), close,
+                              self.rng.randint(1, 100) * 100,
+                              round((open_ + close) / 2, 3), self.rng.randint(1, 20)))
+            price = close
+
+    def sendOrderStatus(self, orderId, status, filled, remaining, avgFillPrice,
+                        permId, lastFillPrice):
+        msg = [IN.ORDER_STATUS]
+        if self.serverVersion < MIN_SERVER_VER_MARKET_CAP_PRICE:
+            msg.append(6)
+        msg += [orderId, status, filled, remaining, avgFillPrice, permId, 0,
+                lastFillPrice, 0, ""]
+        if self.serverVersion >= MIN_SERVER_VER_MARKET_CAP_PRICE:
+            msg.append(0.)
+        self.send(makeMsg(*msg))
+
+    def handlePlaceOrder(self, fields):
+        idx = 1 if self.serverVersion >= MIN_SERVER_VER_ORDER_CONTAINER else 2
+        orderId = int(fields[idx])
+        self.nextOrderId = max(self.nextOrderId, orderId + 1)
+        self.permId += 1
+        quantity = 100.
+        price = self.script.startPrice
+        self.sendOrderStatus(orderId, "PreSubmitted", 0., quantity, 0., self.permId, 0.)
+        self.sendOrderStatus(orderId, "Submitted", 0., quantity, 0., self.permId, 0.)
+        nFills = self.script.fillsPerOrder
+        filled = 0.
+        notional = 0.
+        for i in range(nFills):
+            fillQty = quantity / nFills
+            filled += fillQty
+            notional += fillQty * price
+            status = "Filled" if i == nFills - 1 else "Submitted"
+            self.sendOrderStatus(orderId, status, filled, quantity - filled,
+                                 notional / filled, self.permId, price)
+            price = self.walk(price)
+
+
+class MockGateway(Object):
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 script: MockScript = None, serverVersion: int = MAX_CLIENT_VER,
+                 sessionClass=MockSession):
+        self.host = host
+        self.port = port
+        self.script = script or MockScript()
+        self.serverVersion = serverVersion
+        self.sessionClass = sessionClass
+        self.server = None
+        self.thread = None
+
+    def _makeServer(self):
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port),
+                                                      self.sessionClass)
+        self.server.daemon_threads = True
+        self.server.gateway = self
+        self.port = self.server.server_address[1]
+
+    def start(self) -> int:
+        """ serves on a background thread, returns the port listened to """
+        self._makeServer()
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name="MockGateway", daemon=True)
+        self.thread.start()
+        return self.port
+
+    def serveForever(self):
+        self._makeServer()
+        self.server.serve_forever()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def main():
+    cmdLineParser = argparse.ArgumentParser("mock TWS gateway")
+    cmdLineParser.add_argument("-p", "--port", type=int, default=7497,
+                               help="The TCP port to listen to")
+    cmdLineParser.add_argument("--ticks", type=int, default=100,
+                               help="tickPrice per reqMktData")
+    cmdLineParser.add_argument("--tbt", type=int, default=100,
+                               help="ticks per reqTickByTickData")
+    cmdLineParser.add_argument("--depth", type=int, default=100,
+                               help="depth updates per reqMktDepth")
+    cmdLineParser.add_argument("--l2", action="store_true", default=False,
+                               help="send updateMktDepthL2 instead of updateMktDepth")
+    cmdLineParser.add_argument("--bars", type=int, default=100,
+                               help="bars per reqHistoricalData")
+    cmdLineParser.add_argument("--fills", type=int, default=1,
+                               help="fills per placed order")
+    args = cmdLineParser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    script = MockScript(ticksPerRequest=args.ticks, tickByTickPerRequest=args.tbt,
+                        depthUpdatesPerRequest=args.depth, depthL2=args.l2,
+                        barsPerRequest=args.bars, fillsPerOrder=args.fills)
+    gateway = MockGateway(port=args.port, script=script)
+    print("MockGateway listening on port", args.port)
+    try:
+        gateway.serveForever()
+    except KeyboardInterrupt:
+        gateway.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""
+Multiprocess callback dispatch: the callbacks of the market data requests
+run in worker processes, partitioned by reqId.
+
+The front process owns the socket. Instead of EClient.run() it runs
+MultiprocessDispatcher.run(), which for every message only reads the message
+id and the reqId (a split of the first few fields) and copies the raw
+message into the shared memory ring of worker reqId % nWorkers. Each worker
+decodes its messages with the stock Decoder and calls its own wrapper, built
+in the worker by wrapperFactory(workerIndex), so decoding and the per-tick
+work (books, bars, greeks, ...) spread over the cores and never stall the
+socket reader. The messages of a reqId are always handled in order, by the
+same worker.
+
+Only the streams go to the workers: ticks, depth, real time bars,
+tick-by-tick, history updates, PnL. The answers which complete a request
+(historical bars, contract details, scanner results, snapshot ends, option
+parameters, ...) are decoded in the front process, as are the messages
+without a reqId (orders, executions, accounts, nextValidId, ...): the front
+wrapper is the one which sent the requests, keeps their bookkeeping
+(schedulers, caches, futures) and is the only one able to send more. So are
+the streams of the reqIds the front wants for itself (frontReqId(reqId),
+e.g. the option chains it computes greeks for). Errors go to the front and,
+when they carry a reqId of a worker, to that worker as well (e.g. 317,
+market depth reset).
+
+Raw messages rather than decoded objects cross the process boundary: they
+are already the most compact encoding, and decoding is part of the work to
+spread.
+
+    dispatcher = MultiprocessDispatcher(app, BookWorker, nWorkers=4,
+                                        frontReqId=app.frontReqId)
+    app.connect("127.0.0.1", 7497, 0)
+    dispatcher.start()
+    dispatcher.run()                     # instead of app.run()
+"""
+
+import inspect
+import logging
+import multiprocessing
+import multiprocessing.shared_memory
+import queue
+import signal
+import struct
+import time
+
+from ibapi import comm
+from ibapi.client import EClient
+from ibapi.decoder import Decoder
+from ibapi.message import IN
+from ibapi.object_implem import Object
+from ibapi.server_versions import MIN_SERVER_VER_PRICE_BASED_VOLATILITY
+
+logger = logging.getLogger(__name__)
+
+# position of the reqId among the fields of the messages decoded by a proc
+# handler (the msgId being field 0); the others carry no reqId
+_PROC_REQ_ID_FIELDS = {
+    IN.TICK_PRICE: 2,
+    IN.CONTRACT_DATA: 2,
+    IN.BOND_CONTRACT_DATA: 2,
+    IN.SCANNER_DATA: 2,
+    IN.REAL_TIME_BARS: 2,
+    IN.DELTA_NEUTRAL_VALIDATION: 2,
+    IN.POSITION_MULTI: 2,
+    IN.MARKET_DEPTH_L2: 2,
+    IN.HISTORICAL_DATA_UPDATE: 1,
+    IN.SECURITY_DEFINITION_OPTION_PARAMETER: 1,
+    IN.SECURITY_DEFINITION_OPTION_PARAMETER_END: 1,
+    IN.SOFT_DOLLAR_TIERS: 1,
+    IN.SYMBOL_SAMPLES: 1,
+    IN.SMART_COMPONENTS: 1,
+    IN.TICK_REQ_PARAMS: 1,
+    IN.HEAD_TIMESTAMP: 1,
+    IN.TICK_NEWS: 1,
+    IN.NEWS_ARTICLE: 1,
+    IN.HISTORICAL_NEWS: 1,
+    IN.HISTORICAL_NEWS_END: 1,
+    IN.HISTOGRAM_DATA: 1,
+    IN.REROUTE_MKT_DATA_REQ: 1,
+    IN.REROUTE_MKT_DEPTH_REQ: 1,
+    IN.PNL: 1,
+    IN.PNL_SINGLE: 1,
+    IN.HISTORICAL_TICKS: 1,
+    IN.HISTORICAL_TICKS_BID_ASK: 1,
+    IN.HISTORICAL_TICKS_LAST: 1,
+    IN.TICK_BY_TICK: 1,
+}
+
+# order related messages and the answers completing a request stay with the
+# front, whatever id they carry
+_FRONT_ONLY = (IN.ORDER_STATUS, IN.OPEN_ORDER, IN.EXECUTION_DATA,
+               IN.EXECUTION_DATA_END, IN.COMMISSION_REPORT, IN.ORDER_BOUND,
+               IN.NEXT_VALID_ID, IN.COMPLETED_ORDER,
+               IN.HISTORICAL_DATA, IN.CONTRACT_DATA, IN.BOND_CONTRACT_DATA,
+               IN.CONTRACT_DATA_END, IN.SCANNER_DATA, IN.TICK_SNAPSHOT_END,
+               IN.SECURITY_DEFINITION_OPTION_PARAMETER,
+               IN.SECURITY_DEFINITION_OPTION_PARAMETER_END, IN.HEAD_TIMESTAMP,
+               IN.HISTOGRAM_DATA, IN.HISTORICAL_TICKS, IN.HISTORICAL_TICKS_BID_ASK,
+               IN.HISTORICAL_TICKS_LAST, IN.SYMBOL_SAMPLES, IN.FUNDAMENTAL_DATA,
+               IN.HISTORICAL_NEWS, IN.HISTORICAL_NEWS_END, IN.NEWS_ARTICLE,
+               IN.SMART_COMPONENTS, IN.SOFT_DOLLAR_TIERS, IN.ACCOUNT_SUMMARY,
+               IN.ACCOUNT_SUMMARY_END, IN.POSITION_MULTI, IN.POSITION_MULTI_END,
+               IN.ACCOUNT_UPDATE_MULTI, IN.ACCOUNT_UPDATE_MULTI_END,
+               IN.DELTA_NEUTRAL_VALIDATION)
+
+
+def reqIdFields(serverVersion: int) -> dict:
+    """ msgId -> position of the reqId field, for the messages that have one """
+    fields = {}
+    for (msgId, handleInfo) in Decoder.msgId2handleInfo.items():
+        if msgId in _FRONT_ONLY:
+            continue
+        if handleInfo.wrapperMeth is not None:
+            # wrapper signature handlers: msgId, version, then the arguments
+            params = [name for name in inspect.signature(handleInfo.wrapperMeth).parameters
+                      if name != "self"]
+            if params and params[0] in ("reqId", "tickerId", "reqID"):
+                fields[msgId] = 2
+        elif msgId in _PROC_REQ_ID_FIELDS:
+            fields[msgId] = _PROC_REQ_ID_FIELDS[msgId]
+    # the version field was dropped from it by later servers
+    fields[IN.TICK_OPTION_COMPUTATION] = \
+        1 if serverVersion >= MIN_SERVER_VER_PRICE_BASED_VOLATILITY else 2
+    return fields
+
+
+# ring layout: head (written by the producer) and tail (written by the
+# consumer) on their own cache lines, then the data; a record is a u32 length
+# and the message, padded to 4 bytes
+_COUNTER = struct.Struct("<Q")
+_LENGTH = struct.Struct("<I")
+_HEAD_OFFSET = 0
+_TAIL_OFFSET = 64
+_DATA_OFFSET = 128
+# the rest of the data area is unused, the next record is at its start
+_WRAP = 0xFFFFFFFF
+# no more records
+_STOP = 0xFFFFFFFE
+
+
+def _padded(n: int) -> int:
+    return 4 + ((n + 3) & ~3)
+
+
+class ShmRing(Object):
+    """ single producer, single consumer byte ring in shared memory for
+    variable size records; the producer only writes head, the consumer only
+    tail, each publishes its counter after the record itself """
+
+    def __init__(self, capacity: int = 1 << 22, name: str = None):
+        if name is None:
+            self.shm = multiprocessing.shared_memory.SharedMemory(
+                create=True, size=_DATA_OFFSET + capacity)
+            self.shm.buf[:_DATA_OFFSET] = bytes(_DATA_OFFSET)
+        else:
+            self.shm = multiprocessing.shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.capacity = capacity
+        # the producer's own copy of head, the consumer's own copy of tail
+        self.head = _COUNTER.unpack_from(self.buf, _HEAD_OFFSET)[0]
+        self.tail = _COUNTER.unpack_from(self.buf, _TAIL_OFFSET)[0]
+        # the last tail the producer read, the consumer is at least there
+        self.knownTail = self.tail
+        self.nFull = 0
+
+    def _reserve(self, need: int) -> int:
+        """ wait for room for a need bytes record, returns its position """
+        capacity = self.capacity
+        while True:
+            pos = self.head % capacity
+            toEnd = capacity - pos
+            skip = toEnd if toEnd < need else 0
+            if self.head + skip + need - self.knownTail <= capacity:
+                break
+            # only read the consumer's cache line when the old tail is short
+            self.knownTail = _COUNTER.unpack_from(self.buf, _TAIL_OFFSET)[0]
+            if self.head + skip + need - self.knownTail <= capacity:
+                break
+            # full: the consumer is behind, hold the producer back
+            self.nFull += 1
+            time.sleep(0)
+        if skip:
+            _LENGTH.pack_into(self.buf, _DATA_OFFSET + pos, _WRAP)
+            self.head += skip
+            pos = 0
+        return pos
+
+    def put(self, record: bytes):
+        n = len(record)
+        need = _padded(n)
+        if need > self.capacity:
+            raise ValueError("%d bytes record in a %d bytes ring" % (n, self.capacity))
+        pos = self._reserve(need)
+        start = _DATA_OFFSET + pos
+        self.buf[start + 4:start + 4 + n] = record
+        _LENGTH.pack_into(self.buf, start, n)
+        self.head += need
+        _COUNTER.pack_into(self.buf, _HEAD_OFFSET, self.head)
+
+    def putStop(self):
+        pos = self._reserve(4)
+        _LENGTH.pack_into(self.buf, _DATA_OFFSET + pos, _STOP)
+        self.head += 4
+        _COUNTER.pack_into(self.buf, _HEAD_OFFSET, self.head)
+
+    def drain(self, handle) -> int:
+        """ handle(record) for every record available now; returns their
+        number, -1 once the stop record is reached """
+        head = _COUNTER.unpack_from(self.buf, _HEAD_OFFSET)[0]
+        capacity = self.capacity
+        n = 0
+        while self.tail < head:
+            pos = self.tail % capacity
+            start = _DATA_OFFSET + pos
+            length = _LENGTH.unpack_from(self.buf, start)[0]
+            if length == _WRAP:
+                self.tail += capacity - pos
+                continue
+            if length == _STOP:
+                self.tail += 4
+                _COUNTER.pack_into(self.buf, _TAIL_OFFSET, self.tail)
+                return -1
+            record = bytes(self.buf[start + 4:start + 4 + length])
+            self.tail += _padded(length)
+            n += 1
+            handle(record)
+        # publishing once per batch is enough, the producer only needs room
+        _COUNTER.pack_into(self.buf, _TAIL_OFFSET, self.tail)
+        return n
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def _workerMain(ringName: str, capacity: int, wrapperFactory, workerIndex: int,
+                serverVersion: int, idleSleep: float):
+    # Ctrl-C is for the front process, which ends the workers with a stop
+    # record once the queued messages are handled
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ring = ShmRing(capacity, ringName)
+    wrapper = wrapperFactory(workerIndex)
+    decoder = Decoder(wrapper, serverVersion)
+    readFields = comm.read_fields
+    interpret = decoder.interpret
+
+    def handle(record):
+        try:
+            interpret(readFields(record))
+        except Exception:
+            logger.exception("worker %d failed on %s", workerIndex, record[:64])
+
+    idle = 0
+    try:
+        while True:
+            n = ring.drain(handle)
+            if n < 0:
+                break
+            if n:
+                idle = 0
+            else:
+                # spin a little, then sleep, while the ring is empty
+                idle += 1
+                time.sleep(0 if idle < 100 else idleSleep)
+    finally:
+        # the stream is over for this worker's wrapper
+        wrapper.connectionClosed()
+        ring.close()
+
+
+class MultiprocessDispatcher(Object):
+    def __init__(self, client: EClient, wrapperFactory, nWorkers: int = 2,
+                 ringCapacity: int = 1 << 22, idleSleep: float = 0.0005,
+                 frontReqId=None):
+        self.client = client
+        # reqIds whose streams stay with the front too
+        self.frontReqId = frontReqId
+        # called in each worker with the worker index; with the spawn start
+        # method it must be picklable (a class or a module level function)
+        self.wrapperFactory = wrapperFactory
+        self.nWorkers = nWorkers
+        self.ringCapacity = ringCapacity
+        self.idleSleep = idleSleep
+        self.rings = []
+        self.workers = []
+        self.reqIdFields = {}
+        self.nRouted = [0] * nWorkers
+        self.nFront = 0
+
+    def start(self):
+        """ to be called once connected, the workers decode with the server
+        version of the connection """
+        serverVersion = self.client.serverVersion()
+        self.reqIdFields = reqIdFields(serverVersion)
+        # spawn: the front process already runs the reader thread
+        context = multiprocessing.get_context("spawn")
+        for workerIndex in range(self.nWorkers):
+            ring = ShmRing(self.ringCapacity)
+            worker = context.Process(
+                target=_workerMain, name="Dispatch-%d" % workerIndex, daemon=True,
+                args=(ring.name, self.ringCapacity, self.wrapperFactory, workerIndex,
+                      serverVersion, self.idleSleep))
+            worker.start()
+            self.rings.append(ring)
+            self.workers.append(worker)
+
+    def worker(self, reqId: int) -> int:
+        return reqId % self.nWorkers
+
+    def dispatch(self, text: bytes):
+        """ route one raw message, decoding only what routing needs """
+        end = text.index(b"\0")
+        msgId = int(text[:end])
+        reqIdField = self.reqIdFields.get(msgId)
+        if reqIdField is None:
+            self.nFront += 1
+            self.client.decoder.interpret(comm.read_fields(text))
+            return
+        reqId = int(text.split(b"\0", reqIdField + 1)[reqIdField])
+        front = self.frontReqId is not None and self.frontReqId(reqId)
+        if msgId == IN.ERR_MSG or front:
+            self.nFront += 1
+            self.client.decoder.interpret(comm.read_fields(text))
+            if reqId < 0 or front:
+                return
+        workerIndex = reqId % self.nWorkers
+        self.nRouted[workerIndex] += 1
+        self.rings[workerIndex].put(text)
+
+    def run(self):
+        """ the message loop, instead of EClient.run() """
+        client = self.client
+        try:
+            while client.isConnected() or not client.msg_queue.empty():
+                try:
+                    try:
+                        text = client.msg_queue.get(block=True, timeout=0.2)
+                    except queue.Empty:
+                        client.msgLoopTmo()
+                    else:
+                        self.dispatch(text)
+                        client.msgLoopRec()
+                except (KeyboardInterrupt, SystemExit):
+                    client.keyboardInterrupt()
+                    client.keyboardInterruptHard()
+                except Exception:
+                    logger.exception("dispatch failed")
+        finally:
+            client.disconnect()
+            self.stop()
+
+    def stop(self, timeout: float = 10.):
+        """ let the workers handle what is queued, then end them """
+        for ring in self.rings:
+            ring.putStop()
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+        for ring in self.rings:
+            ring.close()
+            ring.unlink()
+        self.rings = []
+        self.workers = []
@@ -0,0 +1,339 @@
+"""
+Option chain builder: reqSecDefOptParams -> strike x expiry grid ->
+market data subscriptions within the market data line limit.
+
+build() sends reqSecDefOptParams and a market data request for the
+underlying at once. When both answered (the parameters and a first price),
+the chain is laid out: the nearest nExpirations expirations, the strikes
+within strikeWindow of the underlying price, calls and puts, as one block of
+consecutive reqIds so a reply finds its cell by arithmetic, the cell states
+and the GreeksEngine rows in small arrays shaped (expiration, strike, right).
+
+The option subscriptions of all the chains being built wait in one heap,
+nearest expiration first, then closest to the money. At most maxLines
+requests hold a line at any time: snapshots free theirs on tickSnapshotEnd,
+a request ended by an error frees its line (the grid makes up contracts:
+the strikes of all the expirations are reported together, some do not exist
+for some expirations) and "max number of tickers reached" puts the request
+back and lowers maxLines.
+
+    builder = OptionChainBuilder(app, app.greeks, maxLines=90)
+    chain = builder.build(underlying, nExpirations=3, strikeWindow=0.1)
+    # securityDefinitionOptionParameter(End), tickPrice, tickSnapshotEnd,
+    # error: hand them over to the builder
+    chain.done.wait(60)
+"""
+
+import bisect
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import numpy as np
+
+from ibapi.client import EClient
+from ibapi.contract import Contract
+from ibapi.object_implem import Object
+from ibapi.ticktype import TickTypeEnum
+
+from ErrorCodes import isWarning
+from GreeksEngine import GreeksEngine
+
+logger = logging.getLogger(__name__)
+
+# "Max number of tickers has been reached"
+MAX_TICKERS_REACHED = 101
+NO_SECURITY_DEFINITION = 200
+
+UNDERLYING_PRICE_TICKS = frozenset((TickTypeEnum.LAST, TickTypeEnum.DELAYED_LAST,
+                                    TickTypeEnum.CLOSE, TickTypeEnum.DELAYED_CLOSE))
+
+# cell states
+QUEUED = 0
+SUBSCRIBED = 1
+DONE = 2
+MISSING = -1
+
+RIGHTS = ("C", "P")
+
+
+class OptionChain(Object):
+    def __init__(self, reqId: int, underlying: Contract, nExpirations: int,
+                 strikeWindow: float):
+        self.reqId = reqId
+        self.underlying = underlying
+        self.nExpirations = nExpirations
+        self.strikeWindow = strikeWindow
+        self.underlyingPrice = None
+        # [(exchange, tradingClass, multiplier, expirations, strikes)]
+        self.params = []
+        self.paramsDone = False
+        self.exchange = None
+        self.tradingClass = None
+        self.multiplier = None
+        self.expirations = []
+        self.strikes = np.empty(0)
+        self.firstReqId = None
+        self.state = np.empty((0, 0, 2), dtype=np.int8)
+        # GreeksEngine rows, -1 without an engine
+        self.rows = np.empty((0, 0, 2), dtype=np.int32)
+        self.underlyingRow = None
+        self.nPending = 0
+        self.error = None
+        self.cancelled = False
+        # set once laid out (or failed), then once every cell is settled
+        self.ready = threading.Event()
+        self.done = threading.Event()
+
+    @property
+    def shape(self) -> tuple:
+        return self.state.shape
+
+    def cellReqId(self, expiry: int, strike: int, right: int) -> int:
+        return self.firstReqId + int(np.ravel_multi_index((expiry, strike, right),
+                                                          self.state.shape))
+
+    def cell(self, reqId: int) -> tuple:
+        """ (expiration index, strike index, right index) of a reqId """
+        return tuple(int(i) for i in np.unravel_index(reqId - self.firstReqId,
+                                                       self.state.shape))
+
+    def contract(self, expiry: int, strike: int, right: int) -> Contract:
+        contract = Contract()
+        contract.symbol = self.underlying.symbol
+        contract.secType = "FOP" if self.underlying.secType == "FUT" else "OPT"
+        contract.exchange = self.exchange
+        contract.currency = self.underlying.currency
+        contract.lastTradeDateOrContractMonth = self.expirations[expiry]
+        contract.strike = float(self.strikes[strike])
+        contract.right = RIGHTS[right]
+        contract.multiplier = self.multiplier
+        contract.tradingClass = self.tradingClass
+        return contract
+
+
+class OptionChainBuilder(Object):
+    def __init__(self, client: EClient, greeks: GreeksEngine = None,
+                 maxLines: int = 100, firstReqId: int = 30000000,
+                 snapshot: bool = True):
+        self.client = client
+        self.greeks = greeks
+        self.maxLines = maxLines
+        # snapshots go through the whole grid, streams keep their lines
+        self.snapshot = snapshot
+        self.firstReqId = firstReqId
+        self.nextReqId = firstReqId
+        self.chains = {}
+        self.underlyingReqId2chain = {}
+        # first reqIds of the grids, in order, and their chains
+        self.blockStarts = []
+        self.blockChains = []
+        self.queue = []
+        self.seq = itertools.count()
+        # reqIds holding a market data line
+        self.active = set()
+        # callbacks come from the reader thread, build() from anywhere
+        self.lock = threading.RLock()
+
+    def owns(self, reqId: int) -> bool:
+        """ reqId of a request of the builder, any chain """
+        return self.firstReqId <= reqId < self.nextReqId
+
+    def _allocate(self, n: int) -> int:
+        reqId = self.nextReqId
+        self.nextReqId += n
+        return reqId
+
+    def build(self, underlying: Contract, nExpirations: int = 3,
+              strikeWindow: float = 0.1) -> OptionChain:
+        """ underlying with its conId; the grid covers the strikes within
+        strikeWindow (a fraction) of the underlying price """
+        with self.lock:
+            reqId = self._allocate(2)
+            chain = OptionChain(reqId, underlying, nExpirations, strikeWindow)
+            self.chains[reqId] = chain
+            self.underlyingReqId2chain[reqId + 1] = chain
+            if self.greeks is not None:
+                chain.underlyingRow = self.greeks.addUnderlying(
+                    reqId + 1, isFuture=underlying.secType == "FUT")
+            self.active.add(reqId + 1)
+        futFopExchange = underlying.exchange if underlying.secType == "FUT" else ""
+        self.client.reqSecDefOptParams(reqId, underlying.symbol, futFopExchange,
+                                       underlying.secType, underlying.conId)
+        # the underlying keeps streaming, the greeks follow its moves
+        self.client.reqMktData(reqId + 1, underlying, "", False, False, [])
+        return chain
+
+    def _pick(self, chain: OptionChain) -> tuple:
+        """ the parameters of SMART if there, of the trading class named
+        like the underlying if there, else the ones with most expirations """
+        params = [p for p in chain.params if p[0] == "SMART"] or chain.params
+        return max(params, key=lambda p: (p[1] == chain.underlying.symbol, len(p[3])))
+
+    def _layout(self, chain: OptionChain):
+        if not chain.paramsDone or chain.underlyingPrice is None or chain.ready.is_set():
+            return
+        if not chain.params:
+            chain.error = "no option parameters for %s" % chain.underlying.symbol
+            chain.ready.set()
+            chain.done.set()
+            return
+        (chain.exchange, chain.tradingClass, chain.multiplier, expirations,
+         strikes) = self._pick(chain)
+        today = time.strftime("%Y%m%d")
+        chain.expirations = sorted(e for e in expirations if e >= today)[:chain.nExpirations]
+        price = chain.underlyingPrice
+        strikes = np.array(sorted(strikes), dtype=float)
+        chain.strikes = strikes[np.abs(strikes / price - 1.) <= chain.strikeWindow]
+        shape = (len(chain.expirations), len(chain.strikes), 2)
+        n = int(np.prod(shape))
+        chain.state = np.full(shape, QUEUED, dtype=np.int8)
+        chain.rows = np.full(shape, -1, dtype=np.int32)
+        chain.firstReqId = self._allocate(n)
+        chain.nPending = n
+        self.blockStarts.append(chain.firstReqId)
+        self.blockChains.append(chain)
+        if self.greeks is not None:
+            for (i, expiry) in enumerate(chain.expirations):
+                for (j, strike) in enumerate(chain.strikes):
+                    for (k, right) in enumerate(RIGHTS):
+                        reqId = chain.cellReqId(i, j, k)
+                        chain.rows[i, j, k] = self.greeks.addOption(
+                            reqId, chain.underlyingRow, strike, expiry, right)
+        # nearest expiration first, then closest to the money
+        distance = np.abs(chain.strikes / price - 1.)
+        (expiry, strike, right) = np.unravel_index(np.arange(n), shape)
+        for flat in np.lexsort((right, distance[strike], expiry)).tolist():
+            heapq.heappush(self.queue, (int(expiry[flat]), float(distance[strike[flat]]),
+                                        next(self.seq), chain, flat))
+        logger.info("%s chain: %d expirations x %d strikes around %f", chain.underlying.symbol,
+                    shape[0], shape[1], price)
+        chain.ready.set()
+        if n == 0:
+            chain.done.set()
+        self._pump()
+
+    def _pump(self):
+        while len(self.active) < self.maxLines and self.queue:
+            (_, _, _, chain, flat) = heapq.heappop(self.queue)
+            if chain.cancelled:
+                continue
+            reqId = chain.firstReqId + flat
+            cell = np.unravel_index(flat, chain.state.shape)
+            chain.state[cell] = SUBSCRIBED
+            self.active.add(reqId)
+            self.client.reqMktData(reqId, chain.contract(*cell), "", self.snapshot, False, [])
+
+    def _chainOf(self, reqId: int) -> OptionChain:
+        i = bisect.bisect(self.blockStarts, reqId) - 1
+        if i < 0:
+            return None
+        chain = self.blockChains[i]
+        if reqId >= chain.firstReqId + chain.state.size:
+            return None
+        return chain
+
+    def _settle(self, chain: OptionChain, reqId: int, state: int):
+        self.active.discard(reqId)
+        chain.state[chain.cell(reqId)] = state
+        chain.nPending -= 1
+        if chain.nPending == 0:
+            chain.done.set()
+        self._pump()
+
+    def securityDefinitionOptionParameter(self, reqId: int, exchange: str,
+                                          underlyingConId: int, tradingClass: str,
+                                          multiplier: str, expirations, strikes) -> bool:
+        chain = self.chains.get(reqId)
+        if chain is None:
+            return False
+        with self.lock:
+            chain.params.append((exchange, tradingClass, multiplier, expirations, strikes))
+        return True
+
+    def securityDefinitionOptionParameterEnd(self, reqId: int) -> bool:
+        chain = self.chains.get(reqId)
+        if chain is None:
+            return False
+        with self.lock:
+            chain.paramsDone = True
+            self._layout(chain)
+        return True
+
+    def tickPrice(self, reqId: int, tickType: int, price: float):
+        chain = self.underlyingReqId2chain.get(reqId)
+        if chain is None or chain.underlyingPrice is not None:
+            return
+        if price > 0 and tickType in UNDERLYING_PRICE_TICKS:
+            with self.lock:
+                chain.underlyingPrice = price
+                self._layout(chain)
+
+    def tickSnapshotEnd(self, reqId: int) -> bool:
+        with self.lock:
+            chain = self._chainOf(reqId)
+            if chain is None or reqId not in self.active:
+                return False
+            self._settle(chain, reqId, DONE)
+        return True
+
+    def error(self, reqId: int, errorCode: int, errorString: str) -> bool:
+        """ True if the error was about a chain request and is taken care of """
+        with self.lock:
+            chain = self.chains.get(reqId)
+            if chain is not None:
+                chain.error = "%d: %s" % (errorCode, errorString)
+                chain.ready.set()
+                chain.done.set()
+                return True
+            chain = self.underlyingReqId2chain.get(reqId)
+            if chain is not None:
+                if isWarning(errorCode):
+                    return False
+                self.active.discard(reqId)
+                # without an underlying price there is no grid; a grid
+                # already laid out goes on with the last price
+                if not chain.ready.is_set():
+                    chain.error = "%d: %s" % (errorCode, errorString)
+                    chain.ready.set()
+                    chain.done.set()
+                self._pump()
+                return True
+            chain = self._chainOf(reqId)
+            if chain is None or reqId not in self.active:
+                return False
+            if errorCode == MAX_TICKERS_REACHED:
+                # back in the queue, in front, with one line less from now on
+                self.active.discard(reqId)
+                (i, j, k) = chain.cell(reqId)
+                chain.state[i, j, k] = QUEUED
+                heapq.heappush(self.queue, (-1, 0., next(self.seq), chain,
+                                            reqId - chain.firstReqId))
+                self.maxLines = max(1, len(self.active))
+                logger.warning("market data lines limited to %d", self.maxLines)
+                return True
+            if isWarning(errorCode):
+                return False
+            self._settle(chain, reqId, MISSING)
+            # the strikes of all the expirations come together, some of
+            # the grid does not exist: not worth a message
+            return errorCode == NO_SECURITY_DEFINITION
+
+    def cancel(self, chain: OptionChain):
+        """ stop a chain: its streams and its underlying are cancelled, what
+        is still queued is dropped """
+        with self.lock:
+            chain.cancelled = True
+            reqIds = [reqId for reqId in self.active
+                      if chain.firstReqId is not None
+                      and 0 <= reqId - chain.firstReqId < chain.state.size]
+            reqIds.append(chain.reqId + 1)
+            for reqId in reqIds:
+                self.active.discard(reqId)
+            chain.done.set()
+        for reqId in reqIds:
+            self.client.cancelMktData(reqId)
+        with self.lock:
+            self._pump()
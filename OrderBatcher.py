@@ -0,0 +1,185 @@
+"""
+Batch order placement: many (Contract, Order) pairs, one id range, one write.
+
+OrderBatcher.submit() takes the pairs of a basket, bracket sets from
+OrderSamples.BracketOrder, OCA groups from OrderSamples.OneCancelsAll, ...
+and
+    - allocates a contiguous range of order ids in one step under a lock, so
+      concurrent submitters and nextOrderId() never hand out the same id
+    - renumbers the orders into that range, in list order: ids already set
+      on the orders (BracketOrder numbers its parent and children) are taken
+      as batch local and a parentId points at the latest order before it
+      with that local id, so a basket of BracketOrder(1, ...) sets works
+    - encodes every placeOrder as usual but buffers the frames, then sends
+      them with a single sendall(); the client's sendMsg is wrapped once, it
+      only buffers on the thread encoding a batch, requests sent meanwhile
+      from other threads go out as usual
+    - tracks the acknowledgement of every order: the first openOrder or
+      orderStatus acks it, an order error before that rejects it; the batch
+      future resolves when every order is acked or rejected.
+Note TWS still paces the messages it reads (50/s by default), a large basket
+is written at once but not necessarily accepted at once.
+
+    batcher = OrderBatcher(app)          # app is the EClient and the EWrapper
+    # nextValidId: batcher.reset(orderId)
+    # openOrder / orderStatus / error: hand them over to the batcher
+    batch = batcher.submit([(contract, order) for order in
+                            OrderSamples.BracketOrder(1, "BUY", 100, 30, 40, 20)])
+    batch.wait(5)
+"""
+
+import concurrent.futures
+import logging
+import threading
+import time
+
+from ibapi import comm
+from ibapi.client import EClient
+from ibapi.object_implem import Object
+
+from ErrorCodes import isWarning
+
+logger = logging.getLogger(__name__)
+
+
+class OrderBatch(Object):
+    def __init__(self, orderIds: list):
+        self.orderIds = orderIds
+        # orderId -> status it was acknowledged with
+        self.statuses = {}
+        # orderId -> (errorCode, errorString) of the rejected ones
+        self.rejected = {}
+        self.nPending = len(orderIds)
+        self.future = concurrent.futures.Future()
+        self.sentAt = None
+        self.doneAt = None
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def wait(self, timeout: float = None) -> "OrderBatch":
+        """ blocks until every order is acked or rejected """
+        return self.future.result(timeout)
+
+    def latency(self) -> float:
+        """ seconds from the write to the last acknowledgement """
+        return None if self.doneAt is None else self.doneAt - self.sentAt
+
+
+class OrderBatcher(Object):
+    def __init__(self, client: EClient):
+        self.client = client
+        self.nextId = None
+        self.orderId2batch = {}
+        self.lock = threading.Lock()
+        # .frames: the frames captured by this thread, while it encodes
+        self.capturing = threading.local()
+        send = client.sendMsg
+
+        def sendMsg(msg):
+            frames = getattr(self.capturing, "frames", None)
+            if frames is None:
+                return send(msg)
+            frames.append(comm.make_msg(msg))
+        client.sendMsg = sendMsg
+
+    def reset(self, nextValidId: int):
+        """ from nextValidId; never goes back on ids already handed out """
+        with self.lock:
+            if self.nextId is None or nextValidId > self.nextId:
+                self.nextId = nextValidId
+
+    def allocate(self, n: int) -> range:
+        with self.lock:
+            if self.nextId is None:
+                raise RuntimeError("no order id yet, nextValidId not received")
+            ids = range(self.nextId, self.nextId + n)
+            self.nextId += n
+        return ids
+
+    @staticmethod
+    def renumber(orders: list, orderIds: range):
+        """ give the orders their final ids, parentIds follow; parents come
+        before their children, as TWS wants them anyway """
+        local2id = {}
+        for (order, orderId) in zip(orders, orderIds):
+            if order.parentId:
+                order.parentId = local2id.get(order.parentId, order.parentId)
+            if order.orderId:
+                local2id[order.orderId] = orderId
+            order.orderId = orderId
+
+    def encode(self, pairs: list) -> bytes:
+        """ the placeOrder frames of the pairs, back to back """
+        frames = []
+        # EClient.placeOrder validates and builds the message, then hands it
+        # to sendMsg: take it there
+        self.capturing.frames = frames
+        try:
+            for (contract, order) in pairs:
+                self.client.placeOrder(order.orderId, contract, order)
+        finally:
+            self.capturing.frames = None
+        return b"".join(frames)
+
+    def submit(self, pairs: list) -> OrderBatch:
+        pairs = list(pairs)
+        orderIds = self.allocate(len(pairs))
+        self.renumber([order for (_, order) in pairs], orderIds)
+        batch = OrderBatch(list(orderIds))
+        with self.lock:
+            for orderId in orderIds:
+                self.orderId2batch[orderId] = batch
+        try:
+            data = self.encode(pairs)
+            batch.sentAt = time.perf_counter()
+            conn = self.client.conn
+            if conn is None:
+                raise ConnectionError("not connected, batch of %d orders not sent"
+                                      % len(pairs))
+            with conn.lock:
+                if not conn.isConnected():
+                    raise ConnectionError("not connected, batch of %d orders not sent"
+                                          % len(pairs))
+                conn.socket.sendall(data)
+        except Exception:
+            # nothing of the batch will be acknowledged
+            with self.lock:
+                for orderId in orderIds:
+                    self.orderId2batch.pop(orderId, None)
+            raise
+        logger.info("sent %d orders, ids %d to %d, %d bytes", len(pairs),
+                    orderIds[0] if pairs else 0, orderIds[-1] if pairs else 0, len(data))
+        if not pairs:
+            self._finish(batch)
+        return batch
+
+    def _finish(self, batch: OrderBatch):
+        batch.doneAt = time.perf_counter()
+        batch.future.set_result(batch)
+
+    def _settle(self, orderId: int, status: str = None, error: tuple = None):
+        with self.lock:
+            batch = self.orderId2batch.pop(orderId, None)
+        if batch is None:
+            return
+        if error is None:
+            batch.statuses[orderId] = status
+        else:
+            batch.rejected[orderId] = error
+        batch.nPending -= 1
+        if batch.nPending == 0:
+            self._finish(batch)
+
+    def openOrder(self, orderId: int, status: str):
+        self._settle(orderId, status)
+
+    def orderStatus(self, orderId: int, status: str):
+        self._settle(orderId, status)
+
+    def error(self, reqId: int, errorCode: int, errorString: str) -> bool:
+        """ True if reqId is an order of a batch still waiting for its ack """
+        if isWarning(errorCode) or reqId not in self.orderId2batch:
+            return False
+        self._settle(reqId, error=(errorCode, errorString))
+        return True
@@ -0,0 +1,249 @@
+"""
+Incremental order books fed by updateMktDepth / updateMktDepthL2.
+
+TWS sends depth as row operations: insert a row at a position (the rows
+below move down), update the row at a position, delete it (the rows below
+move up); row 0 is the best price. Each side keeps its rows in preallocated
+NumPy arrays, the market maker (or exchange for smart depth) of every row
+next to them, plus running totals of size and price * size, so that
+    best bid/ask, spread, mid, micro price   O(1)
+    total size, depth weighted mid           O(1)
+    cumulative size down to a level          O(1) after the first query
+                                             following an update
+An insert or delete shifts the rows below it, a memmove of a few dozen
+floats at most.
+
+    books = OrderBooks()
+    books.updateMktDepthL2(reqId, position, marketMaker, operation, side,
+                           price, size, isSmartDepth)    # from the wrapper
+    book = books.book(reqId)
+    book.bestBid(), book.depthWeightedMid(), book.cumulativeSize(SIDE_BID, 5)
+"""
+
+import numpy as np
+
+from ibapi.object_implem import Object
+
+OPERATION_INSERT = 0
+OPERATION_UPDATE = 1
+OPERATION_DELETE = 2
+
+SIDE_ASK = 0
+SIDE_BID = 1
+
+# "Market depth data has been RESET. Please empty deep book contents before
+# applying any new entries."
+MARKET_DEPTH_RESET = 317
+
+
+class BookSide(Object):
+    def __init__(self, capacity: int = 64):
+        self.price = np.zeros(capacity)
+        self.size = np.zeros(capacity)
+        self.marketMakers = [""] * capacity
+        self.count = 0
+        self.totalSize = 0.
+        self.totalNotional = 0.
+        self.cumSize = np.zeros(capacity)
+        self.cumDirty = False
+
+    def _grow(self, minCapacity: int):
+        capacity = len(self.price)
+        while capacity < minCapacity:
+            capacity *= 2
+        for name in ("price", "size", "cumSize"):
+            old = getattr(self, name)
+            new = np.zeros(capacity)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self.marketMakers += [""] * (capacity - len(self.marketMakers))
+
+    def _add(self, price: float, size: float):
+        self.totalSize += size
+        self.totalNotional += price * size
+
+    def _remove(self, position: int):
+        self.totalSize -= self.size[position]
+        self.totalNotional -= self.price[position] * self.size[position]
+
+    def insert(self, position: int, price: float, size: float, marketMaker: str = ""):
+        position = min(position, self.count)
+        if self.count == len(self.price):
+            self._grow(self.count + 1)
+        n = self.count
+        if position < n:
+            self.price[position + 1:n + 1] = self.price[position:n]
+            self.size[position + 1:n + 1] = self.size[position:n]
+            self.marketMakers[position + 1:n + 1] = self.marketMakers[position:n]
+        self.price[position] = price
+        self.size[position] = size
+        self.marketMakers[position] = marketMaker
+        self.count = n + 1
+        self._add(price, size)
+        self.cumDirty = True
+
+    def update(self, position: int, price: float, size: float, marketMaker: str = ""):
+        if position >= self.count:
+            # an update past the last row is how some feeds add a level
+            self.insert(position, price, size, marketMaker)
+            return
+        self._remove(position)
+        self.price[position] = price
+        self.size[position] = size
+        self.marketMakers[position] = marketMaker
+        self._add(price, size)
+        self.cumDirty = True
+
+    def delete(self, position: int):
+        n = self.count
+        if position >= n:
+            return
+        self._remove(position)
+        self.price[position:n - 1] = self.price[position + 1:n]
+        self.size[position:n - 1] = self.size[position + 1:n]
+        self.marketMakers[position:n - 1] = self.marketMakers[position + 1:n]
+        self.price[n - 1] = 0.
+        self.size[n - 1] = 0.
+        self.marketMakers[n - 1] = ""
+        self.count = n - 1
+        if self.count == 0:
+            # no rounding left over from the running sums
+            self.totalSize = 0.
+            self.totalNotional = 0.
+        self.cumDirty = True
+
+    def clear(self):
+        self.price[:self.count] = 0.
+        self.size[:self.count] = 0.
+        for i in range(self.count):
+            self.marketMakers[i] = ""
+        self.count = 0
+        self.totalSize = 0.
+        self.totalNotional = 0.
+        self.cumDirty = True
+
+    def vwap(self) -> float:
+        return self.totalNotional / self.totalSize if self.totalSize > 0 else np.nan
+
+    def cumulativeSize(self, levels: int) -> float:
+        """ size of the best levels rows """
+        if levels <= 0 or self.count == 0:
+            return 0.
+        if self.cumDirty:
+            np.cumsum(self.size[:self.count], out=self.cumSize[:self.count])
+            self.cumDirty = False
+        return self.cumSize[min(levels, self.count) - 1]
+
+
+class OrderBook(Object):
+    def __init__(self, reqId: int, capacity: int = 64):
+        self.reqId = reqId
+        self.sides = (BookSide(capacity), BookSide(capacity))
+        self.asks = self.sides[SIDE_ASK]
+        self.bids = self.sides[SIDE_BID]
+        self.isSmartDepth = False
+        self.nUpdates = 0
+
+    def apply(self, position: int, operation: int, side: int, price: float,
+              size: float, marketMaker: str = ""):
+        bookSide = self.sides[side]
+        if operation == OPERATION_UPDATE:
+            bookSide.update(position, price, size, marketMaker)
+        elif operation == OPERATION_INSERT:
+            bookSide.insert(position, price, size, marketMaker)
+        elif operation == OPERATION_DELETE:
+            bookSide.delete(position)
+        self.nUpdates += 1
+
+    def clear(self):
+        self.asks.clear()
+        self.bids.clear()
+
+    def bestBid(self) -> float:
+        return self.bids.price[0] if self.bids.count else np.nan
+
+    def bestAsk(self) -> float:
+        return self.asks.price[0] if self.asks.count else np.nan
+
+    def bestBidSize(self) -> float:
+        return self.bids.size[0] if self.bids.count else 0.
+
+    def bestAskSize(self) -> float:
+        return self.asks.size[0] if self.asks.count else 0.
+
+    def spread(self) -> float:
+        return self.bestAsk() - self.bestBid()
+
+    def mid(self) -> float:
+        return (self.bestAsk() + self.bestBid()) / 2
+
+    def microPrice(self) -> float:
+        """ top of book mid weighted by the size on the other side """
+        bidSize = self.bestBidSize()
+        askSize = self.bestAskSize()
+        if bidSize + askSize <= 0:
+            return np.nan
+        return (self.bestBid() * askSize + self.bestAsk() * bidSize) / (bidSize + askSize)
+
+    def depthWeightedMid(self) -> float:
+        """ mid of the size weighted average prices of both whole sides """
+        return (self.bids.vwap() + self.asks.vwap()) / 2
+
+    def totalSize(self, side: int) -> float:
+        return self.sides[side].totalSize
+
+    def cumulativeSize(self, side: int, levels: int) -> float:
+        return self.sides[side].cumulativeSize(levels)
+
+    def imbalance(self, levels: int) -> float:
+        """ (bid - ask) / (bid + ask) size over the best levels rows """
+        bid = self.bids.cumulativeSize(levels)
+        ask = self.asks.cumulativeSize(levels)
+        return (bid - ask) / (bid + ask) if bid + ask > 0 else 0.
+
+    def levels(self, side: int, n: int = None) -> tuple:
+        """ (prices, sizes, marketMakers) of the best n rows, the arrays are
+        views and change with the book """
+        bookSide = self.sides[side]
+        n = bookSide.count if n is None else min(n, bookSide.count)
+        return (bookSide.price[:n], bookSide.size[:n], bookSide.marketMakers[:n])
+
+    def __str__(self):
+        return "OrderBook. ReqId: %d, Bid: %s x %s, Ask: %s x %s, Rows: %d/%d" % (
+            self.reqId, self.bestBid(), self.bestBidSize(), self.bestAsk(),
+            self.bestAskSize(), self.bids.count, self.asks.count)
+
+
+class OrderBooks(Object):
+    """ one book per market depth reqId, created on its first update """
+
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        self.books = {}
+
+    def book(self, reqId: int) -> OrderBook:
+        book = self.books.get(reqId)
+        if book is None:
+            book = OrderBook(reqId, self.capacity)
+            self.books[reqId] = book
+        return book
+
+    def updateMktDepth(self, reqId: int, position: int, operation: int, side: int,
+                       price: float, size: int):
+        self.book(reqId).apply(position, operation, side, price, size)
+
+    def updateMktDepthL2(self, reqId: int, position: int, marketMaker: str,
+                         operation: int, side: int, price: float, size: int,
+                         isSmartDepth: bool):
+        book = self.book(reqId)
+        book.isSmartDepth = isSmartDepth
+        book.apply(position, operation, side, price, size, marketMaker)
+
+    def reset(self, reqId: int):
+        """ TWS asks to empty the book before new entries (error 317) """
+        book = self.books.get(reqId)
+        if book is not None:
+            book.clear()
+
+    def remove(self, reqId: int):
+        self.books.pop(reqId, None)
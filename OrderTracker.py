@@ -0,0 +1,254 @@
+"""
+Order state machine fed by openOrder, orderStatus, execDetails,
+commissionReport and completedOrder.
+
+Every order gets a dense row (index into parallel per field lists), found in
+O(1) by orderId, by permId or through one of its execIds. The callbacks only
+update the row they touch: the status moves forward (a late PreSubmitted
+after Filled is ignored), fills add their quantity and notional, a corrected
+execution (same execId but the last part) replaces the one it corrects and
+commissions are added to the fill and its order. The working orders are kept
+as a set, updated on every transition, so no query scans the orders.
+
+The permId is the key of an order once known, the orderId (unique per
+client only) until then; orderId queries answer about the latest order
+with that id. Orders without an orderId (placed from TWS) are only indexed
+by permId.
+
+    tracker = OrderTracker()
+    # openOrder/orderStatus/execDetails/commissionReport/completedOrder:
+    #     hand them over to the tracker
+    tracker.working()        # [orderId, ...]
+    tracker.avgPrice(orderId)
+    tracker.fills(orderId)   # [Fill, ...]
+"""
+
+import threading
+
+from ibapi.commission_report import CommissionReport
+from ibapi.contract import Contract
+from ibapi.execution import Execution
+from ibapi.object_implem import Object
+from ibapi.order import Order
+from ibapi.order_state import OrderState
+
+WORKING_STATUSES = frozenset(("PendingSubmit", "PendingCancel", "PreSubmitted",
+                              "Submitted", "ApiPending"))
+# no way back from these
+FINAL_STATUSES = frozenset(("Filled", "Cancelled", "ApiCancelled"))
+
+
+def execBase(execId: str) -> str:
+    """ execId without its revision: corrections of an execution only change
+    the last part """
+    return execId.rpartition(".")[0] or execId
+
+
+class Fill(Object):
+    def __init__(self, execId: str, time_: str, shares: float, price: float):
+        self.execId = execId
+        self.time = time_
+        self.shares = shares
+        self.price = price
+        self.commission = 0.
+        self.realizedPNL = None
+
+    def __str__(self):
+        return "ExecId: %s, Time: %s, Shares: %f, Price: %f, Commission: %f" % (
+            self.execId, self.time, self.shares, self.price, self.commission)
+
+
+class OrderTracker(Object):
+    def __init__(self):
+        self.orderId2row = {}
+        self.permId2row = {}
+        # execBase -> (row, Fill)
+        self.exec2fill = {}
+        # one entry per row
+        self.orderIds = []
+        self.permIds = []
+        self.contracts = []
+        self.orders = []
+        self.statuses = []
+        self.filled = []
+        self.remaining = []
+        self.avgFillPrices = []
+        self.execShares = []
+        self.execNotional = []
+        self.commissions = []
+        self.rowFills = []
+        self.workingRows = set()
+        self.nTransitions = 0
+        self.nIgnored = 0
+        # callbacks come from the reader thread, queries from anywhere
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.orderIds)
+
+    def _row(self, orderId: int, permId: int) -> int:
+        # permIds are unique, orderIds only per client (reqAllOpenOrders
+        # brings the orders of the others): a row already holding another
+        # permId is another order
+        row = self.permId2row.get(permId) if permId else None
+        if row is None and orderId:
+            row = self.orderId2row.get(orderId)
+            if row is not None and permId and self.permIds[row] not in (0, permId):
+                row = None
+        if row is None:
+            row = len(self.orderIds)
+            self.orderIds.append(0)
+            self.permIds.append(permId)
+            self.contracts.append(None)
+            self.orders.append(None)
+            self.statuses.append("")
+            self.filled.append(0.)
+            self.remaining.append(0.)
+            self.avgFillPrices.append(0.)
+            self.execShares.append(0.)
+            self.execNotional.append(0.)
+            self.commissions.append(0.)
+            self.rowFills.append([])
+        # ids learned later (permId after submission) are indexed then; an
+        # orderId goes to the latest order taking it, not back and forth
+        if orderId and self.orderIds[row] != orderId:
+            self.orderIds[row] = orderId
+            self.orderId2row[orderId] = row
+        if permId:
+            self.permIds[row] = permId
+            self.permId2row[permId] = row
+        return row
+
+    def _transition(self, row: int, status: str):
+        current = self.statuses[row]
+        if status == current or not status:
+            return
+        if current in FINAL_STATUSES:
+            self.nIgnored += 1
+            return
+        self.statuses[row] = status
+        self.nTransitions += 1
+        if status in WORKING_STATUSES:
+            self.workingRows.add(row)
+        else:
+            self.workingRows.discard(row)
+
+    def openOrder(self, orderId: int, contract: Contract, order: Order,
+                  orderState: OrderState):
+        with self.lock:
+            row = self._row(orderId, order.permId)
+            self.contracts[row] = contract
+            self.orders[row] = order
+            self._transition(row, orderState.status)
+
+    def orderStatus(self, orderId: int, status: str, filled: float,
+                    remaining: float, avgFillPrice: float, permId: int,
+                    parentId: int, lastFillPrice: float, clientId: int,
+                    whyHeld: str, mktCapPrice: float):
+        with self.lock:
+            row = self._row(orderId, permId)
+            # statuses can come out of order, the filled quantity only grows
+            if filled >= self.filled[row]:
+                self.filled[row] = filled
+                self.remaining[row] = remaining
+                self.avgFillPrices[row] = avgFillPrice
+            self._transition(row, status)
+
+    def completedOrder(self, contract: Contract, order: Order,
+                       orderState: OrderState):
+        with self.lock:
+            row = self._row(order.orderId, order.permId)
+            self.contracts[row] = contract
+            self.orders[row] = order
+            self._transition(row, orderState.status)
+
+    def execDetails(self, reqId: int, contract: Contract, execution: Execution):
+        with self.lock:
+            row = self._row(execution.orderId, execution.permId)
+            if self.contracts[row] is None:
+                self.contracts[row] = contract
+            base = execBase(execution.execId)
+            corrected = self.exec2fill.get(base)
+            if corrected is not None:
+                (_, fill) = corrected
+                if fill.execId >= execution.execId:
+                    # the same execution again (reqExecutions), or older
+                    return
+                self.execShares[row] -= fill.shares
+                self.execNotional[row] -= fill.shares * fill.price
+                self.rowFills[row].remove(fill)
+            fill = Fill(execution.execId, execution.time, execution.shares,
+                        execution.price)
+            if corrected is not None:
+                fill.commission = corrected[1].commission
+            self.exec2fill[base] = (row, fill)
+            self.rowFills[row].append(fill)
+            self.execShares[row] += fill.shares
+            self.execNotional[row] += fill.shares * fill.price
+
+    def commissionReport(self, commissionReport: CommissionReport):
+        with self.lock:
+            entry = self.exec2fill.get(execBase(commissionReport.execId))
+            if entry is None:
+                return
+            (row, fill) = entry
+            self.commissions[row] += commissionReport.commission - fill.commission
+            fill.commission = commissionReport.commission
+            fill.realizedPNL = commissionReport.realizedPNL
+
+    # queries, all O(1) but working()
+    def rowOf(self, orderId: int = None, permId: int = None, execId: str = None) -> int:
+        """ row of an order, None if unknown """
+        if orderId:
+            return self.orderId2row.get(orderId)
+        if permId:
+            return self.permId2row.get(permId)
+        if execId:
+            entry = self.exec2fill.get(execBase(execId))
+            return None if entry is None else entry[0]
+        return None
+
+    def status(self, orderId: int) -> str:
+        row = self.orderId2row.get(orderId)
+        return None if row is None else self.statuses[row]
+
+    def order(self, orderId: int) -> Order:
+        row = self.orderId2row.get(orderId)
+        return None if row is None else self.orders[row]
+
+    def isWorking(self, orderId: int) -> bool:
+        return self.orderId2row.get(orderId) in self.workingRows
+
+    def working(self) -> list:
+        """ orderIds (permIds for the orders without one) of the working
+        orders, O(number of working orders) """
+        with self.lock:
+            return [self.orderIds[row] or self.permIds[row] for row in self.workingRows]
+
+    def filledQty(self, orderId: int) -> float:
+        row = self.orderId2row.get(orderId)
+        if row is None:
+            return 0.
+        return max(self.filled[row], self.execShares[row])
+
+    def avgPrice(self, orderId: int) -> float:
+        """ from the executions when there are some, from orderStatus
+        otherwise """
+        row = self.orderId2row.get(orderId)
+        if row is None:
+            return None
+        with self.lock:
+            if self.execShares[row]:
+                return self.execNotional[row] / self.execShares[row]
+            return self.avgFillPrices[row]
+
+    def fills(self, orderId: int) -> list:
+        row = self.orderId2row.get(orderId)
+        if row is None:
+            return []
+        with self.lock:
+            return list(self.rowFills[row])
+
+    def commission(self, orderId: int) -> float:
+        row = self.orderId2row.get(orderId)
+        return 0. if row is None else self.commissions[row]
@@ -6,12 +6,15 @@ Copyright (C) 2019 Interactive Brokers LLC. All rights reserved. This code is su
 import argparse
 import datetime
 import collections
+import functools
 import inspect
 
 import logging
 import time
 import os.path
 
+import numpy as np
+
 from ibapi import wrapper
 from ibapi import utils
 from ibapi.client import EClient
@@ -36,7 +39,27 @@ from OrderSamples import OrderSamples
 from AvailableAlgoParams import AvailableAlgoParams
 from ScannerSubscriptionSamples import ScannerSubscriptionSamples
 from FaAllocationSamples import FaAllocationSamples
-from ibapi.scanner import ScanData
+import CompactRecords
+from ContractCache import ContractCache
+from ErrorCodes import isConnectionError
+from GreeksEngine import GreeksEngine
+from HistoricalBarCache import HistoricalBarCache
+from HistoricalDataScheduler import HistoricalDataScheduler
+from MultiprocessDispatch import MultiprocessDispatcher
+from OptionChainBuilder import OptionChainBuilder
+from RequestMgr import Activity, RequestMgr
+from ScannerDiffer import ScannerDiffer
+from ScannerParameters import InvalidScannerSubscription, ScannerParameters
+from EventSink import makeSink
+from OrderBatcher import OrderBatcher
+from OrderBook import MARKET_DEPTH_RESET, OrderBooks
+from OrderTracker import OrderTracker
+from TickJournal import TickJournals
+from ibapi.scanner import ScanData, ScannerSubscription
+
+# bars and tick attributes are decoded into slotted records; at import, so
+# the dispatch worker processes get them too
+CompactRecords.install()
 
 
 def SetupLogger():
@@ -69,112 +92,95 @@ def printWhenExecuting(fn):
 
     return fn2
 
-def printinstance(inst:Object):
-    attrs = vars(inst)
-    print(', '.join("%s: %s" % item for item in attrs.items()))
+# per class tables: [(methName, index of the reqId param or -1, sign)]
+# computed once, the counting wrappers then only index preallocated arrays
+_methTables = {}
+
+
+def methodTable(cls, skipReqId=lambda methName: False) -> list:
+    table = _methTables.get(cls)
+    if table is None:
+        table = []
+        for (methName, meth) in inspect.getmembers(cls, inspect.isfunction):
+            # don't screw up the nice automated logging in sendMsg()
+            if methName.startswith("_") or methName in ("sendMsg", "logAnswer"):
+                continue
+            reqIdIdx = -1
+            if not skipReqId(methName):
+                for (idx, paramName) in enumerate(inspect.signature(meth).parameters):
+                    if paramName == "reqId":
+                        reqIdIdx = idx
+            sign = -1 if 'cancel' in methName else 1
+            table.append((methName, reqIdIdx, sign))
+        _methTables[cls] = table
+    return table
 
-class Activity(Object):
-    def __init__(self, reqMsgId, ansMsgId, ansEndMsgId, reqId):
-        self.reqMsdId = reqMsgId
-        self.ansMsgId = ansMsgId
-        self.ansEndMsgId = ansEndMsgId
-        self.reqId = reqId
 
+def countCalls(fn, callCounts, i, argIdx, sign, reqId2n):
+    if argIdx < 0:
+        def countCalls_(*args, **kwargs):
+            callCounts[i] += 1
+            return fn(*args, **kwargs)
+    else:
+        def countCalls_(*args, **kwargs):
+            callCounts[i] += 1
+            reqId = args[argIdx] if argIdx < len(args) else kwargs["reqId"]
+            reqId2n[sign * reqId] += 1
+            return fn(*args, **kwargs)
 
-class RequestMgr(Object):
-    def __init__(self):
-        # I will keep this simple even if slower for now: only one list of
-        # requests finding will be done by linear search
-        self.requests = []
+    return countCalls_
 
-    def addReq(self, req):
-        self.requests.append(req)
 
-    def receivedMsg(self, msg):
-        pass
+def installCallCounters(obj, table, callCounts, reqId2n):
+    """ shadows every method of the table with a counting wrapper on the
+    instance itself, so an uninstrumented object keeps the plain methods """
+    for (i, (methName, reqIdIdx, sign)) in enumerate(table):
+        # bound methods: the reqId position moves down by one (no self)
+        setattr(obj, methName, countCalls(getattr(obj, methName), callCounts, i,
+                                          reqIdIdx - 1, sign, reqId2n))
 
 
 # ! [socket_declare]
 class TestClient(EClient):
-    def __init__(self, wrapper):
+    def __init__(self, wrapper, instrument=True):
         EClient.__init__(self, wrapper)
         # ! [socket_declare]
 
         # how many times a method is called to see test coverage
-        self.clntMeth2callCount = collections.defaultdict(int)
-        self.clntMeth2reqIdIdx = collections.defaultdict(lambda: -1)
+        self.clntMethTable = methodTable(EClient)
+        self.clntCallCounts = [0] * len(self.clntMethTable)
+        self.clntMeth2reqIdIdx = {methName: idx for (methName, idx, _) in self.clntMethTable}
         self.reqId2nReq = collections.defaultdict(int)
-        self.setupDetectReqId()
-
-    def countReqId(self, methName, fn):
-        def countReqId_(*args, **kwargs):
-            self.clntMeth2callCount[methName] += 1
-            idx = self.clntMeth2reqIdIdx[methName]
-            if idx >= 0:
-                sign = -1 if 'cancel' in methName else 1
-                self.reqId2nReq[sign * args[idx]] += 1
-            return fn(*args, **kwargs)
+        if instrument:
+            installCallCounters(self, self.clntMethTable, self.clntCallCounts,
+                                self.reqId2nReq)
 
-        return countReqId_
-
-    def setupDetectReqId(self):
-
-        methods = inspect.getmembers(EClient, inspect.isfunction)
-        for (methName, meth) in methods:
-            if methName != "send_msg":
-                # don't screw up the nice automated logging in the send_msg()
-                self.clntMeth2callCount[methName] = 0
-                # logging.debug("meth %s", name)
-                sig = inspect.signature(meth)
-                for (idx, pnameNparam) in enumerate(sig.parameters.items()):
-                    (paramName, param) = pnameNparam # @UnusedVariable
-                    if paramName == "reqId":
-                        self.clntMeth2reqIdIdx[methName] = idx
-
-                setattr(TestClient, methName, self.countReqId(methName, meth))
-
-                # print("TestClient.clntMeth2reqIdIdx", self.clntMeth2reqIdIdx)
+    @property
+    def clntMeth2callCount(self) -> dict:
+        return {methName: n for ((methName, _, _), n)
+                in zip(self.clntMethTable, self.clntCallCounts)}
 
 
 # ! [ewrapperimpl]
 class TestWrapper(wrapper.EWrapper):
     # ! [ewrapperimpl]
-    def __init__(self):
+    def __init__(self, instrument=True):
         wrapper.EWrapper.__init__(self)
 
-        self.wrapMeth2callCount = collections.defaultdict(int)
-        self.wrapMeth2reqIdIdx = collections.defaultdict(lambda: -1)
+        # we want to count the errors as 'error' not 'answer'
+        self.wrapMethTable = methodTable(wrapper.EWrapper,
+                                         lambda methName: 'error' in methName)
+        self.wrapCallCounts = [0] * len(self.wrapMethTable)
+        self.wrapMeth2reqIdIdx = {methName: idx for (methName, idx, _) in self.wrapMethTable}
         self.reqId2nAns = collections.defaultdict(int)
-        self.setupDetectWrapperReqId()
-
-    # TODO: see how to factor this out !!
+        if instrument:
+            installCallCounters(self, self.wrapMethTable, self.wrapCallCounts,
+                                self.reqId2nAns)
 
-    def countWrapReqId(self, methName, fn):
-        def countWrapReqId_(*args, **kwargs):
-            self.wrapMeth2callCount[methName] += 1
-            idx = self.wrapMeth2reqIdIdx[methName]
-            if idx >= 0:
-                self.reqId2nAns[args[idx]] += 1
-            return fn(*args, **kwargs)
-
-        return countWrapReqId_
-
-    def setupDetectWrapperReqId(self):
-
-        methods = inspect.getmembers(wrapper.EWrapper, inspect.isfunction)
-        for (methName, meth) in methods:
-            self.wrapMeth2callCount[methName] = 0
-            # logging.debug("meth %s", name)
-            sig = inspect.signature(meth)
-            for (idx, pnameNparam) in enumerate(sig.parameters.items()):
-                (paramName, param) = pnameNparam # @UnusedVariable
-                # we want to count the errors as 'error' not 'answer'
-                if 'error' not in methName and paramName == "reqId":
-                    self.wrapMeth2reqIdIdx[methName] = idx
-
-            setattr(TestWrapper, methName, self.countWrapReqId(methName, meth))
-
-            # print("TestClient.wrapMeth2reqIdIdx", self.wrapMeth2reqIdIdx)
+    @property
+    def wrapMeth2callCount(self) -> dict:
+        return {methName: n for ((methName, _, _), n)
+                in zip(self.wrapMethTable, self.wrapCallCounts)}
 
 
 # this is here for documentation generation
@@ -188,9 +194,10 @@ class TestWrapper(wrapper.EWrapper):
 
 # ! [socket_init]
 class TestApp(TestWrapper, TestClient):
-    def __init__(self):
-        TestWrapper.__init__(self)
-        TestClient.__init__(self, wrapper=self)
+    def __init__(self, instrument=True, sink=None, dispatchWorker=False):
+        # instrument=False leaves no counting wrapper on the callbacks
+        TestWrapper.__init__(self, instrument)
+        TestClient.__init__(self, wrapper=self, instrument=instrument)
         # ! [socket_init]
         self.nKeybInt = 0
         self.started = False
@@ -199,6 +206,36 @@ class TestApp(TestWrapper, TestClient):
         self.reqId2nErr = collections.defaultdict(int)
         self.globalCancelOnly = False
         self.simplePlaceOid = None
+        # order ids are handed out in ranges, baskets go out in one write
+        self.orderBatcher = OrderBatcher(self)
+        self.orderBatch = None
+        # state of every order seen this session, by orderId/permId/execId
+        self.orderTracker = OrderTracker()
+        # implied vols and greeks of the option chains, computed locally
+        self.greeks = GreeksEngine()
+        self.chainBuilder = OptionChainBuilder(self, self.greeks, maxLines=90)
+        self.optionChain = None
+        self.optionChainPriced = False
+        # scanner refreshes are reported as what changed since the last one
+        self.scanDiffer = ScannerDiffer()
+        self.scanDiffer.listeners.append(self.scanDelta)
+        # indexed reqScannerParameters answer, cached per server version
+        self.scannerParams = None
+        # a dispatch worker only gets streams: the request bookkeeping is
+        # the front process's
+        self.dispatchWorker = dispatchWorker
+        if dispatchWorker:
+            self.histScheduler = self.barCache = self.reqMgr = self.contractCache = None
+        else:
+            self.histScheduler = HistoricalDataScheduler(self)
+            self.barCache = HistoricalBarCache("cache/bars", self.histScheduler)
+            self.reqMgr = RequestMgr()
+            self.contractCache = ContractCache(self, self.reqMgr, "cache/contracts.pickle")
+        # the callbacks report through the sink, never print() themselves
+        self.sink = sink if sink is not None else makeSink("console")
+        # set to a TickJournals to keep the tick-by-tick data on disk
+        self.tickJournals = None
+        self.orderBooks = OrderBooks()
 
     def dumpTestCoverageSituation(self):
         for clntMeth in sorted(self.clntMeth2callCount.keys()):
@@ -225,6 +262,15 @@ class TestApp(TestWrapper, TestClient):
 
     # ! [connectack]
 
+    @iswrapper
+    def connectionClosed(self):
+        super().connectionClosed()
+        if self.dispatchWorker:
+            # the end of this worker's stream: nothing more to write
+            if self.tickJournals is not None:
+                self.tickJournals.close()
+            self.sink.close()
+
     @iswrapper
     # ! [nextvalidid]
     def nextValidId(self, orderId: int):
@@ -232,7 +278,8 @@ class TestApp(TestWrapper, TestClient):
 
         logging.debug("setting nextValidOrderId: %d", orderId)
         self.nextValidOrderId = orderId
-        print("NextValidId:", orderId)
+        self.orderBatcher.reset(orderId)
+        self.sink.emit("NextValidId", ("OrderId",), orderId)
     # ! [nextvalidid]
 
         # we can start now
@@ -305,15 +352,40 @@ class TestApp(TestWrapper, TestClient):
         print("Executing cancels ... finished")
 
     def nextOrderId(self):
-        oid = self.nextValidOrderId
-        self.nextValidOrderId += 1
-        return oid
+        return self.orderBatcher.allocate(1)[0]
+
+    def frontReqId(self, reqId: int) -> bool:
+        """ the market data the front process needs itself: option chain
+        cells and the snapshots tracked by reqMgr """
+        return self.chainBuilder.owns(reqId) or self.reqMgr.find(reqId) is not None
 
     @iswrapper
     # ! [error]
     def error(self, reqId: TickerId, errorCode: int, errorString: str):
         super().error(reqId, errorCode, errorString)
-        print("Error. Id:", reqId, "Code:", errorCode, "Msg:", errorString)
+        if errorCode == MARKET_DEPTH_RESET:
+            self.orderBooks.reset(reqId)
+        if self.dispatchWorker:
+            # reported and taken care of by the front, only the state of the
+            # streams is the worker's
+            return
+        self.sink.emit("Error", ("Id", "Code", "Msg"), reqId, errorCode, errorString)
+        if reqId == NO_VALID_ID and isConnectionError(errorCode):
+            # no answer comes for the history requests out, their slots go
+            for lostId in self.histScheduler.connectionLost(errorCode, errorString):
+                if not self.barCache.error(lostId, errorCode, errorString):
+                    self.reqMgr.receivedError(lostId, errorCode, errorString)
+            return
+        # pacing violations of the queued historical requests are retried
+        if self.histScheduler.onError(reqId, errorCode, errorString) \
+                or self.barCache.error(reqId, errorCode, errorString) \
+                or self.orderBatcher.error(reqId, errorCode, errorString):
+            return
+        if self.chainBuilder.error(reqId, errorCode, errorString):
+            # the last cell of the chain may have been settled by an error
+            self.optionChainGreeks()
+        else:
+            self.reqMgr.receivedError(reqId, errorCode, errorString)
 
     # ! [error] self.reqId2nErr[reqId] += 1
 
@@ -327,21 +399,26 @@ class TestApp(TestWrapper, TestClient):
     def openOrder(self, orderId: OrderId, contract: Contract, order: Order,
                   orderState: OrderState):
         super().openOrder(orderId, contract, order, orderState)
-        print("OpenOrder. PermId: ", order.permId, "ClientId:", order.clientId, " OrderId:", orderId, 
-              "Account:", order.account, "Symbol:", contract.symbol, "SecType:", contract.secType,
-              "Exchange:", contract.exchange, "Action:", order.action, "OrderType:", order.orderType,
-              "TotalQty:", order.totalQuantity, "CashQty:", order.cashQty, 
-              "LmtPrice:", order.lmtPrice, "AuxPrice:", order.auxPrice, "Status:", orderState.status)
+        self.sink.emit("OpenOrder", ("PermId", "ClientId", "OrderId", "Account", "Symbol",
+                                    "SecType", "Exchange", "Action", "OrderType",
+                                    "TotalQty", "CashQty", "LmtPrice", "AuxPrice",
+                                    "Status"),
+                       order.permId, order.clientId, orderId, order.account,
+                       contract.symbol, contract.secType, contract.exchange, order.action,
+                       order.orderType, order.totalQuantity, order.cashQty, order.lmtPrice,
+                       order.auxPrice, orderState.status)
 
         order.contract = contract
         self.permId2ord[order.permId] = order
+        self.orderTracker.openOrder(orderId, contract, order, orderState)
+        self.orderBatcher.openOrder(orderId, orderState.status)
     # ! [openorder]
 
     @iswrapper
     # ! [openorderend]
     def openOrderEnd(self):
         super().openOrderEnd()
-        print("OpenOrderEnd")
+        self.sink.emit("OpenOrderEnd", ())
 
         logging.debug("Received %d openOrders", len(self.permId2ord))
     # ! [openorderend]
@@ -354,11 +431,16 @@ class TestApp(TestWrapper, TestClient):
                     whyHeld: str, mktCapPrice: float):
         super().orderStatus(orderId, status, filled, remaining,
                             avgFillPrice, permId, parentId, lastFillPrice, clientId, whyHeld, mktCapPrice)
-        print("OrderStatus. Id:", orderId, "Status:", status, "Filled:", filled,
-              "Remaining:", remaining, "AvgFillPrice:", avgFillPrice,
-              "PermId:", permId, "ParentId:", parentId, "LastFillPrice:",
-              lastFillPrice, "ClientId:", clientId, "WhyHeld:",
-              whyHeld, "MktCapPrice:", mktCapPrice)
+        self.sink.emit("OrderStatus", ("Id", "Status", "Filled", "Remaining",
+                                      "AvgFillPrice", "PermId", "ParentId",
+                                      "LastFillPrice", "ClientId", "WhyHeld",
+                                      "MktCapPrice"),
+                       orderId, status, filled, remaining, avgFillPrice, permId, parentId,
+                       lastFillPrice, clientId, whyHeld, mktCapPrice)
+        self.orderTracker.orderStatus(orderId, status, filled, remaining, avgFillPrice,
+                                      permId, parentId, lastFillPrice, clientId, whyHeld,
+                                      mktCapPrice)
+        self.orderBatcher.orderStatus(orderId, status)
     # ! [orderstatus]
 
 
@@ -481,7 +563,7 @@ class TestApp(TestWrapper, TestClient):
     # ! [managedaccounts]
     def managedAccounts(self, accountsList: str):
         super().managedAccounts(accountsList)
-        print("Account list:", accountsList)
+        self.sink.emit("ManagedAccounts", ("AccountsList",), accountsList)
         # ! [managedaccounts]
 
         self.account = accountsList.split(",")[0]
@@ -491,15 +573,17 @@ class TestApp(TestWrapper, TestClient):
     def accountSummary(self, reqId: int, account: str, tag: str, value: str,
                        currency: str):
         super().accountSummary(reqId, account, tag, value, currency)
-        print("AccountSummary. ReqId:", reqId, "Account:", account,
-              "Tag: ", tag, "Value:", value, "Currency:", currency)
+        self.sink.emit("AccountSummary", ("ReqId", "Account", "Tag", "Value", "Currency"),
+                       reqId, account, tag, value, currency)
+        self.reqMgr.receivedMsg(reqId, (account, tag, value, currency))
     # ! [accountsummary]
 
     @iswrapper
     # ! [accountsummaryend]
     def accountSummaryEnd(self, reqId: int):
         super().accountSummaryEnd(reqId)
-        print("AccountSummaryEnd. ReqId:", reqId)
+        self.sink.emit("AccountSummaryEnd", ("ReqId",), reqId)
+        self.reqMgr.receivedEnd(reqId)
     # ! [accountsummaryend]
 
     @iswrapper
@@ -507,8 +591,8 @@ class TestApp(TestWrapper, TestClient):
     def updateAccountValue(self, key: str, val: str, currency: str,
                            accountName: str):
         super().updateAccountValue(key, val, currency, accountName)
-        print("UpdateAccountValue. Key:", key, "Value:", val,
-              "Currency:", currency, "AccountName:", accountName)
+        self.sink.emit("UpdateAccountValue", ("Key", "Value", "Currency", "AccountName"),
+                       key, val, currency, accountName)
     # ! [updateaccountvalue]
 
     @iswrapper
@@ -519,25 +603,26 @@ class TestApp(TestWrapper, TestClient):
                         realizedPNL: float, accountName: str):
         super().updatePortfolio(contract, position, marketPrice, marketValue,
                                 averageCost, unrealizedPNL, realizedPNL, accountName)
-        print("UpdatePortfolio.", "Symbol:", contract.symbol, "SecType:", contract.secType, "Exchange:",
-              contract.exchange, "Position:", position, "MarketPrice:", marketPrice,
-              "MarketValue:", marketValue, "AverageCost:", averageCost,
-              "UnrealizedPNL:", unrealizedPNL, "RealizedPNL:", realizedPNL,
-              "AccountName:", accountName)
+        self.sink.emit("UpdatePortfolio", ("Symbol", "SecType", "Exchange", "Position",
+                                          "MarketPrice", "MarketValue", "AverageCost",
+                                          "UnrealizedPNL", "RealizedPNL", "AccountName"),
+                       contract.symbol, contract.secType, contract.exchange, position,
+                       marketPrice, marketValue, averageCost, unrealizedPNL, realizedPNL,
+                       accountName)
     # ! [updateportfolio]
 
     @iswrapper
     # ! [updateaccounttime]
     def updateAccountTime(self, timeStamp: str):
         super().updateAccountTime(timeStamp)
-        print("UpdateAccountTime. Time:", timeStamp)
+        self.sink.emit("UpdateAccountTime", ("Time",), timeStamp)
     # ! [updateaccounttime]
 
     @iswrapper
     # ! [accountdownloadend]
     def accountDownloadEnd(self, accountName: str):
         super().accountDownloadEnd(accountName)
-        print("AccountDownloadEnd. Account:", accountName)
+        self.sink.emit("AccountDownloadEnd", ("Account",), accountName)
     # ! [accountdownloadend]
 
     @iswrapper
@@ -545,16 +630,17 @@ class TestApp(TestWrapper, TestClient):
     def position(self, account: str, contract: Contract, position: float,
                  avgCost: float):
         super().position(account, contract, position, avgCost)
-        print("Position.", "Account:", account, "Symbol:", contract.symbol, "SecType:",
-              contract.secType, "Currency:", contract.currency,
-              "Position:", position, "Avg cost:", avgCost)
+        self.sink.emit("Position", ("Account", "Symbol", "SecType", "Currency", "Position",
+                                   "AvgCost"),
+                       account, contract.symbol, contract.secType, contract.currency,
+                       position, avgCost)
     # ! [position]
 
     @iswrapper
     # ! [positionend]
     def positionEnd(self):
         super().positionEnd()
-        print("PositionEnd")
+        self.sink.emit("PositionEnd", ())
     # ! [positionend]
 
     @iswrapper
@@ -562,17 +648,19 @@ class TestApp(TestWrapper, TestClient):
     def positionMulti(self, reqId: int, account: str, modelCode: str,
                       contract: Contract, pos: float, avgCost: float):
         super().positionMulti(reqId, account, modelCode, contract, pos, avgCost)
-        print("PositionMulti. RequestId:", reqId, "Account:", account,
-              "ModelCode:", modelCode, "Symbol:", contract.symbol, "SecType:",
-              contract.secType, "Currency:", contract.currency, ",Position:",
-              pos, "AvgCost:", avgCost)
+        self.sink.emit("PositionMulti", ("RequestId", "Account", "ModelCode", "Symbol",
+                                        "SecType", "Currency", "Position", "AvgCost"),
+                       reqId, account, modelCode, contract.symbol, contract.secType,
+                       contract.currency, pos, avgCost)
+        self.reqMgr.receivedMsg(reqId, (account, modelCode, contract, pos, avgCost))
     # ! [positionmulti]
 
     @iswrapper
     # ! [positionmultiend]
     def positionMultiEnd(self, reqId: int):
         super().positionMultiEnd(reqId)
-        print("PositionMultiEnd. RequestId:", reqId)
+        self.sink.emit("PositionMultiEnd", ("RequestId",), reqId)
+        self.reqMgr.receivedEnd(reqId)
     # ! [positionmultiend]
 
     @iswrapper
@@ -581,25 +669,26 @@ class TestApp(TestWrapper, TestClient):
                            key: str, value: str, currency: str):
         super().accountUpdateMulti(reqId, account, modelCode, key, value,
                                    currency)
-        print("AccountUpdateMulti. RequestId:", reqId, "Account:", account,
-              "ModelCode:", modelCode, "Key:", key, "Value:", value,
-              "Currency:", currency)
+        self.sink.emit("AccountUpdateMulti", ("RequestId", "Account", "ModelCode", "Key",
+                                             "Value", "Currency"),
+                       reqId, account, modelCode, key, value, currency)
+        self.reqMgr.receivedMsg(reqId, (account, modelCode, key, value, currency))
     # ! [accountupdatemulti]
 
     @iswrapper
     # ! [accountupdatemultiend]
     def accountUpdateMultiEnd(self, reqId: int):
         super().accountUpdateMultiEnd(reqId)
-        print("AccountUpdateMultiEnd. RequestId:", reqId)
+        self.sink.emit("AccountUpdateMultiEnd", ("RequestId",), reqId)
+        self.reqMgr.receivedEnd(reqId)
     # ! [accountupdatemultiend]
 
     @iswrapper
     # ! [familyCodes]
     def familyCodes(self, familyCodes: ListOfFamilyCode):
         super().familyCodes(familyCodes)
-        print("Family Codes:")
         for familyCode in familyCodes:
-            print("FamilyCode.", familyCode)
+            self.sink.emit("FamilyCode", ("FamilyCode",), familyCode)
     # ! [familyCodes]
 
     @iswrapper
@@ -607,8 +696,8 @@ class TestApp(TestWrapper, TestClient):
     def pnl(self, reqId: int, dailyPnL: float,
             unrealizedPnL: float, realizedPnL: float):
         super().pnl(reqId, dailyPnL, unrealizedPnL, realizedPnL)
-        print("Daily PnL. ReqId:", reqId, "DailyPnL:", dailyPnL,
-              "UnrealizedPnL:", unrealizedPnL, "RealizedPnL:", realizedPnL)
+        self.sink.emit("Pnl", ("ReqId", "DailyPnL", "UnrealizedPnL", "RealizedPnL"), reqId,
+                       dailyPnL, unrealizedPnL, realizedPnL)
     # ! [pnl]
 
     @iswrapper
@@ -616,9 +705,9 @@ class TestApp(TestWrapper, TestClient):
     def pnlSingle(self, reqId: int, pos: int, dailyPnL: float,
                   unrealizedPnL: float, realizedPnL: float, value: float):
         super().pnlSingle(reqId, pos, dailyPnL, unrealizedPnL, realizedPnL, value)
-        print("Daily PnL Single. ReqId:", reqId, "Position:", pos,
-              "DailyPnL:", dailyPnL, "UnrealizedPnL:", unrealizedPnL,
-              "RealizedPnL:", realizedPnL, "Value:", value)
+        self.sink.emit("PnlSingle", ("ReqId", "Position", "DailyPnL", "UnrealizedPnL",
+                                    "RealizedPnL", "Value"),
+                       reqId, pos, dailyPnL, unrealizedPnL, realizedPnL, value)
     # ! [pnlsingle]
 
     def marketDataTypeOperations(self):
@@ -631,7 +720,7 @@ class TestApp(TestWrapper, TestClient):
     # ! [marketdatatype]
     def marketDataType(self, reqId: TickerId, marketDataType: int):
         super().marketDataType(reqId, marketDataType)
-        print("MarketDataType. ReqId:", reqId, "Type:", marketDataType)
+        self.sink.emit("MarketDataType", ("ReqId", "Type"), reqId, marketDataType)
     # ! [marketdatatype]
 
     @printWhenExecuting
@@ -734,57 +823,65 @@ class TestApp(TestWrapper, TestClient):
     def tickPrice(self, reqId: TickerId, tickType: TickType, price: float,
                   attrib: TickAttrib):
         super().tickPrice(reqId, tickType, price, attrib)
-        print("TickPrice. TickerId:", reqId, "tickType:", tickType,
-              "Price:", price, "CanAutoExecute:", attrib.canAutoExecute,
-              "PastLimit:", attrib.pastLimit, end=' ')
-        if tickType == TickTypeEnum.BID or tickType == TickTypeEnum.ASK:
-            print("PreOpen:", attrib.preOpen)
-        else:
-            print()
+        self.sink.emit("TickPrice", ("TickerId", "TickType", "Price", "CanAutoExecute",
+                                    "PastLimit", "PreOpen"),
+                       reqId, tickType, price, attrib.canAutoExecute, attrib.pastLimit,
+                       attrib.preOpen)
+        self.greeks.tickPrice(reqId, tickType, price)
+        self.chainBuilder.tickPrice(reqId, tickType, price)
+        if self.reqMgr is not None:
+            # the answers of a tracked reqMktData snapshot
+            self.reqMgr.receivedMsg(reqId, (tickType, price))
     # ! [tickprice]
 
     @iswrapper
     # ! [ticksize]
     def tickSize(self, reqId: TickerId, tickType: TickType, size: int):
         super().tickSize(reqId, tickType, size)
-        print("TickSize. TickerId:", reqId, "TickType:", tickType, "Size:", size)
+        self.sink.emit("TickSize", ("TickerId", "TickType", "Size"), reqId, tickType, size)
     # ! [ticksize]
 
     @iswrapper
     # ! [tickgeneric]
     def tickGeneric(self, reqId: TickerId, tickType: TickType, value: float):
         super().tickGeneric(reqId, tickType, value)
-        print("TickGeneric. TickerId:", reqId, "TickType:", tickType, "Value:", value)
+        self.sink.emit("TickGeneric", ("TickerId", "TickType", "Value"), reqId, tickType,
+                       value)
     # ! [tickgeneric]
 
     @iswrapper
     # ! [tickstring]
     def tickString(self, reqId: TickerId, tickType: TickType, value: str):
         super().tickString(reqId, tickType, value)
-        print("TickString. TickerId:", reqId, "Type:", tickType, "Value:", value)
+        self.sink.emit("TickString", ("TickerId", "Type", "Value"), reqId, tickType, value)
     # ! [tickstring]
 
     @iswrapper
     # ! [ticksnapshotend]
     def tickSnapshotEnd(self, reqId: int):
         super().tickSnapshotEnd(reqId)
-        print("TickSnapshotEnd. TickerId:", reqId)
+        self.sink.emit("TickSnapshotEnd", ("TickerId",), reqId)
+        if self.chainBuilder.tickSnapshotEnd(reqId):
+            self.optionChainGreeks()
+        else:
+            self.reqMgr.receivedEnd(reqId)
     # ! [ticksnapshotend]
 
     @iswrapper
     # ! [rerouteMktDataReq]
     def rerouteMktDataReq(self, reqId: int, conId: int, exchange: str):
         super().rerouteMktDataReq(reqId, conId, exchange)
-        print("Re-route market data request. ReqId:", reqId, "ConId:", conId, "Exchange:", exchange)
+        self.sink.emit("RerouteMktDataReq", ("ReqId", "ConId", "Exchange"), reqId, conId,
+                       exchange)
     # ! [rerouteMktDataReq]
 
     @iswrapper
     # ! [marketRule]
     def marketRule(self, marketRuleId: int, priceIncrements: ListOfPriceIncrements):
         super().marketRule(marketRuleId, priceIncrements)
-        print("Market Rule ID: ", marketRuleId)
         for priceIncrement in priceIncrements:
-            print("Price Increment.", priceIncrement)
+            self.sink.emit("MarketRule", ("MarketRuleId", "PriceIncrement"),
+                           marketRuleId, priceIncrement)
     # ! [marketRule]
 
     @printWhenExecuting
@@ -825,7 +922,8 @@ class TestApp(TestWrapper, TestClient):
     # ! [orderbound]
     def orderBound(self, orderId: int, apiClientId: int, apiOrderId: int):
         super().orderBound(orderId, apiClientId, apiOrderId)
-        print("OrderBound.", "OrderId:", orderId, "ApiClientId:", apiClientId, "ApiOrderId:", apiOrderId)
+        self.sink.emit("OrderBound", ("OrderId", "ApiClientId", "ApiOrderId"), orderId,
+                       apiClientId, apiOrderId)
     # ! [orderbound]
 
     @iswrapper
@@ -835,14 +933,17 @@ class TestApp(TestWrapper, TestClient):
                           specialConditions: str):
         super().tickByTickAllLast(reqId, tickType, time, price, size, tickAtrribLast,
                                   exchange, specialConditions)
-        if tickType == 1:
-            print("Last.", end='')
-        else:
-            print("AllLast.", end='')
-        print(" ReqId:", reqId,
-              "Time:", datetime.datetime.fromtimestamp(time).strftime("%Y%m%d %H:%M:%S"),
-              "Price:", price, "Size:", size, "Exch:" , exchange,
-              "Spec Cond:", specialConditions, "PastLimit:", tickAtrribLast.pastLimit, "Unreported:", tickAtrribLast.unreported)
+        # the time stays epoch seconds, the console writer formats it
+        self.sink.emit("TickByTickLast" if tickType == 1 else "TickByTickAllLast",
+                       ("ReqId", "Time", "Price", "Size", "Exch", "SpecCond", "PastLimit",
+                        "Unreported"),
+                       reqId, time, price, size, exchange, specialConditions,
+                       tickAtrribLast.pastLimit, tickAtrribLast.unreported)
+        if self.tickJournals is not None:
+            self.tickJournals.tickByTickAllLast(reqId, tickType, time, price, size,
+                                                tickAtrribLast.pastLimit,
+                                                tickAtrribLast.unreported, exchange,
+                                                specialConditions)
     # ! [tickbytickalllast]
 
     @iswrapper
@@ -851,19 +952,25 @@ class TestApp(TestWrapper, TestClient):
                          bidSize: int, askSize: int, tickAttribBidAsk: TickAttribBidAsk):
         super().tickByTickBidAsk(reqId, time, bidPrice, askPrice, bidSize,
                                  askSize, tickAttribBidAsk)
-        print("BidAsk. ReqId:", reqId,
-              "Time:", datetime.datetime.fromtimestamp(time).strftime("%Y%m%d %H:%M:%S"),
-              "BidPrice:", bidPrice, "AskPrice:", askPrice, "BidSize:", bidSize,
-              "AskSize:", askSize, "BidPastLow:", tickAttribBidAsk.bidPastLow, "AskPastHigh:", tickAttribBidAsk.askPastHigh)
+        self.sink.emit("TickByTickBidAsk", ("ReqId", "Time", "BidPrice", "AskPrice",
+                                           "BidSize", "AskSize", "BidPastLow",
+                                           "AskPastHigh"),
+                       reqId, time, bidPrice, askPrice, bidSize, askSize,
+                       tickAttribBidAsk.bidPastLow, tickAttribBidAsk.askPastHigh)
+        if self.tickJournals is not None:
+            self.tickJournals.tickByTickBidAsk(reqId, time, bidPrice, askPrice, bidSize,
+                                               askSize, tickAttribBidAsk.bidPastLow,
+                                               tickAttribBidAsk.askPastHigh)
     # ! [tickbytickbidask]
 
     # ! [tickbytickmidpoint]
     @iswrapper
     def tickByTickMidPoint(self, reqId: int, time: int, midPoint: float):
         super().tickByTickMidPoint(reqId, time, midPoint)
-        print("Midpoint. ReqId:", reqId,
-              "Time:", datetime.datetime.fromtimestamp(time).strftime("%Y%m%d %H:%M:%S"),
-              "MidPoint:", midPoint)
+        self.sink.emit("TickByTickMidPoint", ("ReqId", "Time", "MidPoint"), reqId, time,
+                       midPoint)
+        if self.tickJournals is not None:
+            self.tickJournals.tickByTickMidPoint(reqId, time, midPoint)
     # ! [tickbytickmidpoint]
 
     @printWhenExecuting
@@ -889,14 +996,18 @@ class TestApp(TestWrapper, TestClient):
         self.cancelMktDepth(2001, False)
         self.cancelMktDepth(2002, True)
         # ! [cancelmktdepth]
+        self.orderBooks.remove(2001)
+        self.orderBooks.remove(2002)
 
     @iswrapper
     # ! [updatemktdepth]
     def updateMktDepth(self, reqId: TickerId, position: int, operation: int,
                        side: int, price: float, size: int):
         super().updateMktDepth(reqId, position, operation, side, price, size)
-        print("UpdateMarketDepth. ReqId:", reqId, "Position:", position, "Operation:",
-              operation, "Side:", side, "Price:", price, "Size:", size)
+        self.sink.emit("UpdateMktDepth", ("ReqId", "Position", "Operation", "Side", "Price",
+                                         "Size"),
+                       reqId, position, operation, side, price, size)
+        self.orderBooks.updateMktDepth(reqId, position, operation, side, price, size)
     # ! [updatemktdepth]
 
     @iswrapper
@@ -905,8 +1016,12 @@ class TestApp(TestWrapper, TestClient):
                          operation: int, side: int, price: float, size: int, isSmartDepth: bool):
         super().updateMktDepthL2(reqId, position, marketMaker, operation, side,
                                  price, size, isSmartDepth)
-        print("UpdateMarketDepthL2. ReqId:", reqId, "Position:", position, "MarketMaker:", marketMaker, "Operation:",
-              operation, "Side:", side, "Price:", price, "Size:", size, "isSmartDepth:", isSmartDepth)
+        self.sink.emit("UpdateMktDepthL2", ("ReqId", "Position", "MarketMaker", "Operation",
+                                           "Side", "Price", "Size", "IsSmartDepth"),
+                       reqId, position, marketMaker, operation, side, price, size,
+                       isSmartDepth)
+        self.orderBooks.updateMktDepthL2(reqId, position, marketMaker, operation, side,
+                                         price, size, isSmartDepth)
 
     # ! [updatemktdepthl2]
 
@@ -914,7 +1029,8 @@ class TestApp(TestWrapper, TestClient):
     # ! [rerouteMktDepthReq]
     def rerouteMktDepthReq(self, reqId: int, conId: int, exchange: str):
         super().rerouteMktDataReq(reqId, conId, exchange)
-        print("Re-route market depth request. ReqId:", reqId, "ConId:", conId, "Exchange:", exchange)
+        self.sink.emit("RerouteMktDepthReq", ("ReqId", "ConId", "Exchange"), reqId, conId,
+                       exchange)
     # ! [rerouteMktDepthReq]
 
     @printWhenExecuting
@@ -929,7 +1045,9 @@ class TestApp(TestWrapper, TestClient):
     def realtimeBar(self, reqId: TickerId, time:int, open_: float, high: float, low: float, close: float,
                         volume: int, wap: float, count: int):
         super().realtimeBar(reqId, time, open_, high, low, close, volume, wap, count)
-        print("RealTimeBar. TickerId:", reqId, RealTimeBar(time, -1, open_, high, low, close, volume, wap, count))
+        self.sink.emit("RealtimeBar", ("TickerId", "Time", "Open", "High", "Low", "Close",
+                                      "Volume", "Wap", "Count"),
+                       reqId, time, open_, high, low, close, volume, wap, count)
     # ! [realtimebar]
 
     @printWhenExecuting
@@ -956,6 +1074,20 @@ class TestApp(TestWrapper, TestClient):
                                "1 M", "1 day", "MIDPOINT", 1, 1, True, [])
         # ! [reqhistoricaldata]
 
+        # Larger batches go through the bar cache: only the bars not already
+        # on disk are requested, through the scheduler which keeps them under
+        # the historical data pacing limits and retries pacing violations
+        for contract in [ContractSamples.USStockAtSmart(),
+                         ContractSamples.USStock(),
+                         ContractSamples.EuropeanStock2()]:
+            self.barCache.request(contract, "5 mins", "TRADES", 1,
+                                  time.time() - 86400, onDone=self.cachedBars)
+
+    def cachedBars(self, req):
+        self.sink.emit("CachedHistoricalData", ("Key", "Bars", "Fetched", "Errors"),
+                       req.key, len(req.future.result()["time"]), req.nFetched,
+                       req.errors)
+
     @printWhenExecuting
     def historicalDataOperations_cancel(self):
         # ! [cancelHeadTimestamp]
@@ -969,6 +1101,9 @@ class TestApp(TestWrapper, TestClient):
         self.cancelHistoricalData(4104)
         # ! [cancelhistoricaldata]
 
+        for reqId in self.histScheduler.cancelAll():
+            self.cancelHistoricalData(reqId)
+
     @printWhenExecuting
     def historicalTicksOperations(self):
         # ! [reqhistoricalticks]
@@ -983,39 +1118,46 @@ class TestApp(TestWrapper, TestClient):
     @iswrapper
     # ! [headTimestamp]
     def headTimestamp(self, reqId:int, headTimestamp:str):
-        print("HeadTimestamp. ReqId:", reqId, "HeadTimeStamp:", headTimestamp)
+        self.sink.emit("HeadTimestamp", ("ReqId", "HeadTimeStamp"), reqId, headTimestamp)
+        self.reqMgr.receivedEnd(reqId, headTimestamp)
     # ! [headTimestamp]
 
     @iswrapper
     # ! [histogramData]
     def histogramData(self, reqId:int, items:HistogramDataList):
-        print("HistogramData. ReqId:", reqId, "HistogramDataList:", "[%s]" % "; ".join(map(str, items)))
+        self.sink.emit("HistogramData", ("ReqId", "HistogramDataList"), reqId, items)
+        self.reqMgr.receivedEnd(reqId, items)
     # ! [histogramData]
 
     @iswrapper
     # ! [historicaldata]
     def historicalData(self, reqId:int, bar: BarData):
-        print("HistoricalData. ReqId:", reqId, "BarData.", bar)
+        self.sink.emit("HistoricalData", ("ReqId", "BarData"), reqId, bar)
+        if not self.barCache.historicalData(reqId, bar):
+            self.reqMgr.receivedMsg(reqId, bar)
     # ! [historicaldata]
 
     @iswrapper
     # ! [historicaldataend]
     def historicalDataEnd(self, reqId: int, start: str, end: str):
         super().historicalDataEnd(reqId, start, end)
-        print("HistoricalDataEnd. ReqId:", reqId, "from", start, "to", end)
+        self.sink.emit("HistoricalDataEnd", ("ReqId", "From", "To"), reqId, start, end)
+        self.histScheduler.onEnd(reqId)
+        if not self.barCache.historicalDataEnd(reqId):
+            self.reqMgr.receivedEnd(reqId)
     # ! [historicaldataend]
 
     @iswrapper
     # ! [historicalDataUpdate]
     def historicalDataUpdate(self, reqId: int, bar: BarData):
-        print("HistoricalDataUpdate. ReqId:", reqId, "BarData.", bar)
+        self.sink.emit("HistoricalDataUpdate", ("ReqId", "BarData"), reqId, bar)
     # ! [historicalDataUpdate]
 
     @iswrapper
     # ! [historicalticks]
     def historicalTicks(self, reqId: int, ticks: ListOfHistoricalTick, done: bool):
         for tick in ticks:
-            print("HistoricalTick. ReqId:", reqId, tick)
+            self.sink.emit("HistoricalTick", ("ReqId", "Tick"), reqId, tick)
     # ! [historicalticks]
 
     @iswrapper
@@ -1023,7 +1165,7 @@ class TestApp(TestWrapper, TestClient):
     def historicalTicksBidAsk(self, reqId: int, ticks: ListOfHistoricalTickBidAsk,
                               done: bool):
         for tick in ticks:
-            print("HistoricalTickBidAsk. ReqId:", reqId, tick)
+            self.sink.emit("HistoricalTickBidAsk", ("ReqId", "Tick"), reqId, tick)
     # ! [historicalticksbidask]
 
     @iswrapper
@@ -1031,7 +1173,7 @@ class TestApp(TestWrapper, TestClient):
     def historicalTicksLast(self, reqId: int, ticks: ListOfHistoricalTickLast,
                             done: bool):
         for tick in ticks:
-            print("HistoricalTickLast. ReqId:", reqId, tick)
+            self.sink.emit("HistoricalTickLast", ("ReqId", "Tick"), reqId, tick)
     # ! [historicaltickslast]
 
     @printWhenExecuting
@@ -1040,6 +1182,14 @@ class TestApp(TestWrapper, TestClient):
         self.reqSecDefOptParams(0, "IBM", "", "STK", 8314)
         # ! [reqsecdefoptparams]
 
+        # The whole IBM chain around the money: snapshots of the grid within
+        # the market data lines, the greeks computed by self.greeks
+        underlying = ContractSamples.USStockAtSmart()
+        underlying.conId = 8314
+        self.optionChainPriced = False
+        self.optionChain = self.chainBuilder.build(underlying, nExpirations=3,
+                                                   strikeWindow=0.1)
+
         # Calculating implied volatility
         # ! [calculateimpliedvolatility]
         self.calculateImpliedVolatility(5001, ContractSamples.OptionAtBOX(), 5, 85, [])
@@ -1058,11 +1208,32 @@ class TestApp(TestWrapper, TestClient):
 
     @printWhenExecuting
     def optionsOperations_cancel(self):
+        if self.optionChain is not None:
+            self.chainBuilder.cancel(self.optionChain)
         # Canceling implied volatility
         self.cancelCalculateImpliedVolatility(5001)
         # Canceling option's price calculation
         self.cancelCalculateOptionPrice(5002)
 
+    def optionChainGreeks(self):
+        """ once every cell of the option chain is settled: its implied vols
+        and greeks, solved in one batch and reported like
+        tickOptionComputation """
+        chain = self.optionChain
+        if chain is None or not chain.done.is_set() or self.optionChainPriced:
+            return
+        self.optionChainPriced = True
+        greeks = self.greeks
+        rows = greeks.refresh()
+        for (i, j, k) in np.argwhere(np.isin(chain.rows, rows)).tolist():
+            row = chain.rows[i, j, k]
+            self.sink.emit("OptionGreeks", ("TickerId", "ImpliedVolatility", "Delta",
+                                           "OptionPrice", "Gamma", "Vega", "Theta",
+                                           "UnderlyingPrice"),
+                           chain.cellReqId(i, j, k), greeks.iv[row], greeks.delta[row],
+                           greeks.price[row], greeks.gamma[row], greeks.vega[row],
+                           greeks.theta[row], greeks.undPrice[row])
+
     @iswrapper
     # ! [securityDefinitionOptionParameter]
     def securityDefinitionOptionParameter(self, reqId: int, exchange: str,
@@ -1070,16 +1241,26 @@ class TestApp(TestWrapper, TestClient):
                                           expirations: SetOfString, strikes: SetOfFloat):
         super().securityDefinitionOptionParameter(reqId, exchange,
                                                   underlyingConId, tradingClass, multiplier, expirations, strikes)
-        print("SecurityDefinitionOptionParameter.",
-              "ReqId:", reqId, "Exchange:", exchange, "Underlying conId:", underlyingConId, "TradingClass:", tradingClass, "Multiplier:", multiplier,
-              "Expirations:", expirations, "Strikes:", str(strikes))
+        self.sink.emit("SecurityDefinitionOptionParameter", ("ReqId", "Exchange",
+                                                            "UnderlyingConId",
+                                                            "TradingClass", "Multiplier",
+                                                            "Expirations", "Strikes"),
+                       reqId, exchange, underlyingConId, tradingClass, multiplier,
+                       expirations, strikes)
+        if not self.chainBuilder.securityDefinitionOptionParameter(
+                reqId, exchange, underlyingConId, tradingClass, multiplier, expirations,
+                strikes):
+            self.reqMgr.receivedMsg(reqId, (exchange, underlyingConId, tradingClass,
+                                            multiplier, expirations, strikes))
     # ! [securityDefinitionOptionParameter]
 
     @iswrapper
     # ! [securityDefinitionOptionParameterEnd]
     def securityDefinitionOptionParameterEnd(self, reqId: int):
         super().securityDefinitionOptionParameterEnd(reqId)
-        print("SecurityDefinitionOptionParameterEnd. ReqId:", reqId)
+        self.sink.emit("SecurityDefinitionOptionParameterEnd", ("ReqId",), reqId)
+        if not self.chainBuilder.securityDefinitionOptionParameterEnd(reqId):
+            self.reqMgr.receivedEnd(reqId)
     # ! [securityDefinitionOptionParameterEnd]
 
     @iswrapper
@@ -1089,10 +1270,14 @@ class TestApp(TestWrapper, TestClient):
                               gamma: float, vega: float, theta: float, undPrice: float):
         super().tickOptionComputation(reqId, tickType, impliedVol, delta,
                                       optPrice, pvDividend, gamma, vega, theta, undPrice)
-        print("TickOptionComputation. TickerId:", reqId, "TickType:", tickType,
-              "ImpliedVolatility:", impliedVol, "Delta:", delta, "OptionPrice:",
-              optPrice, "pvDividend:", pvDividend, "Gamma: ", gamma, "Vega:", vega,
-              "Theta:", theta, "UnderlyingPrice:", undPrice)
+        self.sink.emit("TickOptionComputation", ("TickerId", "TickType",
+                                                "ImpliedVolatility", "Delta",
+                                                "OptionPrice", "PvDividend", "Gamma",
+                                                "Vega", "Theta", "UnderlyingPrice"),
+                       reqId, tickType, impliedVol, delta, optPrice, pvDividend, gamma,
+                       vega, theta, undPrice)
+        self.greeks.tickOptionComputation(reqId, tickType, impliedVol, delta, optPrice,
+                                          pvDividend, gamma, vega, theta, undPrice)
 
     # ! [tickoptioncomputation]
 
@@ -1111,6 +1296,21 @@ class TestApp(TestWrapper, TestClient):
         self.reqMatchingSymbols(211, "IB")
         # ! [reqmatchingsymbols]
 
+        # Batches of contracts are resolved through the contract cache: the
+        # misses are all requested at once, the hits never leave the process
+        for contract in [ContractSamples.USStockAtSmart(), ContractSamples.USStock(),
+                         ContractSamples.EuropeanStock2(), ContractSamples.EurGbpFx()]:
+            self.contractCache.submit(contract).add_done_callback(
+                functools.partial(self.contractResolved, contract))
+
+    def contractResolved(self, contract, future):
+        if future.exception() is not None:
+            self.sink.emit("ContractResolution", ("Contract", "Error"), contract,
+                           future.exception())
+        else:
+            self.sink.emit("ContractResolution", ("Contract", "ConId"), contract,
+                           future.result().contract.conId)
+
     @printWhenExecuting
     def newsOperations_req(self):
         # Requesting news ticks
@@ -1148,60 +1348,67 @@ class TestApp(TestWrapper, TestClient):
     #! [tickNews]
     def tickNews(self, tickerId: int, timeStamp: int, providerCode: str,
                  articleId: str, headline: str, extraData: str):
-        print("TickNews. TickerId:", tickerId, "TimeStamp:", timeStamp,
-              "ProviderCode:", providerCode, "ArticleId:", articleId,
-              "Headline:", headline, "ExtraData:", extraData)
+        self.sink.emit("TickNews", ("TickerId", "TimeStamp", "ProviderCode", "ArticleId",
+                                   "Headline", "ExtraData"),
+                       tickerId, timeStamp, providerCode, articleId, headline, extraData)
     #! [tickNews]
 
     @iswrapper
     #! [historicalNews]
     def historicalNews(self, reqId: int, time: str, providerCode: str,
                        articleId: str, headline: str):
-        print("HistoricalNews. ReqId:", reqId, "Time:", time,
-              "ProviderCode:", providerCode, "ArticleId:", articleId,
-              "Headline:", headline)
+        self.sink.emit("HistoricalNews", ("ReqId", "Time", "ProviderCode", "ArticleId",
+                                         "Headline"),
+                       reqId, time, providerCode, articleId, headline)
+        self.reqMgr.receivedMsg(reqId, (time, providerCode, articleId, headline))
     #! [historicalNews]
 
     @iswrapper
     #! [historicalNewsEnd]
     def historicalNewsEnd(self, reqId:int, hasMore:bool):
-        print("HistoricalNewsEnd. ReqId:", reqId, "HasMore:", hasMore)
+        self.sink.emit("HistoricalNewsEnd", ("ReqId", "HasMore"), reqId, hasMore)
+        self.reqMgr.receivedEnd(reqId)
     #! [historicalNewsEnd]
 
     @iswrapper
     #! [newsProviders]
     def newsProviders(self, newsProviders: ListOfNewsProviders):
-        print("NewsProviders: ")
         for provider in newsProviders:
-            print("NewsProvider.", provider)
+            self.sink.emit("NewsProvider", ("NewsProvider",), provider)
     #! [newsProviders]
 
     @iswrapper
     #! [newsArticle]
     def newsArticle(self, reqId: int, articleType: int, articleText: str):
-        print("NewsArticle. ReqId:", reqId, "ArticleType:", articleType,
-              "ArticleText:", articleText)
+        self.sink.emit("NewsArticle", ("ReqId", "ArticleType", "ArticleText"), reqId,
+                       articleType, articleText)
+        self.reqMgr.receivedEnd(reqId, (articleType, articleText))
     #! [newsArticle]
 
     @iswrapper
     # ! [contractdetails]
     def contractDetails(self, reqId: int, contractDetails: ContractDetails):
         super().contractDetails(reqId, contractDetails)
-        printinstance(contractDetails)
+        self.sink.emit("ContractDetails", ("ReqId", "ContractDetails"), reqId,
+                       contractDetails)
+        self.reqMgr.receivedMsg(reqId, contractDetails)
     # ! [contractdetails]
 
     @iswrapper
     # ! [bondcontractdetails]
     def bondContractDetails(self, reqId: int, contractDetails: ContractDetails):
         super().bondContractDetails(reqId, contractDetails)
-        printinstance(contractDetails)
+        self.sink.emit("BondContractDetails", ("ReqId", "ContractDetails"), reqId,
+                       contractDetails)
+        self.reqMgr.receivedMsg(reqId, contractDetails)
     # ! [bondcontractdetails]
 
     @iswrapper
     # ! [contractdetailsend]
     def contractDetailsEnd(self, reqId: int):
         super().contractDetailsEnd(reqId)
-        print("ContractDetailsEnd. ReqId:", reqId)
+        self.sink.emit("ContractDetailsEnd", ("ReqId",), reqId)
+        self.reqMgr.receivedEnd(reqId)
     # ! [contractdetailsend]
 
     @iswrapper
@@ -1209,32 +1416,31 @@ class TestApp(TestWrapper, TestClient):
     def symbolSamples(self, reqId: int,
                       contractDescriptions: ListOfContractDescription):
         super().symbolSamples(reqId, contractDescriptions)
-        print("Symbol Samples. Request Id: ", reqId)
-
         for contractDescription in contractDescriptions:
-            derivSecTypes = ""
-            for derivSecType in contractDescription.derivativeSecTypes:
-                derivSecTypes += derivSecType
-                derivSecTypes += " "
-            print("Contract: conId:%s, symbol:%s, secType:%s primExchange:%s, "
-                  "currency:%s, derivativeSecTypes:%s" % (
-                contractDescription.contract.conId,
-                contractDescription.contract.symbol,
-                contractDescription.contract.secType,
-                contractDescription.contract.primaryExchange,
-                contractDescription.contract.currency, derivSecTypes))
+            contract = contractDescription.contract
+            self.sink.emit("SymbolSample", ("ReqId", "ConId", "Symbol", "SecType",
+                                           "PrimExchange", "Currency",
+                                           "DerivativeSecTypes"),
+                           reqId, contract.conId, contract.symbol, contract.secType,
+                           contract.primaryExchange, contract.currency,
+                           " ".join(contractDescription.derivativeSecTypes))
+        self.reqMgr.receivedEnd(reqId, contractDescriptions)
     # ! [symbolSamples]
 
     @printWhenExecuting
     def marketScannersOperations_req(self):
-        # Requesting list of valid scanner parameters which can be used in TWS
-        # ! [reqscannerparameters]
-        self.reqScannerParameters()
-        # ! [reqscannerparameters]
+        # Requesting list of valid scanner parameters which can be used in TWS,
+        # unless they are cached for this server version already
+        self.scannerParams = ScannerParameters.load("cache", self.serverVersion())
+        if self.scannerParams is None:
+            # ! [reqscannerparameters]
+            self.reqScannerParameters()
+            # ! [reqscannerparameters]
 
         # Triggering a scanner subscription
         # ! [reqscannersubscription]
-        self.reqScannerSubscription(7001, ScannerSubscriptionSamples.HighOptVolumePCRatioUSIndexes(), [], [])
+        if self.scannerSubscriptionValid(7001, ScannerSubscriptionSamples.HighOptVolumePCRatioUSIndexes(), []):
+            self.reqScannerSubscription(7001, ScannerSubscriptionSamples.HighOptVolumePCRatioUSIndexes(), [], [])
 
         # Generic Filters
         tagvalues = []
@@ -1242,15 +1448,30 @@ class TestApp(TestWrapper, TestClient):
         tagvalues.append(TagValue("optVolumeAbove", "1000"))
         tagvalues.append(TagValue("avgVolumeAbove", "10000"));
 
-        self.reqScannerSubscription(7002, ScannerSubscriptionSamples.HotUSStkByVolume(), [], tagvalues) # requires TWS v973+
+        if self.scannerSubscriptionValid(7002, ScannerSubscriptionSamples.HotUSStkByVolume(), tagvalues):
+            self.reqScannerSubscription(7002, ScannerSubscriptionSamples.HotUSStkByVolume(), [], tagvalues) # requires TWS v973+
         # ! [reqscannersubscription]
 
         # ! [reqcomplexscanner]
         AAPLConIDTag = [TagValue("underConID", "265598")]
-        self.reqScannerSubscription(7003, ScannerSubscriptionSamples.ComplexOrdersAndTrades(), [], AAPLConIDTag) # requires TWS v975+
+        if self.scannerSubscriptionValid(7003, ScannerSubscriptionSamples.ComplexOrdersAndTrades(), AAPLConIDTag):
+            self.reqScannerSubscription(7003, ScannerSubscriptionSamples.ComplexOrdersAndTrades(), [], AAPLConIDTag) # requires TWS v975+
         
         # ! [reqcomplexscanner]
 
+    def scannerSubscriptionValid(self, reqId: int, subscription: ScannerSubscription,
+                                 filterTagValues: list) -> bool:
+        """ checked against the cached scanner parameters, when there are
+        some; TWS has the last word otherwise """
+        if self.scannerParams is None:
+            return True
+        try:
+            self.scannerParams.validate(subscription, filterTagValues)
+        except InvalidScannerSubscription as e:
+            self.sink.emit("ScannerInvalid", ("ReqId", "Problems"), reqId, e.problems)
+            return False
+        return True
+
 
     @printWhenExecuting
     def marketScanners_cancel(self):
@@ -1260,13 +1481,16 @@ class TestApp(TestWrapper, TestClient):
         self.cancelScannerSubscription(7002)
         self.cancelScannerSubscription(7003)
         # ! [cancelscannersubscription]
+        for reqId in (7001, 7002, 7003):
+            self.scanDiffer.forget(reqId)
 
     @iswrapper
     # ! [scannerparameters]
     def scannerParameters(self, xml: str):
         super().scannerParameters(xml)
-        open('log/scanner.xml', 'w').write(xml)
-        print("ScannerParameters received.")
+        self.scannerParams = ScannerParameters.parse(xml, self.serverVersion())
+        self.scannerParams.save("cache")
+        self.sink.emit("ScannerParameters", ("Parameters",), self.scannerParams)
     # ! [scannerparameters]
 
     @iswrapper
@@ -1280,23 +1504,35 @@ class TestApp(TestWrapper, TestClient):
 #              "Currency:", contractDetails.contract.currency,
 #              "Distance:", distance, "Benchmark:", benchmark,
 #              "Projection:", projection, "Legs String:", legsStr)
-        print("ScannerData. ReqId:", reqId, ScanData(contractDetails.contract, rank, distance, benchmark, projection, legsStr))
+        # the rows are only reported through the delta at scannerDataEnd
+        self.scanDiffer.scannerData(reqId, rank, contractDetails, distance,
+                                    benchmark, projection, legsStr)
+        self.reqMgr.receivedMsg(reqId, ScanData(contractDetails.contract, rank,
+                                                distance, benchmark, projection,
+                                                legsStr))
     # ! [scannerdata]
 
     @iswrapper
     # ! [scannerdataend]
     def scannerDataEnd(self, reqId: int):
         super().scannerDataEnd(reqId)
-        print("ScannerDataEnd. ReqId:", reqId)
+        self.sink.emit("ScannerDataEnd", ("ReqId",), reqId)
+        self.scanDiffer.scannerDataEnd(reqId)
+        self.reqMgr.receivedEnd(reqId)
         # ! [scannerdataend]
 
+    def scanDelta(self, delta):
+        self.sink.emit("ScannerDelta", ("ReqId", "Refresh", "Entered", "Exited", "Moved"),
+                       delta.reqId, delta.refresh, delta.entered, delta.exited,
+                       delta.moved)
+
     @iswrapper
     # ! [smartcomponents]
     def smartComponents(self, reqId:int, smartComponentMap:SmartComponentMap):
         super().smartComponents(reqId, smartComponentMap)
-        print("SmartComponents:")
         for smartComponent in smartComponentMap:
-            print("SmartComponent.", smartComponent)
+            self.sink.emit("SmartComponent", ("ReqId", "SmartComponent"), reqId,
+                           smartComponent)
     # ! [smartcomponents]
 
     @iswrapper
@@ -1304,17 +1540,17 @@ class TestApp(TestWrapper, TestClient):
     def tickReqParams(self, tickerId:int, minTick:float,
                       bboExchange:str, snapshotPermissions:int):
         super().tickReqParams(tickerId, minTick, bboExchange, snapshotPermissions)
-        print("TickReqParams. TickerId:", tickerId, "MinTick:", minTick,
-              "BboExchange:", bboExchange, "SnapshotPermissions:", snapshotPermissions)
+        self.sink.emit("TickReqParams", ("TickerId", "MinTick", "BboExchange",
+                                        "SnapshotPermissions"),
+                       tickerId, minTick, bboExchange, snapshotPermissions)
     # ! [tickReqParams]
 
     @iswrapper
     # ! [mktDepthExchanges]
     def mktDepthExchanges(self, depthMktDataDescriptions:ListOfDepthExchanges):
         super().mktDepthExchanges(depthMktDataDescriptions)
-        print("MktDepthExchanges:")
         for desc in depthMktDataDescriptions:
-            print("DepthMktDataDescription.", desc)
+            self.sink.emit("DepthMktDataDescription", ("DepthMktDataDescription",), desc)
     # ! [mktDepthExchanges]
 
     @printWhenExecuting
@@ -1351,7 +1587,8 @@ class TestApp(TestWrapper, TestClient):
     # ! [fundamentaldata]
     def fundamentalData(self, reqId: TickerId, data: str):
         super().fundamentalData(reqId, data)
-        print("FundamentalData. ReqId:", reqId, "Data:", data)
+        self.sink.emit("FundamentalData", ("ReqId", "Data"), reqId, data)
+        self.reqMgr.receivedEnd(reqId, data)
     # ! [fundamentaldata]
 
     @printWhenExecuting
@@ -1373,8 +1610,9 @@ class TestApp(TestWrapper, TestClient):
     def updateNewsBulletin(self, msgId: int, msgType: int, newsMessage: str,
                            originExch: str):
         super().updateNewsBulletin(msgId, msgType, newsMessage, originExch)
-        print("News Bulletins. MsgId:", msgId, "Type:", msgType, "Message:", newsMessage,
-              "Exchange of Origin: ", originExch)
+        self.sink.emit("UpdateNewsBulletin", ("MsgId", "Type", "Message",
+                                             "ExchangeOfOrigin"),
+                       msgId, msgType, newsMessage, originExch)
         # ! [updatenewsbulletin]
 
     def ocaSample(self):
@@ -1382,10 +1620,9 @@ class TestApp(TestWrapper, TestClient):
         # ! [ocasubmit]
         ocaOrders = [OrderSamples.LimitOrder("BUY", 1, 10), OrderSamples.LimitOrder("BUY", 1, 11),
                      OrderSamples.LimitOrder("BUY", 1, 12)]
-        OrderSamples.OneCancelsAll("TestOCA_" + str(self.nextValidOrderId), ocaOrders, 2)
-        for o in ocaOrders:
-            self.placeOrder(self.nextOrderId(), ContractSamples.USStockAtSmart(), o)
-            # ! [ocasubmit]
+        OrderSamples.OneCancelsAll("TestOCA_" + str(self.orderBatcher.nextId), ocaOrders, 2)
+        self.orderBatcher.submit([(ContractSamples.USStockAtSmart(), o) for o in ocaOrders])
+        # ! [ocasubmit]
 
     def conditionSamples(self):
         # ! [order_conditioning_activate]
@@ -1416,11 +1653,11 @@ class TestApp(TestWrapper, TestClient):
     def bracketSample(self):
         # BRACKET ORDER
         # ! [bracketsubmit]
-        bracket = OrderSamples.BracketOrder(self.nextOrderId(), "BUY", 100, 30, 40, 20)
-        for o in bracket:
-            self.placeOrder(o.orderId, ContractSamples.EuropeanStock(), o)
-            self.nextOrderId()  # need to advance this we'll skip one extra oid, it's fine
-            # ! [bracketsubmit]
+        # ids 1..3 are local to the batch, the batcher renumbers them and the
+        # parentIds of the children
+        bracket = OrderSamples.BracketOrder(1, "BUY", 100, 30, 40, 20)
+        self.orderBatcher.submit([(ContractSamples.EuropeanStock(), o) for o in bracket])
+        # ! [bracketsubmit]
 
     def hedgeSample(self):
         # F Hedge order
@@ -1575,7 +1812,7 @@ class TestApp(TestWrapper, TestClient):
     # ! [receivefa]
     def receiveFA(self, faData: FaDataType, cxml: str):
         super().receiveFA(faData, cxml)
-        print("Receiving FA: ", faData)
+        self.sink.emit("ReceiveFA", ("FaData",), faData)
         open('log/fa.xml', 'w').write(cxml)
     # ! [receivefa]
 
@@ -1583,9 +1820,8 @@ class TestApp(TestWrapper, TestClient):
     # ! [softDollarTiers]
     def softDollarTiers(self, reqId: int, tiers: list):
         super().softDollarTiers(reqId, tiers)
-        print("SoftDollarTiers. ReqId:", reqId)
         for tier in tiers:
-            print("SoftDollarTier.", tier)
+            self.sink.emit("SoftDollarTier", ("ReqId", "SoftDollarTier"), reqId, tier)
     # ! [softDollarTiers]
 
     @printWhenExecuting
@@ -1617,14 +1853,15 @@ class TestApp(TestWrapper, TestClient):
     # ! [displaygrouplist]
     def displayGroupList(self, reqId: int, groups: str):
         super().displayGroupList(reqId, groups)
-        print("DisplayGroupList. ReqId:", reqId, "Groups", groups)
+        self.sink.emit("DisplayGroupList", ("ReqId", "Groups"), reqId, groups)
     # ! [displaygrouplist]
 
     @iswrapper
     # ! [displaygroupupdated]
     def displayGroupUpdated(self, reqId: int, contractInfo: str):
         super().displayGroupUpdated(reqId, contractInfo)
-        print("DisplayGroupUpdated. ReqId:", reqId, "ContractInfo:", contractInfo)
+        self.sink.emit("DisplayGroupUpdated", ("ReqId", "ContractInfo"), reqId,
+                       contractInfo)
     # ! [displaygroupupdated]
 
     @printWhenExecuting
@@ -1660,8 +1897,9 @@ class TestApp(TestWrapper, TestClient):
         # ! [reqopenorders]
 
 
-        # Placing/modifying an order - remember to ALWAYS increment the
-        # nextValidId after placing an order so it can be used for the next one!
+        # Placing/modifying an order - every order needs an id of its own,
+        # nextOrderId() and the batcher both take them from the range
+        # starting at nextValidId.
         # Note if there are multiple clients connected to an account, the
         # order ID must also be greater than all order IDs returned for orders
         # to orderStatus and openOrder to this client.
@@ -1672,18 +1910,19 @@ class TestApp(TestWrapper, TestClient):
                         OrderSamples.LimitOrder("SELL", 1, 50))
         # ! [order_submission]
 
+        basket = []
         # ! [faorderoneaccount]
         faOrderOneAccount = OrderSamples.MarketOrder("BUY", 100)
         # Specify the Account Number directly
         faOrderOneAccount.account = "DU119915"
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(), faOrderOneAccount)
+        basket.append((ContractSamples.USStock(), faOrderOneAccount))
         # ! [faorderoneaccount]
 
         # ! [faordergroupequalquantity]
         faOrderGroupEQ = OrderSamples.LimitOrder("SELL", 200, 2000)
         faOrderGroupEQ.faGroup = "Group_Equal_Quantity"
         faOrderGroupEQ.faMethod = "EqualQuantity"
-        self.placeOrder(self.nextOrderId(), ContractSamples.SimpleFuture(), faOrderGroupEQ)
+        basket.append((ContractSamples.SimpleFuture(), faOrderGroupEQ))
         # ! [faordergroupequalquantity]
 
         # ! [faordergrouppctchange]
@@ -1692,70 +1931,51 @@ class TestApp(TestWrapper, TestClient):
         faOrderGroupPC.faGroup = "Pct_Change"
         faOrderGroupPC.faMethod = "PctChange"
         faOrderGroupPC.faPercentage = "100"
-        self.placeOrder(self.nextOrderId(), ContractSamples.EurGbpFx(), faOrderGroupPC)
+        basket.append((ContractSamples.EurGbpFx(), faOrderGroupPC))
         # ! [faordergrouppctchange]
 
         # ! [faorderprofile]
         faOrderProfile = OrderSamples.LimitOrder("BUY", 200, 100)
         faOrderProfile.faProfile = "Percent_60_40"
-        self.placeOrder(self.nextOrderId(), ContractSamples.EuropeanStock(), faOrderProfile)
+        basket.append((ContractSamples.EuropeanStock(), faOrderProfile))
         # ! [faorderprofile]
 
         # ! [modelorder]
         modelOrder = OrderSamples.LimitOrder("BUY", 200, 100)
         modelOrder.account = "DF12345"
         modelOrder.modelCode = "Technology" # model for tech stocks first created in TWS
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(), modelOrder)
+        basket.append((ContractSamples.USStock(), modelOrder))
         # ! [modelorder]
 
-        self.placeOrder(self.nextOrderId(), ContractSamples.OptionAtBOX(),
-                        OrderSamples.Block("BUY", 50, 20))
-        self.placeOrder(self.nextOrderId(), ContractSamples.OptionAtBOX(),
-                         OrderSamples.BoxTop("SELL", 10))
-        self.placeOrder(self.nextOrderId(), ContractSamples.FutureComboContract(),
-                         OrderSamples.ComboLimitOrder("SELL", 1, 1, False))
-        self.placeOrder(self.nextOrderId(), ContractSamples.StockComboContract(),
-                          OrderSamples.ComboMarketOrder("BUY", 1, True))
-        self.placeOrder(self.nextOrderId(), ContractSamples.OptionComboContract(),
-                          OrderSamples.ComboMarketOrder("BUY", 1, False))
-        self.placeOrder(self.nextOrderId(), ContractSamples.StockComboContract(),
-                          OrderSamples.LimitOrderForComboWithLegPrices("BUY", 1, [10, 5], True))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                         OrderSamples.Discretionary("SELL", 1, 45, 0.5))
-        self.placeOrder(self.nextOrderId(), ContractSamples.OptionAtBOX(),
-                          OrderSamples.LimitIfTouched("BUY", 1, 30, 34))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                          OrderSamples.LimitOnClose("SELL", 1, 34))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                          OrderSamples.LimitOnOpen("BUY", 1, 35))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                          OrderSamples.MarketIfTouched("BUY", 1, 30))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                         OrderSamples.MarketOnClose("SELL", 1))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                          OrderSamples.MarketOnOpen("BUY", 1))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                          OrderSamples.MarketOrder("SELL", 1))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                          OrderSamples.MarketToLimit("BUY", 1))
-        self.placeOrder(self.nextOrderId(), ContractSamples.OptionAtIse(),
-                          OrderSamples.MidpointMatch("BUY", 1))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                          OrderSamples.MarketToLimit("BUY", 1))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                          OrderSamples.Stop("SELL", 1, 34.4))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                          OrderSamples.StopLimit("BUY", 1, 35, 33))
-        self.placeOrder(self.nextOrderId(), ContractSamples.SimpleFuture(),
-                          OrderSamples.StopWithProtection("SELL", 1, 45))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                          OrderSamples.SweepToFill("BUY", 1, 35))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                          OrderSamples.TrailingStop("SELL", 1, 0.5, 30))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USStock(),
-                          OrderSamples.TrailingStopLimit("BUY", 1, 2, 5, 50))
-        self.placeOrder(self.nextOrderId(), ContractSamples.USOptionContract(),
-                         OrderSamples.Volatility("SELL", 1, 5, 2))
+        basket += [
+            (ContractSamples.OptionAtBOX(), OrderSamples.Block("BUY", 50, 20)),
+            (ContractSamples.OptionAtBOX(), OrderSamples.BoxTop("SELL", 10)),
+            (ContractSamples.FutureComboContract(), OrderSamples.ComboLimitOrder("SELL", 1, 1, False)),
+            (ContractSamples.StockComboContract(), OrderSamples.ComboMarketOrder("BUY", 1, True)),
+            (ContractSamples.OptionComboContract(), OrderSamples.ComboMarketOrder("BUY", 1, False)),
+            (ContractSamples.StockComboContract(), OrderSamples.LimitOrderForComboWithLegPrices("BUY", 1, [10, 5], True)),
+            (ContractSamples.USStock(), OrderSamples.Discretionary("SELL", 1, 45, 0.5)),
+            (ContractSamples.OptionAtBOX(), OrderSamples.LimitIfTouched("BUY", 1, 30, 34)),
+            (ContractSamples.USStock(), OrderSamples.LimitOnClose("SELL", 1, 34)),
+            (ContractSamples.USStock(), OrderSamples.LimitOnOpen("BUY", 1, 35)),
+            (ContractSamples.USStock(), OrderSamples.MarketIfTouched("BUY", 1, 30)),
+            (ContractSamples.USStock(), OrderSamples.MarketOnClose("SELL", 1)),
+            (ContractSamples.USStock(), OrderSamples.MarketOnOpen("BUY", 1)),
+            (ContractSamples.USStock(), OrderSamples.MarketOrder("SELL", 1)),
+            (ContractSamples.USStock(), OrderSamples.MarketToLimit("BUY", 1)),
+            (ContractSamples.OptionAtIse(), OrderSamples.MidpointMatch("BUY", 1)),
+            (ContractSamples.USStock(), OrderSamples.MarketToLimit("BUY", 1)),
+            (ContractSamples.USStock(), OrderSamples.Stop("SELL", 1, 34.4)),
+            (ContractSamples.USStock(), OrderSamples.StopLimit("BUY", 1, 35, 33)),
+            (ContractSamples.SimpleFuture(), OrderSamples.StopWithProtection("SELL", 1, 45)),
+            (ContractSamples.USStock(), OrderSamples.SweepToFill("BUY", 1, 35)),
+            (ContractSamples.USStock(), OrderSamples.TrailingStop("SELL", 1, 0.5, 30)),
+            (ContractSamples.USStock(), OrderSamples.TrailingStopLimit("BUY", 1, 2, 5, 50)),
+            (ContractSamples.USOptionContract(), OrderSamples.Volatility("SELL", 1, 5, 2)),
+        ]
+        # one id range and one socket write for the whole basket, the
+        # acknowledgements are tracked in self.orderBatch
+        self.orderBatch = self.orderBatcher.submit(basket)
 
         self.bracketSample()
 
@@ -1840,28 +2060,33 @@ class TestApp(TestWrapper, TestClient):
     # ! [execdetails]
     def execDetails(self, reqId: int, contract: Contract, execution: Execution):
         super().execDetails(reqId, contract, execution)
-        print("ExecDetails. ReqId:", reqId, "Symbol:", contract.symbol, "SecType:", contract.secType, "Currency:", contract.currency, execution)
+        self.sink.emit("ExecDetails", ("ReqId", "Symbol", "SecType", "Currency", "Execution"),
+                       reqId, contract.symbol, contract.secType, contract.currency, execution)
+        self.orderTracker.execDetails(reqId, contract, execution)
+        self.reqMgr.receivedMsg(reqId, (contract, execution))
     # ! [execdetails]
 
     @iswrapper
     # ! [execdetailsend]
     def execDetailsEnd(self, reqId: int):
         super().execDetailsEnd(reqId)
-        print("ExecDetailsEnd. ReqId:", reqId)
+        self.sink.emit("ExecDetailsEnd", ("ReqId",), reqId)
+        self.reqMgr.receivedEnd(reqId)
     # ! [execdetailsend]
 
     @iswrapper
     # ! [commissionreport]
     def commissionReport(self, commissionReport: CommissionReport):
         super().commissionReport(commissionReport)
-        print("CommissionReport.", commissionReport)
+        self.sink.emit("CommissionReport", ("CommissionReport",), commissionReport)
+        self.orderTracker.commissionReport(commissionReport)
     # ! [commissionreport]
 
     @iswrapper
     # ! [currenttime]
     def currentTime(self, time:int):
         super().currentTime(time)
-        print("CurrentTime:", datetime.datetime.fromtimestamp(time).strftime("%Y%m%d %H:%M:%S"))
+        self.sink.emit("CurrentTime", ("Time",), time)
     # ! [currenttime]
 
     @iswrapper
@@ -1869,21 +2094,42 @@ class TestApp(TestWrapper, TestClient):
     def completedOrder(self, contract: Contract, order: Order,
                   orderState: OrderState):
         super().completedOrder(contract, order, orderState)
-        print("CompletedOrder. PermId:", order.permId, "ParentPermId:", utils.longToStr(order.parentPermId), "Account:", order.account, 
-              "Symbol:", contract.symbol, "SecType:", contract.secType, "Exchange:", contract.exchange, 
-              "Action:", order.action, "OrderType:", order.orderType, "TotalQty:", order.totalQuantity, 
-              "CashQty:", order.cashQty, "FilledQty:", order.filledQuantity, 
-              "LmtPrice:", order.lmtPrice, "AuxPrice:", order.auxPrice, "Status:", orderState.status,
-              "Completed time:", orderState.completedTime, "Completed Status:" + orderState.completedStatus)
+        self.sink.emit("CompletedOrder", ("PermId", "ParentPermId", "Account", "Symbol",
+                                         "SecType", "Exchange", "Action", "OrderType",
+                                         "TotalQty", "CashQty", "FilledQty", "LmtPrice",
+                                         "AuxPrice", "Status", "CompletedTime",
+                                         "CompletedStatus"),
+                       order.permId, utils.longToStr(order.parentPermId), order.account,
+                       contract.symbol, contract.secType, contract.exchange, order.action,
+                       order.orderType, order.totalQuantity, order.cashQty,
+                       order.filledQuantity, order.lmtPrice, order.auxPrice,
+                       orderState.status, orderState.completedTime,
+                       orderState.completedStatus)
+        self.orderTracker.completedOrder(contract, order, orderState)
     # ! [completedorder]
 
     @iswrapper
     # ! [completedordersend]
     def completedOrdersEnd(self):
         super().completedOrdersEnd()
-        print("CompletedOrdersEnd")
+        self.sink.emit("CompletedOrdersEnd", ())
     # ! [completedordersend]
 
+def makeDispatchWorker(sinkKind: str, sinkPath: str, journalDir: str,
+                       workerIndex: int):
+    """ wrapper of a dispatch worker process (see MultiprocessDispatch),
+    reporting to a sink like the front's, a file of its own if it has one;
+    it journals the tick-by-tick streams routed to it """
+    if sinkPath is not None:
+        sinkPath = "%s.%d" % (sinkPath, workerIndex)
+    app = TestApp(instrument=False, sink=makeSink(sinkKind, sinkPath),
+                  dispatchWorker=True)
+    if journalDir:
+        # one file per reqId, a reqId always goes to the same worker
+        app.tickJournals = TickJournals(journalDir)
+    return app
+
+
 def main():
     SetupLogger()
     logging.debug("now is %s", datetime.datetime.now())
@@ -1897,6 +2143,22 @@ def main():
     cmdLineParser.add_argument("-C", "--global-cancel", action="store_true",
                                dest="global_cancel", default=False,
                                help="whether to trigger a globalCancel req")
+    cmdLineParser.add_argument("-n", "--no-instrument", action="store_true",
+                               dest="no_instrument", default=False,
+                               help="don't count the calls for test coverage")
+    cmdLineParser.add_argument("-s", "--sink", action="store", dest="sink",
+                               choices=("console", "jsonl", "binary", "none"),
+                               default="console", help="where the callbacks report to")
+    cmdLineParser.add_argument("-o", "--sink-file", action="store", dest="sink_file",
+                               default=None,
+                               help="output file of the sink (required for jsonl/binary)")
+    cmdLineParser.add_argument("-j", "--tick-journal", action="store", dest="tick_journal",
+                               default=None,
+                               help="directory to journal the tick-by-tick data to")
+    cmdLineParser.add_argument("-w", "--workers", action="store", type=int,
+                               dest="workers", default=0,
+                               help="run the callbacks of the requests in this many "
+                                    "worker processes, partitioned by reqId")
     args = cmdLineParser.parse_args()
     print("Using args", args)
     logging.debug("Using args %s", args)
@@ -1926,21 +2188,35 @@ def main():
     # sys.exit(1)
 
     try:
-        app = TestApp()
+        app = TestApp(instrument=not args.no_instrument,
+                      sink=makeSink(args.sink, args.sink_file))
         if args.global_cancel:
             app.globalCancelOnly = True
+        if args.tick_journal:
+            app.tickJournals = TickJournals(args.tick_journal)
         # ! [connect]
         app.connect("127.0.0.1", args.port, clientId=0)
         # ! [connect]
         print("serverVersion:%s connectionTime:%s" % (app.serverVersion(),
                                                       app.twsConnectionTime()))
 
-        # ! [clientrun]
-        app.run()
-        # ! [clientrun]
+        if args.workers and app.isConnected():
+            dispatcher = MultiprocessDispatcher(
+                app, functools.partial(makeDispatchWorker, args.sink, args.sink_file,
+                                       args.tick_journal),
+                args.workers, frontReqId=app.frontReqId)
+            dispatcher.start()
+            dispatcher.run()
+        else:
+            # ! [clientrun]
+            app.run()
+            # ! [clientrun]
     except:
         raise
     finally:
+        app.sink.close()
+        if app.tickJournals is not None:
+            app.tickJournals.close()
         app.dumpTestCoverageSituation()
         app.dumpReqAnsErrSituation()
 
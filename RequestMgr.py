@@ -0,0 +1,136 @@
+"""
+Request/answer correlation.
+
+Each tracked request is an Activity indexed by reqId. The wrapper callbacks
+feed the answers with receivedMsg() and resolve the activity on the matching
+*End callback with receivedEnd(), so the caller can block on get() or await
+the activity instead of polling.
+
+    act = app.reqMgr.expect(210, "reqContractDetails")
+    app.reqContractDetails(210, contract)
+    details = act.get(timeout=10)        # or: details = await act.aget()
+"""
+
+import asyncio
+import concurrent.futures
+import queue
+
+from ibapi.message import IN, OUT
+from ibapi.object_implem import Object
+
+from ErrorCodes import isWarning
+
+
+class RequestError(Exception):
+    def __init__(self, reqId: int, errorCode: int, errorString: str):
+        Exception.__init__(self, "reqId %d: %d %s" % (reqId, errorCode, errorString))
+        self.reqId = reqId
+        self.errorCode = errorCode
+        self.errorString = errorString
+
+
+# request -> (request msg id, answer msg id, end of answer msg id)
+# the answer itself is the end for single shot requests
+REQUESTS = {
+    "reqHistoricalData": (OUT.REQ_HISTORICAL_DATA, IN.HISTORICAL_DATA, IN.HISTORICAL_DATA),
+    "reqContractDetails": (OUT.REQ_CONTRACT_DATA, IN.CONTRACT_DATA, IN.CONTRACT_DATA_END),
+    "reqAccountSummary": (OUT.REQ_ACCOUNT_SUMMARY, IN.ACCOUNT_SUMMARY, IN.ACCOUNT_SUMMARY_END),
+    "reqScannerSubscription": (OUT.REQ_SCANNER_SUBSCRIPTION, IN.SCANNER_DATA, IN.SCANNER_DATA),
+    "reqPositionsMulti": (OUT.REQ_POSITIONS_MULTI, IN.POSITION_MULTI, IN.POSITION_MULTI_END),
+    "reqAccountUpdatesMulti": (OUT.REQ_ACCOUNT_UPDATES_MULTI, IN.ACCOUNT_UPDATE_MULTI,
+                               IN.ACCOUNT_UPDATE_MULTI_END),
+    "reqSecDefOptParams": (OUT.REQ_SEC_DEF_OPT_PARAMS, IN.SECURITY_DEFINITION_OPTION_PARAMETER,
+                           IN.SECURITY_DEFINITION_OPTION_PARAMETER_END),
+    "reqExecutions": (OUT.REQ_EXECUTIONS, IN.EXECUTION_DATA, IN.EXECUTION_DATA_END),
+    "reqHistoricalNews": (OUT.REQ_HISTORICAL_NEWS, IN.HISTORICAL_NEWS, IN.HISTORICAL_NEWS_END),
+    "reqMktData": (OUT.REQ_MKT_DATA, IN.TICK_PRICE, IN.TICK_SNAPSHOT_END),
+    "reqMatchingSymbols": (OUT.REQ_MATCHING_SYMBOLS, IN.SYMBOL_SAMPLES, IN.SYMBOL_SAMPLES),
+    "reqHeadTimeStamp": (OUT.REQ_HEAD_TIMESTAMP, IN.HEAD_TIMESTAMP, IN.HEAD_TIMESTAMP),
+    "reqHistogramData": (OUT.REQ_HISTOGRAM_DATA, IN.HISTOGRAM_DATA, IN.HISTOGRAM_DATA),
+    "reqFundamentalData": (OUT.REQ_FUNDAMENTAL_DATA, IN.FUNDAMENTAL_DATA, IN.FUNDAMENTAL_DATA),
+    "reqNewsArticle": (OUT.REQ_NEWS_ARTICLE, IN.NEWS_ARTICLE, IN.NEWS_ARTICLE),
+}
+
+
+class Activity(Object):
+    def __init__(self, reqMsgId, ansMsgId, ansEndMsgId, reqId, stream=False):
+        self.reqMsdId = reqMsgId
+        self.ansMsgId = ansMsgId
+        self.ansEndMsgId = ansEndMsgId
+        self.reqId = reqId
+        self.items = []
+        self.future = concurrent.futures.Future()
+        # streaming consumers read the answers as they arrive
+        self.queue = queue.Queue() if stream else None
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def get(self, timeout: float = None):
+        """ blocks until the end message (or an error) and returns the list
+        of answers """
+        return self.future.result(timeout)
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+    async def aget(self):
+        return await self
+
+
+class RequestMgr(Object):
+    def __init__(self):
+        self.requests = {}
+
+    def addReq(self, req: Activity) -> Activity:
+        self.requests[req.reqId] = req
+        return req
+
+    def expect(self, reqId: int, reqName: str, stream: bool = False) -> Activity:
+        (reqMsgId, ansMsgId, ansEndMsgId) = REQUESTS[reqName]
+        return self.addReq(Activity(reqMsgId, ansMsgId, ansEndMsgId, reqId, stream))
+
+    def find(self, reqId: int) -> Activity:
+        return self.requests.get(reqId)
+
+    def receivedMsg(self, reqId: int, item):
+        req = self.requests.get(reqId)
+        if req is None:
+            return
+        req.items.append(item)
+        if req.queue is not None:
+            req.queue.put(item)
+
+    def receivedEnd(self, reqId: int, item=None):
+        """ the item, if any, is a last answer carried by the end message """
+        req = self.requests.pop(reqId, None)
+        if req is None:
+            return
+        if item is not None:
+            req.items.append(item)
+        if req.queue is not None:
+            if item is not None:
+                req.queue.put(item)
+            req.queue.put(None)
+        if not req.future.done():
+            req.future.set_result(req.items)
+
+    def receivedError(self, reqId: int, errorCode: int, errorString: str):
+        # the request is still alive
+        if isWarning(errorCode):
+            return
+        req = self.requests.pop(reqId, None)
+        if req is None:
+            return
+        if req.queue is not None:
+            req.queue.put(None)
+        if not req.future.done():
+            req.future.set_exception(RequestError(reqId, errorCode, errorString))
+
+    def cancel(self, reqId: int):
+        req = self.requests.pop(reqId, None)
+        if req is None:
+            return
+        if req.queue is not None:
+            req.queue.put(None)
+        req.future.cancel()
@@ -0,0 +1,81 @@
+"""
+Preallocated single producer / single consumer ring buffer of fixed layout
+records.
+
+The records live in one NumPy structured array allocated up front, of a
+fixed layout such as BAR_RECORD. A wrapper callback (the producer, on the
+reader thread) publishes a tuple of plain values into the next free row; the consumer (any other single thread) drains
+everything published so far in one batch, as a structured array. head is
+only written by the producer and tail only by the consumer, each after the
+records it covers, so no lock is needed: under the GIL the stores of the two
+counters are atomic and ordered after the row writes.
+
+    bars = RingBuffer(BAR_RECORD)
+    bars.publish((reqId, epoch, open_, high, low, close, volume, wap, count))
+    for record in bars.drain().tolist():   # on the consumer thread
+        ...
+"""
+
+import time
+
+import numpy as np
+
+from ibapi.object_implem import Object
+
+BAR_RECORD = np.dtype([("reqId", "<i4"), ("time", "<i8"), ("open", "<f8"),
+                       ("high", "<f8"), ("low", "<f8"), ("close", "<f8"),
+                       ("volume", "<f8"), ("average", "<f8"), ("barCount", "<i4")])
+
+
+class RingBuffer(Object):
+    def __init__(self, dtype: np.dtype, capacity: int = 1 << 16,
+                 blocking: bool = True):
+        if capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of 2, not %d" % capacity)
+        self.records = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.mask = capacity - 1
+        # a full ring holds the producer back (blocking) or drops the record
+        self.blocking = blocking
+        # producer side
+        self.head = 0
+        self.nFull = 0
+        self.nDropped = 0
+        # consumer side
+        self.tail = 0
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def publish(self, record: tuple) -> bool:
+        """ producer only; False if the record was dropped """
+        head = self.head
+        if head - self.tail == self.capacity:
+            self.nFull += 1
+            if not self.blocking:
+                self.nDropped += 1
+                return False
+            while head - self.tail == self.capacity:
+                time.sleep(0)
+        self.records[head & self.mask] = record
+        self.head = head + 1
+        return True
+
+    def drain(self, maxRecords: int = None) -> np.ndarray:
+        """ consumer only; a copy of the records published so far, oldest
+        first, at most maxRecords of them """
+        tail = self.tail
+        n = self.head - tail
+        if maxRecords is not None:
+            n = min(n, maxRecords)
+        if n == 0:
+            return self.records[:0].copy()
+        start = tail & self.mask
+        end = start + n
+        if end <= self.capacity:
+            batch = self.records[start:end].copy()
+        else:
+            batch = np.concatenate((self.records[start:],
+                                    self.records[:end - self.capacity]))
+        self.tail = tail + n
+        return batch
@@ -0,0 +1,262 @@
+"""
+Scanner to candle analysis pipeline: symbols appearing in live scanner
+results get their recent history and are analyzed as soon as it is there.
+
+Fed by the deltas of a ScannerDiffer, so only entries and exits are looked
+at. A conId is followed while at least one scanner lists it (several
+scanners listing it count once) and was not already followed elsewhere
+(ignoreConIds). For each new one:
+    reader thread   queued with its scan time; at most maxInFlight history
+                    requests are out at once, the best ranked entries first,
+                    through the HistoricalBarCache (cached bars are not
+                    fetched again, a symbol coming back only fetches what it
+                    missed)
+    main thread     poll() appends the bars to the BarStore, reports the
+                    symbol to onReady and runs the CandleAnalyzer on the
+                    symbols that just became ready
+The scan to signal latency (scannerDataEnd to the analysis including the
+symbol) is recorded for every symbol, from the scan it entered with even if
+it had to wait for room. It is bounded: an entry that could not be requested
+within maxLatency of its admission, or whose history did not come within
+maxLatency of the request (stuck in the pacing queue: it is cancelled), is
+given up for now and tried again on a later refresh of the scanners;
+maxSymbols bounds the number of symbols followed (and of history requests).
+
+    pipeline = ScanPipeline(differ, app.bar_cache, app.fetched_data,
+                            CandleAnalyzer(4), "5 mins", "TRADES", 0, 900,
+                            onReady=subscribeBars, onGone=cancelBars)
+    # main loop:
+    analysis = pipeline.poll()           # None when nothing became ready
+    pipeline.latencyStats()
+"""
+
+import collections
+import functools
+import threading
+import time
+
+import numpy as np
+
+from ibapi.object_implem import Object
+
+from BarStore import BarStore
+from CandleAnalyzer import CandleAnalysis, CandleAnalyzer
+from ContractCache import conIdContract
+from HistoricalBarCache import HistoricalBarCache
+from ScannerDiffer import ScanDelta, ScannerDiffer
+
+
+class ScanPipeline(Object):
+    def __init__(self, differ: ScannerDiffer, barCache: HistoricalBarCache,
+                 store: BarStore, analyzer: CandleAnalyzer, barSizeSetting: str,
+                 whatToShow: str, useRTH: int, historySeconds: float,
+                 exchange: str = "SMART", ignoreConIds=(), maxInFlight: int = 4,
+                 maxSymbols: int = 40, maxLatency: float = 30.,
+                 onReady=None, onGone=None):
+        self.differ = differ
+        self.barCache = barCache
+        self.store = store
+        self.analyzer = analyzer
+        self.barSizeSetting = barSizeSetting
+        self.whatToShow = whatToShow
+        self.useRTH = useRTH
+        self.historySeconds = historySeconds
+        self.exchange = exchange
+        self.ignoreConIds = set(ignoreConIds)
+        self.maxInFlight = maxInFlight
+        self.maxSymbols = maxSymbols
+        self.maxLatency = maxLatency
+        # onReady(symbol, contract) / onGone(symbol), from poll()
+        self.onReady = onReady
+        self.onGone = onGone
+        # conId -> reqIds of the scanners listing it
+        self.listed = {}
+        # listed but not followed yet, best ranked first: conId -> scan time
+        self.deferred = {}
+        # conId -> (scan time, admission time)
+        self.waiting = {}
+        # conId -> [scan time, request time, CacheRequest]
+        self.inFlight = {}
+        self.active = set()
+        # reader thread -> main thread
+        self.completed = collections.deque()
+        self.gone = collections.deque()
+        self.conId2symbol = {}
+        self.symbol2conId = {}
+        # conId -> time of the last bar when it stopped being followed
+        self.lastBarTime = {}
+        self.latencies = collections.deque(maxlen=4096)
+        self.nExpired = 0
+        self.nFailed = 0
+        self.lock = threading.Lock()
+        differ.listeners.append(self.scanDelta)
+
+    def _nFollowed(self) -> int:
+        return len(self.active) + len(self.inFlight) + len(self.waiting)
+
+    def scanDelta(self, delta: ScanDelta):
+        """ ScannerDiffer listener, reader thread """
+        now = time.perf_counter()
+        with self.lock:
+            for (conId, _) in delta.exited:
+                reqIds = self.listed.get(conId)
+                if reqIds is None:
+                    continue
+                reqIds.discard(delta.reqId)
+                if reqIds:
+                    continue
+                del self.listed[conId]
+                self.deferred.pop(conId, None)
+                self.waiting.pop(conId, None)
+                if conId in self.active:
+                    self.gone.append(conId)
+            for (conId, _) in delta.entered:
+                reqIds = self.listed.setdefault(conId, set())
+                if not reqIds and conId not in self.ignoreConIds \
+                        and conId not in self.active and conId not in self.inFlight:
+                    self.deferred[conId] = now
+                reqIds.add(delta.reqId)
+            self._admit(now)
+        self._pump()
+
+    def _admit(self, now: float):
+        # entries given up before or beyond maxSymbols get another chance
+        while self.deferred and self._nFollowed() < self.maxSymbols:
+            conId = next(iter(self.deferred))
+            self.waiting[conId] = (self.deferred.pop(conId), now)
+
+    def _expire(self, now: float):
+        """ cancel the history requests out for more than maxLatency, their
+        slots go to the next waiting entries """
+        with self.lock:
+            stuck = [(conId, entry[2]) for (conId, entry) in self.inFlight.items()
+                     if entry[2] is not None and now - entry[1] > self.maxLatency]
+        for (conId, req) in stuck:
+            # False: the bars came meanwhile, _fetched has it
+            if not self.barCache.cancel(req):
+                continue
+            with self.lock:
+                entry = self.inFlight.pop(conId)
+                self.nExpired += 1
+                if conId in self.listed:
+                    self.deferred[conId] = entry[0]
+
+    def _pump(self):
+        now = time.perf_counter()
+        self._expire(now)
+        starts = []
+        with self.lock:
+            while self.waiting and len(self.inFlight) < self.maxInFlight:
+                conId = next(iter(self.waiting))
+                (scanTime, admitTime) = self.waiting.pop(conId)
+                if now - admitTime > self.maxLatency:
+                    self.nExpired += 1
+                    self.deferred[conId] = scanTime
+                    continue
+                self.inFlight[conId] = [scanTime, now, None]
+                starts.append((conId, self.lastBarTime.get(conId, 0)))
+        for (conId, lastBarTime) in starts:
+            contract = conIdContract(self.differ.details(conId), self.exchange)
+            start = max(time.time() - self.historySeconds, lastBarTime)
+            req = self.barCache.request(contract, self.barSizeSetting, self.whatToShow,
+                                        self.useRTH, start,
+                                        onDone=functools.partial(self._fetched, conId))
+            with self.lock:
+                entry = self.inFlight.get(conId)
+                # None: answered from the cache right away
+                if entry is not None and entry[2] is None:
+                    entry[2] = req
+
+    def _fetched(self, conId: int, req):
+        with self.lock:
+            entry = self.inFlight.get(conId)
+            # a cancelled request completing anyway
+            if entry is None or entry[2] not in (None, req):
+                return
+            del self.inFlight[conId]
+        self.completed.append((conId, entry[0], req))
+        self._pump()
+
+    def _symbol(self, conId: int) -> str:
+        symbol = self.conId2symbol.get(conId)
+        if symbol is None:
+            symbol = self.differ.details(conId).contract.symbol
+            # the same symbol on another exchange, or followed elsewhere
+            if symbol in self.store.symbol2row and self.symbol2conId.get(symbol) != conId:
+                symbol = "%s.%d" % (symbol, conId)
+            self.conId2symbol[conId] = symbol
+            self.symbol2conId[symbol] = conId
+        return symbol
+
+    def poll(self) -> CandleAnalysis:
+        """ main thread: the analysis of the symbols which just became
+        ready, None if there are none """
+        store = self.store
+        # the deadline of the history requests out
+        self._pump()
+        nGone = len(self.gone)
+        while self.gone:
+            conId = self.gone.popleft()
+            symbol = self.conId2symbol[conId]
+            with self.lock:
+                if conId in self.listed:
+                    # back before we got here
+                    continue
+                self.active.discard(conId)
+                row = store.symbol2row[symbol]
+                n = int(store.counts[row])
+                self.lastBarTime[conId] = int(store.time[row, n - 1]) if n else 0
+            if self.onGone is not None:
+                self.onGone(symbol)
+        if nGone:
+            with self.lock:
+                self._admit(time.perf_counter())
+            self._pump()
+
+        ready = []
+        scanTimes = []
+        while self.completed:
+            (conId, scanTime, req) = self.completed.popleft()
+            bars = req.get()
+            if conId not in self.listed:
+                continue
+            if req.errors and not len(bars["time"]):
+                self.nFailed += 1
+                continue
+            symbol = self._symbol(conId)
+            row = store.addSymbol(symbol)
+            n = int(store.counts[row])
+            # the store only grows forward, its last bar may be overwritten
+            first = int(np.searchsorted(bars["time"], store.time[row, n - 1])) if n else 0
+            for i in range(first, len(bars["time"])):
+                store.append(row, int(bars["time"][i]), bars["open"][i], bars["high"][i],
+                             bars["low"][i], bars["close"][i], bars["volume"][i],
+                             int(bars["barCount"][i]), bars["average"][i])
+            with self.lock:
+                self.active.add(conId)
+            if self.onReady is not None:
+                self.onReady(symbol, conIdContract(self.differ.details(conId),
+                                                   self.exchange))
+            ready.append(symbol)
+            scanTimes.append(scanTime)
+        if not ready:
+            return None
+        analysis = self.analyzer.analyzeStore(store, ready)
+        now = time.perf_counter()
+        self.latencies.extend(now - scanTime for scanTime in scanTimes)
+        return analysis
+
+    def symbols(self) -> list:
+        """ the symbols followed, for the analysis of all of them """
+        with self.lock:
+            return [self.conId2symbol[conId] for conId in self.active]
+
+    def latencyStats(self) -> dict:
+        """ scan to signal latency in seconds: count, p50, p95, max """
+        latencies = np.array(self.latencies)
+        if not len(latencies):
+            return {"count": 0}
+        (p50, p95) = np.percentile(latencies, (50, 95))
+        return {"count": len(latencies), "p50": float(p50), "p95": float(p95),
+                "max": float(latencies.max()), "expired": self.nExpired,
+                "failed": self.nFailed}
@@ -0,0 +1,127 @@
+"""
+Scanner result differ: every refresh of a scanner subscription resends the
+whole ranked list, this turns it into what changed.
+
+The scannerData rows of a refresh are collected up to scannerDataEnd, then
+the snapshot (a dict of arrays: "conId" and "rank", in rank order) is
+compared to the previous one of the same reqId with a few array operations:
+    entered   conIds not in the previous snapshot, with their rank
+    exited    conIds gone, with their last rank
+    moved     conIds in both whose rank changed, old and new rank
+Listeners get a ScanDelta only when something changed; the first snapshot of
+a subscription is all entries. The ContractDetails of every conId seen are
+kept, a listener reacting to an entry finds the contract with details().
+
+Combos (complex scanners) have no conId, they are keyed by a negative hash
+of their legs.
+
+    differ = ScannerDiffer()
+    differ.listeners.append(lambda delta: print(delta))
+    # scannerData / scannerDataEnd: hand them over to the differ
+"""
+
+import zlib
+
+import numpy as np
+
+from ibapi.contract import ContractDetails
+from ibapi.object_implem import Object
+
+
+def scanKey(contractDetails: ContractDetails, legsStr: str) -> int:
+    conId = contractDetails.contract.conId
+    if conId:
+        return conId
+    return -(zlib.crc32(legsStr.encode()) or 1)
+
+
+def _emptySnapshot() -> dict:
+    return {"conId": np.empty(0, dtype=np.int64), "rank": np.empty(0, dtype=np.int32)}
+
+
+class ScanDelta(Object):
+    def __init__(self, reqId: int, refresh: int, entered: list, exited: list,
+                 moved: list):
+        self.reqId = reqId
+        # count of the snapshots of this subscription, 1 for the first one
+        self.refresh = refresh
+        # [(conId, rank)]
+        self.entered = entered
+        # [(conId, last rank)]
+        self.exited = exited
+        # [(conId, old rank, new rank)]
+        self.moved = moved
+
+    def __bool__(self):
+        return bool(self.entered or self.exited or self.moved)
+
+    def __str__(self):
+        return "ReqId: %d, Refresh: %d, Entered: %s, Exited: %s, Moved: %s" % (
+            self.reqId, self.refresh, self.entered, self.exited, self.moved)
+
+
+class ScannerDiffer(Object):
+    def __init__(self):
+        # reqId -> last complete snapshot
+        self.snapshots = {}
+        self.nRefreshes = {}
+        # reqId -> ([conId], [rank]) of the refresh being received
+        self.building = {}
+        self.conId2details = {}
+        self.listeners = []
+
+    def scannerData(self, reqId: int, rank: int, contractDetails: ContractDetails,
+                    distance: str, benchmark: str, projection: str, legsStr: str):
+        rows = self.building.get(reqId)
+        if rows is None:
+            rows = self.building[reqId] = ([], [])
+        conId = scanKey(contractDetails, legsStr)
+        rows[0].append(conId)
+        rows[1].append(rank)
+        if conId not in self.conId2details:
+            self.conId2details[conId] = contractDetails
+
+    def scannerDataEnd(self, reqId: int) -> ScanDelta:
+        """ the delta of this refresh, also handed to the listeners if not
+        empty """
+        (conIds, ranks) = self.building.pop(reqId, ([], []))
+        current = {"conId": np.array(conIds, dtype=np.int64),
+                   "rank": np.array(ranks, dtype=np.int32)}
+        previous = self.snapshots.get(reqId) or _emptySnapshot()
+        self.snapshots[reqId] = current
+        refresh = self.nRefreshes.get(reqId, 0) + 1
+        self.nRefreshes[reqId] = refresh
+        delta = self.diff(reqId, refresh, previous, current)
+        if delta:
+            for listener in self.listeners:
+                listener(delta)
+        return delta
+
+    @staticmethod
+    def diff(reqId: int, refresh: int, previous: dict, current: dict) -> ScanDelta:
+        (prevIds, prevRanks) = (previous["conId"], previous["rank"])
+        (curIds, curRanks) = (current["conId"], current["rank"])
+        entered = ~np.isin(curIds, prevIds)
+        exited = ~np.isin(prevIds, curIds)
+        (_, iPrev, iCur) = np.intersect1d(prevIds, curIds, return_indices=True)
+        moved = prevRanks[iPrev] != curRanks[iCur]
+        return ScanDelta(
+            reqId, refresh,
+            list(zip(curIds[entered].tolist(), curRanks[entered].tolist())),
+            list(zip(prevIds[exited].tolist(), prevRanks[exited].tolist())),
+            list(zip(curIds[iCur[moved]].tolist(), prevRanks[iPrev[moved]].tolist(),
+                     curRanks[iCur[moved]].tolist())))
+
+    def current(self, reqId: int) -> dict:
+        """ the last complete snapshot, {"conId": array, "rank": array} """
+        return self.snapshots.get(reqId) or _emptySnapshot()
+
+    def details(self, conId: int) -> ContractDetails:
+        return self.conId2details.get(conId)
+
+    def forget(self, reqId: int):
+        """ after cancelScannerSubscription: a new subscription with the same
+        reqId starts from nothing """
+        self.snapshots.pop(reqId, None)
+        self.nRefreshes.pop(reqId, None)
+        self.building.pop(reqId, None)
@@ -0,0 +1,185 @@
+"""
+Scanner parameters: the reqScannerParameters XML parsed once, indexed and
+cached on disk, so scanner subscriptions are checked locally before they are
+sent.
+
+The XML (several MB) is read with an incremental parser, every Instrument,
+Location, ScanType and filter element is indexed when it ends and then
+dropped, the document is never held as a tree. The indexes:
+    instruments     instrument type -> (name, filter ids)
+    locations       location code -> instrument types (a sub location
+                    without its own list has the one of its parent)
+    scanCodes       scan code -> (display name, instrument types)
+    filters         filter id -> tag names of its fields (the names used in
+                    the scannerSubscriptionFilterOptions TagValues)
+    instrumentTags  instrument type -> every tag name allowed with it
+The cache file is keyed by the server version: a header then the indexes
+pickled, loading it takes a few milliseconds and checking a subscription is
+a handful of dict and set lookups.
+
+    params = ScannerParameters.load("cache", app.serverVersion())
+    if params is None:
+        app.reqScannerParameters()
+        # scannerParameters(xml):
+        #     ScannerParameters.parse(xml, app.serverVersion()).save("cache")
+    params.validate(ScannerSubscriptionSamples.HotUSStkByVolume(), tagValues)
+"""
+
+import io
+import os
+import pickle
+import struct
+import xml.etree.ElementTree as ElementTree
+
+from ibapi.object_implem import Object
+from ibapi.scanner import ScannerSubscription
+
+MAGIC = b"IBSP"
+VERSION = 1
+# magic version reserved serverVersion
+_HEADER = struct.Struct("<4sHHI")
+
+
+class InvalidScannerSubscription(ValueError):
+    def __init__(self, subscription: ScannerSubscription, problems: list):
+        ValueError.__init__(self, "%s/%s/%s: %s" % (
+            subscription.instrument, subscription.locationCode,
+            subscription.scanCode, "; ".join(problems)))
+        self.subscription = subscription
+        self.problems = problems
+
+
+def _split(text: str) -> frozenset:
+    return frozenset(part.strip() for part in (text or "").split(",") if part.strip())
+
+
+class ScannerParameters(Object):
+    def __init__(self, serverVersion: int, instruments: dict, locations: dict,
+                 scanCodes: dict, filters: dict):
+        self.serverVersion = serverVersion
+        self.instruments = instruments
+        self.locations = locations
+        self.scanCodes = scanCodes
+        self.filters = filters
+        self.instrumentTags = {
+            instrument: frozenset(tag for filterId in filterIds
+                                  for tag in filters.get(filterId, ()))
+            for (instrument, (_, filterIds)) in instruments.items()}
+
+    def __str__(self):
+        return "ServerVersion: %d, Instruments: %d, Locations: %d, ScanCodes: %d, Filters: %d" % (
+            self.serverVersion, len(self.instruments), len(self.locations),
+            len(self.scanCodes), len(self.filters))
+
+    @classmethod
+    def parse(cls, xml, serverVersion: int) -> "ScannerParameters":
+        """ xml as received by scannerParameters, or a binary file object """
+        source = io.BytesIO(xml.encode()) if isinstance(xml, str) else xml
+        instruments = {}
+        # locationCode -> (instrument types, sub location codes)
+        locationTree = {}
+        scanCodes = {}
+        filters = {}
+        depth = 0
+        for (event, elem) in ElementTree.iterparse(source, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                continue
+            depth -= 1
+            tag = elem.tag
+            if tag == "Instrument":
+                instruments[elem.findtext("type")] = (
+                    elem.findtext("name"), _split(elem.findtext("filters")))
+                elem.clear()
+            elif tag == "Location":
+                # sub locations are still there, cleared with the tree
+                locationTree[elem.findtext("locationCode")] = (
+                    _split(elem.findtext("instruments")),
+                    [code.text for code in elem.iterfind("LocationTree/Location/locationCode")])
+            elif tag == "ScanType":
+                scanCodes[elem.findtext("scanCode")] = (
+                    elem.findtext("displayName"), _split(elem.findtext("instruments")))
+                elem.clear()
+            elif tag.endswith("Filter") and elem.find("id") is not None:
+                filters[elem.findtext("id")] = tuple(
+                    field.findtext("code") for field in elem.iter("AbstractField"))
+                elem.clear()
+            elif depth == 1:
+                # a whole list (the location tree, settings, ...) is done
+                elem.clear()
+        return cls(serverVersion, instruments, cls._inherit(locationTree),
+                   scanCodes, filters)
+
+    @staticmethod
+    def _inherit(locationTree: dict) -> dict:
+        locations = {}
+        children = {child for (_, subCodes) in locationTree.values() for child in subCodes}
+        pending = [(code, frozenset()) for code in locationTree if code not in children]
+        while pending:
+            (code, parentInstruments) = pending.pop()
+            (instruments, subCodes) = locationTree[code]
+            locations[code] = instruments or parentInstruments
+            pending.extend((sub, locations[code]) for sub in subCodes)
+        return locations
+
+    @staticmethod
+    def cachePath(directory: str, serverVersion: int) -> str:
+        return os.path.join(directory, "scanner-%d.params" % serverVersion)
+
+    def save(self, directory: str):
+        """ write the cache file of this server version, atomically """
+        path = self.cachePath(directory, self.serverVersion)
+        os.makedirs(directory, exist_ok=True)
+        tmpPath = path + ".tmp"
+        with open(tmpPath, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, 0, self.serverVersion))
+            pickle.dump((self.instruments, self.locations, self.scanCodes, self.filters),
+                        f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpPath, path)
+
+    @classmethod
+    def load(cls, directory: str, serverVersion: int) -> "ScannerParameters":
+        """ None if there is no cache for this server version """
+        return cls.fromFile(cls.cachePath(directory, serverVersion))
+
+    @classmethod
+    def fromFile(cls, path: str) -> "ScannerParameters":
+        try:
+            with open(path, "rb") as f:
+                buf = f.read()
+        except FileNotFoundError:
+            return None
+        (magic, version, _, serverVersion) = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a scanner parameters cache file" % path)
+        (instruments, locations, scanCodes, filters) = pickle.loads(buf[_HEADER.size:])
+        return cls(serverVersion, instruments, locations, scanCodes, filters)
+
+    def problems(self, subscription: ScannerSubscription,
+                 filterTagValues: list = None) -> list:
+        """ what TWS would reject in the subscription, [] if nothing """
+        problems = []
+        instrument = subscription.instrument
+        if instrument not in self.instruments:
+            problems.append("unknown instrument %s" % instrument)
+        locationCode = subscription.locationCode
+        instruments = self.locations.get(locationCode)
+        if instruments is None:
+            problems.append("unknown location %s" % locationCode)
+        elif instruments and instrument not in instruments:
+            problems.append("location %s is not for %s" % (locationCode, instrument))
+        scanCode = self.scanCodes.get(subscription.scanCode)
+        if scanCode is None:
+            problems.append("unknown scan code %s" % subscription.scanCode)
+        elif instrument not in scanCode[1]:
+            problems.append("scan code %s is not for %s" % (subscription.scanCode, instrument))
+        tags = self.instrumentTags.get(instrument, frozenset())
+        for tagValue in filterTagValues or ():
+            if tagValue.tag not in tags:
+                problems.append("filter %s is not for %s" % (tagValue.tag, instrument))
+        return problems
+
+    def validate(self, subscription: ScannerSubscription, filterTagValues: list = None):
+        problems = self.problems(subscription, filterTagValues)
+        if problems:
+            raise InvalidScannerSubscription(subscription, problems)
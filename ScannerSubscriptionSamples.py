@@ -4,9 +4,13 @@ Copyright (C) 2019 Interactive Brokers LLC. All rights reserved. This code is su
 """
 
 
+import sys
+
 from ibapi.object_implem import Object 
 from ibapi.scanner import ScannerSubscription
 
+from ScannerParameters import ScannerParameters
+
 
 class ScannerSubscriptionSamples(Object):
 
@@ -65,13 +69,18 @@ class ScannerSubscriptionSamples(Object):
         #! [combolatesttrade]
         return scanSub
 		
-def Test():
-    print(ScannerSubscriptionSamples.HotUSStkByVolume())
-    print(ScannerSubscriptionSamples.TopPercentGainersIbis())
-    print(ScannerSubscriptionSamples.MostActiveFutSoffex())
-    print(ScannerSubscriptionSamples.HighOptVolumePCRatioUSIndexes())
+def Test(paramsPath: str = None):
+    # with a scanner parameters cache file, the samples are checked against it
+    params = ScannerParameters.fromFile(paramsPath) if paramsPath else None
+    for scanSub in (ScannerSubscriptionSamples.HotUSStkByVolume(),
+                    ScannerSubscriptionSamples.TopPercentGainersIbis(),
+                    ScannerSubscriptionSamples.MostActiveFutSoffex(),
+                    ScannerSubscriptionSamples.HighOptVolumePCRatioUSIndexes()):
+        print(scanSub)
+        if params is not None:
+            print(params.problems(scanSub) or "valid")
     
  
 if "__main__" == __name__:
-    Test()
+    Test(*sys.argv[1:2])
  
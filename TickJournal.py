@@ -0,0 +1,260 @@
+"""
+Memory mapped, append only journal of tick-by-tick data.
+
+One file per reqId and tick type, a 64 bytes header followed by fixed size
+records:
+    Last/AllLast   recvTime time price size tickType pastLimit unreported
+                   exchange[16] specialConditions[16]               72 bytes
+    BidAsk         recvTime time bidPrice askPrice bidSize askSize
+                   bidPastLow askPastHigh                           56 bytes
+    MidPoint       recvTime time midPoint                           24 bytes
+recvTime is the local reception time in ns, time the exchange epoch seconds.
+
+Records are packed straight into the mapping with struct.pack_into(), the
+few exchange and condition strings are encoded once and cached, so appending
+creates no object per tick. A longer string is cut, logged and counted in
+nTruncated. The file grows by doubling. The record count in
+the header is updated after the record itself, a reader never sees a partial
+record.
+
+The reader side is a NumPy structured array over the file, no copy:
+    ticks = readJournal("ticks/1001_BidAsk.tj")
+    spread = ticks["askPrice"] - ticks["bidPrice"]
+"""
+
+import glob
+import logging
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+from ibapi.object_implem import Object
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"IBTJ"
+VERSION = 2
+HEADER_SIZE = 64
+# magic version kind recordSize reqId count
+_HEADER = struct.Struct("<4sHHIiQ")
+_COUNT = struct.Struct("<Q")
+_COUNT_OFFSET = 16
+
+KIND_LAST = 1
+KIND_BID_ASK = 2
+KIND_MID_POINT = 3
+
+KIND_NAMES = {KIND_LAST: "Last", KIND_BID_ASK: "BidAsk", KIND_MID_POINT: "MidPoint"}
+
+_STR_SIZE = 16
+
+_RECORDS = {
+    KIND_LAST: struct.Struct("<qqdqb??5x16s16s"),
+    KIND_BID_ASK: struct.Struct("<qqddqq??6x"),
+    KIND_MID_POINT: struct.Struct("<qqd"),
+}
+
+DTYPES = {
+    KIND_LAST: np.dtype({
+        "names": ["recvTime", "time", "price", "size", "tickType", "pastLimit",
+                  "unreported", "exchange", "specialConditions"],
+        "formats": ["<i8", "<i8", "<f8", "<i8", "i1", "?", "?", "S16", "S16"],
+        "offsets": [0, 8, 16, 24, 32, 33, 34, 40, 56],
+        "itemsize": 72}),
+    KIND_BID_ASK: np.dtype({
+        "names": ["recvTime", "time", "bidPrice", "askPrice", "bidSize", "askSize",
+                  "bidPastLow", "askPastHigh"],
+        "formats": ["<i8", "<i8", "<f8", "<f8", "<i8", "<i8", "?", "?"],
+        "offsets": [0, 8, 16, 24, 32, 40, 48, 49],
+        "itemsize": 56}),
+    KIND_MID_POINT: np.dtype([("recvTime", "<i8"), ("time", "<i8"),
+                              ("midPoint", "<f8")]),
+}
+
+
+class TickJournal(Object):
+    def __init__(self, path: str, kind: int, reqId: int,
+                 initialCapacity: int = 1 << 16):
+        self.path = path
+        self.kind = kind
+        self.reqId = reqId
+        self.record = _RECORDS[kind]
+        self.recordSize = self.record.size
+        self.strCache = {}
+        # distinct strings cut to _STR_SIZE bytes
+        self.nTruncated = 0
+
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if exists:
+            header = os.pread(self.fd, _HEADER.size, 0)
+            (magic, version, fileKind, recordSize, fileReqId, count) = \
+                _HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION or fileKind != kind \
+                    or recordSize != self.recordSize:
+                os.close(self.fd)
+                raise ValueError("%s is not a %s tick journal" % (path, KIND_NAMES[kind]))
+            self.count = count
+            size = os.fstat(self.fd).st_size
+            self.capacity = max((size - HEADER_SIZE) // self.recordSize, count)
+        else:
+            self.count = 0
+            self.capacity = initialCapacity
+            os.ftruncate(self.fd, HEADER_SIZE + self.capacity * self.recordSize)
+        self.mm = mmap.mmap(self.fd, HEADER_SIZE + self.capacity * self.recordSize)
+        _HEADER.pack_into(self.mm, 0, MAGIC, VERSION, kind, self.recordSize, reqId,
+                          self.count)
+        self.offset = HEADER_SIZE + self.count * self.recordSize
+
+    def _grow(self):
+        # a reopened journal may have been truncated down to its records
+        self.capacity = max(2 * self.capacity, 1024)
+        os.ftruncate(self.fd, HEADER_SIZE + self.capacity * self.recordSize)
+        # the old mapping may still back arrays handed out by view(), leave
+        # it to the garbage collector rather than closing it under them
+        self.mm.flush()
+        self.mm = mmap.mmap(self.fd, HEADER_SIZE + self.capacity * self.recordSize)
+
+    def _bytes(self, s: str) -> bytes:
+        b = self.strCache.get(s)
+        if b is None:
+            b = s.encode()
+            if len(b) > _STR_SIZE:
+                self.nTruncated += 1
+                logger.warning("%s: %r cut to %d bytes", self.path, s, _STR_SIZE)
+                b = b[:_STR_SIZE]
+            self.strCache[s] = b
+        return b
+
+    def _commit(self):
+        self.count += 1
+        self.offset += self.recordSize
+        _COUNT.pack_into(self.mm, _COUNT_OFFSET, self.count)
+
+    def appendLast(self, recvTime: int, tickType: int, time_: int, price: float,
+                   size: int, pastLimit: bool, unreported: bool, exchange: str,
+                   specialConditions: str):
+        if self.count == self.capacity:
+            self._grow()
+        self.record.pack_into(self.mm, self.offset, recvTime, time_, price, size,
+                              tickType, pastLimit, unreported, self._bytes(exchange),
+                              self._bytes(specialConditions))
+        self._commit()
+
+    def appendBidAsk(self, recvTime: int, time_: int, bidPrice: float,
+                     askPrice: float, bidSize: int, askSize: int, bidPastLow: bool,
+                     askPastHigh: bool):
+        if self.count == self.capacity:
+            self._grow()
+        self.record.pack_into(self.mm, self.offset, recvTime, time_, bidPrice,
+                              askPrice, bidSize, askSize, bidPastLow, askPastHigh)
+        self._commit()
+
+    def appendMidPoint(self, recvTime: int, time_: int, midPoint: float):
+        if self.count == self.capacity:
+            self._grow()
+        self.record.pack_into(self.mm, self.offset, recvTime, time_, midPoint)
+        self._commit()
+
+    def view(self) -> np.ndarray:
+        """ the records written so far, as a structured array over the live
+        mapping (no copy) """
+        return np.frombuffer(self.mm, dtype=DTYPES[self.kind], count=self.count,
+                             offset=HEADER_SIZE)
+
+    def flush(self):
+        self.mm.flush()
+
+    def close(self):
+        if self.mm is None:
+            return
+        self.mm.flush()
+        try:
+            self.mm.close()
+            # only now the unused tail can go without pulling pages from
+            # under a mapping
+            os.ftruncate(self.fd, self.offset)
+        except BufferError:
+            # arrays from view() are still alive, keep the file as it is
+            pass
+        os.close(self.fd)
+        self.mm = None
+
+
+class TickJournals(Object):
+    """ one journal per reqId and tick type under a directory, opened on the
+    first tick; meant to be called from the tickByTick* callbacks """
+
+    def __init__(self, directory: str, initialCapacity: int = 1 << 16):
+        self.directory = directory
+        self.initialCapacity = initialCapacity
+        self.journals = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def journal(self, reqId: int, kind: int) -> TickJournal:
+        # a reqId reused for another tick type gets a journal of its own
+        journal = self.journals.get((reqId, kind))
+        if journal is None:
+            path = journalPath(self.directory, reqId, kind)
+            journal = TickJournal(path, kind, reqId, self.initialCapacity)
+            self.journals[(reqId, kind)] = journal
+        return journal
+
+    def tickByTickAllLast(self, reqId: int, tickType: int, time_: int, price: float,
+                          size: int, pastLimit: bool, unreported: bool,
+                          exchange: str, specialConditions: str):
+        journal = self.journal(reqId, KIND_LAST)
+        journal.appendLast(time.time_ns(), tickType, time_, price, size, pastLimit,
+                           unreported, exchange, specialConditions)
+
+    def tickByTickBidAsk(self, reqId: int, time_: int, bidPrice: float,
+                         askPrice: float, bidSize: int, askSize: int,
+                         bidPastLow: bool, askPastHigh: bool):
+        journal = self.journal(reqId, KIND_BID_ASK)
+        journal.appendBidAsk(time.time_ns(), time_, bidPrice, askPrice, bidSize,
+                             askSize, bidPastLow, askPastHigh)
+
+    def tickByTickMidPoint(self, reqId: int, time_: int, midPoint: float):
+        journal = self.journal(reqId, KIND_MID_POINT)
+        journal.appendMidPoint(time.time_ns(), time_, midPoint)
+
+    def flush(self):
+        for journal in self.journals.values():
+            journal.flush()
+
+    def close(self):
+        for journal in self.journals.values():
+            journal.close()
+        self.journals.clear()
+
+
+def journalPath(directory: str, reqId: int, kind: int) -> str:
+    return os.path.join(directory, "%d_%s.tj" % (reqId, KIND_NAMES[kind]))
+
+
+def readJournal(path: str) -> np.ndarray:
+    """ read only structured array mapped on the file, no copy; only the
+    records committed when called are visible """
+    with open(path, "rb") as f:
+        header = f.read(_HEADER.size)
+    (magic, version, kind, recordSize, reqId, count) = _HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s is not a tick journal" % path)
+    dtype = DTYPES[kind]
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(count,))
+
+
+def readJournals(directory: str) -> dict:
+    """ (reqId, kind) -> structured array, for every journal in the
+    directory """
+    name2kind = {name: kind for (kind, name) in KIND_NAMES.items()}
+    journals = {}
+    for path in sorted(glob.glob(os.path.join(directory, "*.tj"))):
+        (reqId, name) = os.path.basename(path)[:-len(".tj")].split("_")
+        journals[(int(reqId), name2kind[name])] = readJournal(path)
+    return journals
@@ -1,4 +1,6 @@
-from collections import defaultdict
+import concurrent.futures
+import itertools
+import sys
 import time
 import threading
 
@@ -8,9 +10,49 @@ from ibapi.client import EClient
 from ibapi.contract import *
 from ibapi.ticktype import *
 
+from BarAggregator import BarAggregator
+from BarStore import BarStore, barDateToEpoch
+import CompactRecords
+from CandleAnalyzer import CandleAnalyzer
+from ConnectionPool import ConnectionPool
+from ContractCache import ContractCache, ContractResolutionError, conIdContract
+from HistoricalBarCache import HistoricalBarCache, fillStore
+from HistoricalDataScheduler import HistoricalDataScheduler
+from RequestMgr import RequestMgr
+from RingBuffer import BAR_RECORD, RingBuffer
+from ScannerDiffer import ScannerDiffer
+from ScannerSubscriptionSamples import ScannerSubscriptionSamples
+from ScanPipeline import ScanPipeline
+
 AMOUNT_OF_CANDLES_TO_CONSIDER = 4
 CANDLE_TIME_IN_SECONDS = 300
 TOTAL_SECONDS_TO_FETCH = (AMOUNT_OF_CANDLES_TO_CONSIDER-1) * CANDLE_TIME_IN_SECONDS
+# real time bar subscriptions use their own ids, next to the historical ones
+REALTIME_REQ_ID_OFFSET = 1000
+# candles of the symbols close within a moment of each other, scan them once
+CANDLE_SETTLE_SECONDS = 1
+# how long the main thread sleeps when the bar rings are empty
+BAR_POLL_SECONDS = 0.05
+# bars fetched once are kept here, restarts only fetch what is missing
+BAR_CACHE_DIRECTORY = 'cache/bars'
+CONTRACT_CACHE_PATH = 'cache/contracts.pickle'
+# symbols are spread over this many connections, clientIds from CLIENT_ID on
+CONNECTIONS = 3
+CLIENT_ID = 123
+# symbols showing up in these scanners are analyzed too, next to SYMBOLS
+SCANNERS = {9001: ScannerSubscriptionSamples.HotUSStkByVolume(),
+            9002: ScannerSubscriptionSamples.TopPercentGainersIbis()}
+SCANNER_ROWS = 20
+# real time bars of the scanned symbols, from here on
+SCANNED_REALTIME_REQ_ID = 20000
+# most symbols taken from the scanners at a time, history requests out at once
+SCANNED_SYMBOLS = 40
+SCANNED_FETCHES = 4
+# a scanned symbol whose history could not be requested by then is retried later
+SCAN_TO_SIGNAL_SECONDS = 30
+
+# bars and tick attributes come as slotted records
+CompactRecords.install()
 
 
 class Wrapper(wrapper.EWrapper):
@@ -21,33 +63,92 @@ class Client(EClient):
     pass
 
 
-class IBapi(Wrapper, EClient):
+class IBapi(Wrapper):
     def __init__(self):
-        EClient.__init__(self, self)
-        self.fetched_data = defaultdict(lambda: {})
+        Wrapper.__init__(self)
+        # every request goes through the pool, the callbacks of all its
+        # connections come back here one at a time
+        self.client = ConnectionPool(self, CONNECTIONS, CLIENT_ID)
+        self.fetched_data = BarStore()
+        self.scheduler = HistoricalDataScheduler(self.client)
+        self.reqMgr = RequestMgr()
+        self.contract_cache = ContractCache(self.client, self.reqMgr, CONTRACT_CACHE_PATH)
+        self.bar_cache = HistoricalBarCache(BAR_CACHE_DIRECTORY, self.scheduler)
+        self.ready = threading.Event()
+        # the reader threads only publish bars, the main thread drains them
+        # into fetched_data: it is the only one touching the store
+        self.historical_bars = RingBuffer(BAR_RECORD, 1 << 14)
+        self.realtime_bars = RingBuffer(BAR_RECORD, 1 << 14)
+        # live 5 seconds bars are rolled up into the same candles
+        self.aggregator = BarAggregator(CANDLE_TIME_IN_SECONDS, self.fetched_data,
+                                        onClose=self.candleClosed)
+        # monotonic time of the first candle closed since the last scan
+        self.candle_closed_at = None
+        # scanner refreshes reduced to entries and exits
+        self.scan_differ = ScannerDiffer()
+
+    def candleClosed(self, row, start):
+        if self.candle_closed_at is None:
+            self.candle_closed_at = time.monotonic()
+
+    def drain_bars(self) -> int:
+        """ main thread only, returns how many bars were drained """
+        historical = self.historical_bars.drain()
+        self.fetched_data.appendRecords(historical)
+        realtime = self.realtime_bars.drain()
+        for (reqId, time_, open_, high, low, close, volume, wap,
+             count) in realtime.tolist():
+            self.aggregator.addBar(reqId, time_, open_, high, low, close, volume, wap, count)
+        return len(historical) + len(realtime)
+
+    def nextValidId(self, orderId):
+        self.ready.set()
+
+    def error(self, reqId, errorCode, errorString):
+        if self.scheduler.onError(reqId, errorCode, errorString):
+            return
+        if not self.bar_cache.error(reqId, errorCode, errorString):
+            self.reqMgr.receivedError(reqId, errorCode, errorString)
+            print(f'[{reqId}] Error {errorCode}: {errorString}')
+
+    def contractDetails(self, reqId, contractDetails):
+        self.reqMgr.receivedMsg(reqId, contractDetails)
+
+    def contractDetailsEnd(self, reqId):
+        self.reqMgr.receivedEnd(reqId)
 
     def tickPrice(self, reqId, tickType, price, attrib):
         print(f'[{reqId}] The current ask price is: {price}, ticktype: {TickType}, attrib:{attrib}')
 
     def historicalData(self, reqId, bar):
         print(f'[{reqId}] Time: {bar.date} Close: {bar.close}')
-        self.fetched_data[reqId][bar.date] = bar
+        if not self.bar_cache.historicalData(reqId, bar):
+            self.historical_bars.publish((reqId, barDateToEpoch(bar.date), bar.open, bar.high,
+                                          bar.low, bar.close, bar.volume, bar.average,
+                                          bar.barCount))
 
+    def historicalDataEnd(self, reqId, start, end):
+        self.scheduler.onEnd(reqId)
+        self.bar_cache.historicalDataEnd(reqId)
 
-def run_loop():
-    app.run()
+    def realtimeBar(self, reqId, time, open_, high, low, close, volume, wap, count):
+        self.realtime_bars.publish((reqId, time, open_, high, low, close, volume, wap, count))
 
+    def scannerData(self, reqId, rank, contractDetails, distance, benchmark, projection, legsStr):
+        self.scan_differ.scannerData(reqId, rank, contractDetails, distance, benchmark,
+                                     projection, legsStr)
 
-app = IBapi()
-app.connect("127.0.0.1", 7497, 123)
+    def scannerDataEnd(self, reqId):
+        self.scan_differ.scannerDataEnd(reqId)
 
-api_thread = threading.Thread(target=run_loop, daemon=True)
-api_thread.start()
 
-time.sleep(1)
+app = IBapi()
+app.client.connect("127.0.0.1", 7497)
+
+app.ready.wait(10)
 
 
-app.reqMarketDataType(3)
+app.client.reqMarketDataType(3)
 #Create contract object
 eurusd_contract = Contract()
 eurusd_contract.symbol = 'EUR'
@@ -69,7 +170,7 @@ eurusd_contract.currency = 'USD'
 # google_contract.exchange = 'SMART'
 # google_contract.currency = 'USD'
 
-SYMBOLS = ['MU', 'APPL', 'MSFT', 'JD', 'PDD', 'FSLY']
+SYMBOLS = ['MU', 'AAPL', 'MSFT', 'JD', 'PDD', 'FSLY']
 
 
 def generate_contract_for_symbol(symbol_name :str, exchange : str= 'SMART') -> Contract:
@@ -83,17 +184,97 @@ def generate_contract_for_symbol(symbol_name :str, exchange : str= 'SMART') -> C
 def get_end_of_exchange_date_time_by_day(day) -> str:
     return ''
 
-def analyze_for_
+candle_analyzer = CandleAnalyzer(AMOUNT_OF_CANDLES_TO_CONSIDER)
 
-for request_index, symbol_name in enumerate(SYMBOLS):
-    contract = generate_contract_for_symbol(symbol_name)
-    app.reqHistoricalData(request_index, eurusd_contract, '', f'{TOTAL_SECONDS_TO_FETCH} S', '5 mins', 'BID', 0, 1, False, [])
+
+def analyze_for_signals(symbols: list = None):
+    start = time.perf_counter()
+    analysis = candle_analyzer.analyzeStore(app.fetched_data, symbols)
+    print(f'{analysis} (scan took {(time.perf_counter() - start) * 1000:.3f} ms)')
+    return analysis
+
+# a misspelled symbol stops here, not as a late error of some request
+try:
+    contract_details = app.contract_cache.resolve([generate_contract_for_symbol(symbol_name) for symbol_name in SYMBOLS],
+                                                  timeout=30)
+except ContractResolutionError as e:
+    print(e)
+    app.client.disconnect()
+    sys.exit(1)
+# every request below is keyed by conId
+contracts = {symbol_name: conIdContract(details, 'SMART') for symbol_name, details in zip(SYMBOLS, contract_details)}
+
+window_start = time.time() - TOTAL_SECONDS_TO_FETCH
+cache_requests = [app.bar_cache.request(contracts[symbol_name], '5 mins', 'BID', 0, window_start)
+                  for symbol_name in SYMBOLS]
 #a = time.time()
 #app.reqMktData(1, apple_contract, '', False, False, [])
 #app.reqMktData(2, google_contract, '', False, False, [])
 #app.tickSnapshotEnd(1)
 
-time.sleep(10)
+for symbol_name, cache_request in zip(SYMBOLS, cache_requests):
+    try:
+        bars = cache_request.get(timeout=600)
+    except concurrent.futures.TimeoutError:
+        print(f'Timed out waiting for historical data of {symbol_name}')
+        continue
+    for reqId, errorCode, errorString in cache_request.errors:
+        print(f'[{reqId}] {symbol_name} failed with {errorCode}: {errorString}')
+    fillStore(app.fetched_data, app.fetched_data.addSymbol(symbol_name), bars)
+
+analyze_for_signals(SYMBOLS)
+
+# from now on the candles are built from real time bars, no more round trips
+for request_index, symbol_name in enumerate(SYMBOLS):
+    app.aggregator.addSymbol(symbol_name, REALTIME_REQ_ID_OFFSET + request_index)
+    app.aggregator.resume(symbol_name)
+    app.client.reqRealTimeBars(REALTIME_REQ_ID_OFFSET + request_index,
+                               contracts[symbol_name], 5, 'BID', 0, [])
+
+# scanned symbols get the same history and real time bars as SYMBOLS
+scanned_req_ids = {}
+next_scanned_req_id = itertools.count(SCANNED_REALTIME_REQ_ID)
+
+
+def follow_scanned(symbol_name, contract):
+    req_id = next(next_scanned_req_id)
+    scanned_req_ids[symbol_name] = req_id
+    app.aggregator.addSymbol(symbol_name, req_id)
+    app.aggregator.resume(symbol_name)
+    app.client.reqRealTimeBars(req_id, contract, 5, 'BID', 0, [])
+
+
+def unfollow_scanned(symbol_name):
+    app.client.cancelRealTimeBars(scanned_req_ids.pop(symbol_name))
+
+
+scan_pipeline = ScanPipeline(app.scan_differ, app.bar_cache, app.fetched_data, candle_analyzer,
+                             '5 mins', 'BID', 0, TOTAL_SECONDS_TO_FETCH,
+                             ignoreConIds=[contract.conId for contract in contracts.values()],
+                             maxInFlight=SCANNED_FETCHES, maxSymbols=SCANNED_SYMBOLS,
+                             maxLatency=SCAN_TO_SIGNAL_SECONDS,
+                             onReady=follow_scanned, onGone=unfollow_scanned)
+for scanner_req_id, scanner_subscription in SCANNERS.items():
+    scanner_subscription.numberOfRows = SCANNER_ROWS
+    app.client.reqScannerSubscription(scanner_req_id, scanner_subscription, [], [])
+
+try:
+    while app.client.isConnected():
+        if not app.drain_bars():
+            time.sleep(BAR_POLL_SECONDS)
+        scanned_analysis = scan_pipeline.poll()
+        if scanned_analysis is not None:
+            print(f'{scanned_analysis} (scanned, scan to signal {scan_pipeline.latencyStats()})')
+        # symbols without a bar for a while still get their candle closed
+        app.aggregator.flush(grace=10)
+        if app.candle_closed_at is not None \
+                and time.monotonic() - app.candle_closed_at >= CANDLE_SETTLE_SECONDS:
+            app.candle_closed_at = None
+            analyze_for_signals(SYMBOLS + scan_pipeline.symbols())
+except KeyboardInterrupt:
+    pass
 
-time.sleep(5)
-app.disconnect()
+for scanner_req_id in SCANNERS:
+    app.client.cancelScannerSubscription(scanner_req_id)
+print(f'Scan to signal latency: {scan_pipeline.latencyStats()}')
+app.client.disconnect()